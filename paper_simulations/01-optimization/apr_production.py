@@ -0,0 +1,290 @@
+import logging
+
+import mdtraj
+import numpy as np
+from openff.evaluator.attributes import UNDEFINED
+from openff.evaluator.protocols.paprika.openmm import PaprikaOpenMMSimulation
+from openff.evaluator.protocols.paprika.restraints import ApplyRestraints
+from openff.evaluator.utils.timeseries import analyze_time_series
+from openff.evaluator.workflow import workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute, OutputAttribute
+from openff.units import unit
+
+from checkpointing import check_checkpoint
+
+logger = logging.getLogger(__name__)
+
+# The APR phases, whose windows are integrated over lambda
+APR_PHASES = ("attach", "pull", "release")
+
+
+def _centroids(trajectory, groups):
+    # The mass weighted centroid of each atom group (nm), single dummy atoms
+    # may have no mass
+    masses = np.array([atom.element.mass or 0.0 for atom in trajectory.topology.atoms])
+    centroids = []
+    for group in groups:
+        weights = masses[group] if masses[group].sum() > 0.0 else np.ones(len(group))
+        centroids.append(
+            np.einsum("fai,a->fi", trajectory.xyz[:, group], weights) / weights.sum()
+        )
+    return centroids
+
+
+def restraint_values(trajectory, restraint):
+    # The distance (Angstrom), angle or dihedral (radians) of a pAPRika
+    # restraint in every frame
+    groups = [
+        list(group)
+        for group in (
+            restraint.index1,
+            restraint.index2,
+            restraint.index3,
+            restraint.index4,
+        )
+        if group is not None
+    ]
+    points = _centroids(trajectory, groups)
+
+    if len(points) == 2:
+        return 10.0 * np.linalg.norm(points[1] - points[0], axis=1)
+
+    if len(points) == 3:
+        first, second = points[0] - points[1], points[2] - points[1]
+        cosine = np.einsum("fi,fi->f", first, second) / (
+            np.linalg.norm(first, axis=1) * np.linalg.norm(second, axis=1)
+        )
+        return np.arccos(np.clip(cosine, -1.0, 1.0))
+
+    first, second, third = (
+        points[1] - points[0],
+        points[2] - points[1],
+        points[3] - points[2],
+    )
+    normal_1, normal_2 = np.cross(first, second), np.cross(second, third)
+    unit_second = second / np.linalg.norm(second, axis=1)[:, None]
+    return np.arctan2(
+        np.einsum("fi,fi->f", np.cross(normal_1, normal_2), unit_second),
+        np.einsum("fi,fi->f", normal_1, normal_2),
+    )
+
+
+def lambda_restraints(restraints, phase):
+    # The restraints whose force constant or target changes over the windows
+    # of the phase. The static (dummy anchor) and wall restraints are the same
+    # in every window and do not contribute to dU/dlambda.
+    selected = []
+    for restraint in restraints:
+        schedule = restraint.phase.get(phase)
+        if schedule is None or schedule.get("force_constants") is None:
+            continue
+        force_constants = np.asarray(schedule["force_constants"], dtype=float)
+        targets = np.asarray(schedule["targets"], dtype=float)
+        if np.ptp(force_constants) > 0.0 or np.ptp(targets) > 0.0:
+            selected.append((restraint, force_constants, targets))
+    return selected
+
+
+def window_lambdas(selected):
+    # lambda runs from 0 to 1 over the windows of the phase, linear in the
+    # force constants (attach, release) or targets (pull)
+    _, force_constants, targets = selected[0]
+    values = force_constants if np.ptp(force_constants) > 0.0 else targets
+    return (values - values[0]) / (values[-1] - values[0])
+
+
+def restraint_gradients(trajectory, selected, window_index):
+    # dU/dlambda (kcal/mol) of every frame, for U = k (x - x0)^2 with k and
+    # x0 linear in lambda:
+    #   dU/dlambda = dk/dlambda (x - x0)^2 - 2 k (x - x0) dx0/dlambda
+    gradients = np.zeros(trajectory.n_frames)
+    for restraint, force_constants, targets in selected:
+        values = restraint_values(trajectory, restraint)
+        is_distance = restraint.index3 is None
+        if not is_distance:
+            targets = np.radians(targets)
+
+        difference = values - targets[window_index]
+        if restraint.index4 is not None:
+            # Dihedrals are periodic
+            difference = (difference + np.pi) % (2.0 * np.pi) - np.pi
+
+        gradients += (force_constants[-1] - force_constants[0]) * difference**2
+        gradients -= (
+            2.0
+            * force_constants[window_index]
+            * difference
+            * (targets[-1] - targets[0])
+        )
+    return gradients
+
+
+def trapezoid_weight(lambdas, window_index):
+    # The weight of a window in the trapezoidal integration over lambda
+    lower = lambdas[max(window_index - 1, 0)]
+    upper = lambdas[min(window_index + 1, len(lambdas) - 1)]
+    return abs(upper - lower) / 2.0
+
+
+@workflow_protocol()
+class AdaptivePaprikaOpenMMSimulation(PaprikaOpenMMSimulation):
+    # Runs the production of an APR window in chunks and stops once the
+    # autocorrelation corrected standard error of the restraint work of the
+    # window reaches the target, between a minimum and the original number of
+    # steps. The work of a window is its <dU/dlambda> times its weight in the
+    # thermodynamic integration, with dU/dlambda computed from the pAPRika
+    # restraints that change with lambda.
+
+    target_uncertainty = InputAttribute(
+        docstring="The standard error of the restraint work of the window to stop "
+        "at.",
+        type_hint=unit.Quantity,
+        default_value=UNDEFINED,
+    )
+    restraints_path = InputAttribute(
+        docstring="The pAPRika restraints the system was built with.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    phase = InputAttribute(
+        docstring="The APR phase of the window.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    window_index = InputAttribute(
+        docstring="The index of the window in its phase.",
+        type_hint=int,
+        default_value=UNDEFINED,
+    )
+    minimum_number_of_steps = InputAttribute(
+        docstring="The number of steps to run before checking for convergence.",
+        type_hint=int,
+        default_value=UNDEFINED,
+    )
+    chunk_number_of_steps = InputAttribute(
+        docstring="The number of steps between convergence checks.",
+        type_hint=int,
+        default_value=UNDEFINED,
+    )
+
+    gradient_uncertainty = OutputAttribute(
+        docstring="The standard error of the mean dU/dlambda.",
+        type_hint=unit.Quantity,
+    )
+    work_uncertainty = OutputAttribute(
+        docstring="The standard error of the restraint work of the window.",
+        type_hint=unit.Quantity,
+    )
+    steps_saved = OutputAttribute(
+        docstring="The steps saved compared to the fixed length production.",
+        type_hint=int,
+    )
+
+    def _execute(self, directory, available_resources):
+        # A rescheduled window continues from the checkpoint of its last chunk
+        check_checkpoint(self.id, directory)
+
+        # The fixed length production is the upper bound
+        maximum_steps = self.steps_per_iteration * self.total_number_of_iterations
+        chunk_steps = self.chunk_number_of_steps
+
+        # Each chunk is one iteration, and every chunk ends with a checkpoint so
+        # that the next one continues the same trajectory
+        self.steps_per_iteration = chunk_steps
+        self.checkpoint_frequency = 1
+        self.total_number_of_iterations = max(
+            1, int(np.ceil(self.minimum_number_of_steps / chunk_steps))
+        )
+
+        restraints = [
+            restraint
+            for restraint_list in ApplyRestraints.load_restraints(
+                self.restraints_path
+            ).values()
+            for restraint in restraint_list
+        ]
+        selected = lambda_restraints(restraints, self.phase)
+        weight = trapezoid_weight(window_lambdas(selected), self.window_index)
+
+        gradients = np.zeros(0)
+        target = self.target_uncertainty.m_as(unit.kilocalorie / unit.mole)
+
+        while True:
+            super()._execute(directory, available_resources)
+
+            # Only the frames of the new chunk are read
+            for trajectory in mdtraj.iterload(
+                self.trajectory_file_path,
+                top=self.input_coordinate_file,
+                skip=len(gradients),
+            ):
+                gradients = np.concatenate(
+                    [
+                        gradients,
+                        restraint_gradients(trajectory, selected, self.window_index),
+                    ]
+                )
+
+            statistics = analyze_time_series(gradients)
+            equilibrated = gradients[statistics.equilibration_index :]
+            uncertainty = np.std(equilibrated, ddof=1) * np.sqrt(
+                statistics.statistical_inefficiency / len(equilibrated)
+            )
+
+            steps = self.steps_per_iteration * self.total_number_of_iterations
+            if uncertainty * weight <= target or steps + chunk_steps > maximum_steps:
+                break
+            self.total_number_of_iterations += 1
+
+        self.gradient_uncertainty = uncertainty * unit.kilocalorie / unit.mole
+        self.work_uncertainty = uncertainty * weight * unit.kilocalorie / unit.mole
+        self.steps_saved = maximum_steps - steps
+        logger.info(
+            f"{self.id}: stopped after {steps} of {maximum_steps} steps "
+            f"({self.steps_saved} saved), dU/dlambda SEM {uncertainty:.4f} "
+            f"kcal/mol, restraint work SEM {uncertainty * weight:.4f} kcal/mol "
+            f"(target {target:.4f} kcal/mol)."
+        )
+
+
+def use_adaptive_production(
+    calculation_schema,
+    target_uncertainty,
+    minimum_fraction=0.2,
+    chunk_fraction=0.1,
+):
+    # Replace the fixed length production of every APR window in a schema from
+    # HostGuestBindingAffinity.default_paprika_schema. The end states have no
+    # dU/dlambda and keep their fixed length. The minimum and the chunk size
+    # are fractions of the original number of steps, which remains the
+    # maximum, rounded to the output frequency.
+    protocol_schemas = {
+        protocol_schema.id: protocol_schema
+        for protocol_schema in calculation_schema.workflow_schema.protocol_schemas
+    }
+    for protocol_schema in protocol_schemas.values():
+        if protocol_schema.type != "PaprikaOpenMMSimulation":
+            continue
+        if protocol_schema.id.split("_")[0] not in APR_PHASES:
+            continue
+
+        inputs = protocol_schema.inputs
+        steps = inputs[".steps_per_iteration"] * inputs[".total_number_of_iterations"]
+        output_frequency = inputs[".output_frequency"]
+
+        def round_steps(fraction):
+            frames = max(1, int(round(fraction * steps / output_frequency)))
+            return frames * output_frequency
+
+        protocol_schema.type = "AdaptivePaprikaOpenMMSimulation"
+        inputs[".target_uncertainty"] = target_uncertainty
+        inputs[".minimum_number_of_steps"] = round_steps(minimum_fraction)
+        inputs[".chunk_number_of_steps"] = round_steps(chunk_fraction)
+
+        # The restraints of the window, as the ApplyRestraints protocol that
+        # built its system reads them
+        apply_restraints = protocol_schemas[
+            inputs[".parameterized_system"].full_path.split(".")[0]
+        ]
+        for name in (".restraints_path", ".phase", ".window_index"):
+            inputs[name] = apply_restraints.inputs[name]
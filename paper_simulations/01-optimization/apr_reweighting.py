@@ -0,0 +1,573 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+import uuid
+from glob import glob
+
+import mdtraj
+import numpy as np
+import pymbar
+from openff.evaluator.attributes import UNDEFINED, Attribute
+from openff.evaluator.forcefield import (
+    ForceFieldSource,
+    ParameterGradient,
+    SmirnoffForceFieldSource,
+)
+from openff.evaluator.forcefield.system import ParameterizedSystem
+from openff.evaluator.layers import calculation_layer
+from openff.evaluator.layers.workflow import (
+    WorkflowCalculationLayer,
+    WorkflowCalculationSchema,
+)
+from openff.evaluator.substances import Substance
+from openff.evaluator.thermodynamics import ThermodynamicState
+from openff.evaluator.utils.observables import Observable
+from openff.evaluator.utils.openmm import setup_platform_with_resources
+from openff.evaluator.workflow import Protocol, Workflow, workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute, OutputAttribute
+from openff.evaluator.workflow.schemas import ProtocolReplicator, WorkflowSchema
+from openff.evaluator.workflow.utils import ProtocolPath, ReplicatorValue
+from openff.units import unit
+from scipy.special import logsumexp, softmax
+
+from gbsa_parameters import (
+    find_gbsa_force,
+    gbsa_atom_types,
+    gbsa_energies,
+    gbsa_radii,
+    get_particle_radii,
+    radii_from_types,
+    radius_derivatives,
+)
+
+try:
+    import openmm
+except ImportError:
+    from simtk import openmm
+
+logger = logging.getLogger(__name__)
+
+energy_unit = unit.kilojoule / unit.mole
+STATES = ["bound", "unbound"]
+
+
+def _reference_directory(index_directory, substance):
+    key = hashlib.sha1(substance.identifier.encode()).hexdigest()
+    return os.path.join(index_directory, key)
+
+
+def _orientation_name(orientation):
+    return os.path.basename(orientation["coordinate_path"])
+
+
+def _non_gbsa_hash(force_field):
+    # References can only be reweighted to force fields that differ from
+    # them in the GBSA parameters alone
+    force_field = copy.deepcopy(force_field)
+    force_field.deregister_parameter_handler("GBSA")
+    return hashlib.sha256(force_field.to_string().encode()).hexdigest()
+
+
+def _kT(thermodynamic_state):
+    return (unit.molar_gas_constant * thermodynamic_state.temperature).m_as(energy_unit)
+
+
+def load_references(index_directory, substance, orientation, force_field_hash):
+    # The stored APR calculations of one orientation, oldest first, whose
+    # trajectories still exist
+    records = []
+    pattern = os.path.join(
+        _reference_directory(index_directory, substance),
+        f"{_orientation_name(orientation)}-*.json",
+    )
+    for file_path in sorted(glob(pattern), key=os.path.getmtime):
+        with open(file_path) as file:
+            record = json.load(file)
+
+        if record["force_field_hash"] != force_field_hash:
+            continue
+        if not all(
+            os.path.isfile(record[state]["trajectory_path"]) for state in STATES
+        ):
+            continue
+        records.append(record)
+
+    return records
+
+
+@workflow_protocol()
+class StoreAPRReference(Protocol):
+    # Record the end state trajectories and free energy of one APR orientation
+    # so that later force fields can be reweighted from them
+
+    index_directory = InputAttribute(
+        docstring="The directory of the reference records.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    substance = InputAttribute(
+        docstring="The host-guest substance.",
+        type_hint=Substance,
+        default_value=UNDEFINED,
+    )
+    orientation = InputAttribute(
+        docstring="The guest orientation.",
+        type_hint=dict,
+        default_value=UNDEFINED,
+    )
+    orientation_free_energy = InputAttribute(
+        docstring="The binding free energy of the orientation.",
+        type_hint=Observable,
+        default_value=UNDEFINED,
+    )
+    parameterized_system = InputAttribute(
+        docstring="The host-guest system without restraints or dummy atoms.",
+        type_hint=ParameterizedSystem,
+        default_value=UNDEFINED,
+    )
+    bound_topology_path = InputAttribute(
+        docstring="The topology of the bound state trajectory.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    bound_trajectory_path = InputAttribute(
+        docstring="The bound state trajectory.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    unbound_topology_path = InputAttribute(
+        docstring="The topology of the unbound state trajectory.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    unbound_trajectory_path = InputAttribute(
+        docstring="The unbound state trajectory.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+
+    record_path = OutputAttribute(
+        docstring="The path to the stored record.", type_hint=str
+    )
+
+    def _execute(self, directory, available_resources):
+        force_field = self.parameterized_system.force_field.to_force_field()
+
+        record = {
+            "orientation": _orientation_name(self.orientation),
+            "free_energy": self.orientation_free_energy.value.m_as(energy_unit),
+            "free_energy_uncertainty": self.orientation_free_energy.error.m_as(
+                energy_unit
+            ),
+            "force_field_hash": _non_gbsa_hash(force_field),
+            "radii": gbsa_radii(force_field),
+            "atom_types": gbsa_atom_types(
+                force_field, self.parameterized_system.topology
+            ),
+            "system_path": os.path.abspath(self.parameterized_system.system_path),
+            "bound": {
+                "topology_path": os.path.abspath(self.bound_topology_path),
+                "trajectory_path": os.path.abspath(self.bound_trajectory_path),
+            },
+            "unbound": {
+                "topology_path": os.path.abspath(self.unbound_topology_path),
+                "trajectory_path": os.path.abspath(self.unbound_trajectory_path),
+            },
+        }
+
+        reference_directory = _reference_directory(self.index_directory, self.substance)
+        os.makedirs(reference_directory, exist_ok=True)
+
+        # One file per record, so concurrent workflows never write the same file
+        self.record_path = os.path.join(
+            reference_directory, f"{record['orientation']}-{uuid.uuid4().hex}.json"
+        )
+        with open(f"{self.record_path}.tmp", "w") as file:
+            json.dump(record, file)
+        os.replace(f"{self.record_path}.tmp", self.record_path)
+
+
+def mbar_to_target(reduced_potentials, n_samples):
+    # reduced_potentials has one row per reference plus the target as the last
+    # row. Returns f_target - f_reference for each reference and its
+    # uncertainty (in kT), the effective number of samples of the target and
+    # the target weights of all samples.
+    mbar = pymbar.MBAR(reduced_potentials, np.append(n_samples, 0))
+    results = mbar.getFreeEnergyDifferences(return_dict=True)
+    return (
+        results["Delta_f"][:-1, -1],
+        results["dDelta_f"][:-1, -1],
+        mbar.computeEffectiveSampleNumber()[-1],
+        mbar.W_nk[:, -1],
+    )
+
+
+@workflow_protocol()
+class ReweightAPRFreeEnergy(Protocol):
+    # Estimate the binding free energy of one orientation with new GBSA radii
+    # from stored APR calculations. Only the GBSA energies differ between the
+    # force fields, so
+    #   dG(new) = dG(ref) + [F(new) - F(ref)]_bound - [F(new) - F(ref)]_unbound
+    # with the end state free energy differences from MBAR over the end state
+    # trajectories of all references.
+
+    references = InputAttribute(
+        docstring="The reference records of this orientation, oldest first.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+    gbsa_radii = InputAttribute(
+        docstring="The GBSA radii (nm) of the target force field by SMIRKS.",
+        type_hint=dict,
+        default_value=UNDEFINED,
+    )
+    thermodynamic_state = InputAttribute(
+        docstring="The state at which the references were simulated.",
+        type_hint=ThermodynamicState,
+        default_value=UNDEFINED,
+    )
+    gradient_parameters = InputAttribute(
+        docstring="The GBSA radii to compute the free energy gradients of.",
+        type_hint=list,
+        default_value=[],
+    )
+    perturbation = InputAttribute(
+        docstring="The finite difference step of the radii (nm).",
+        type_hint=float,
+        default_value=1.0e-4,
+    )
+    analytic_derivatives = InputAttribute(
+        docstring="Differentiate OBC energies analytically instead of by finite "
+        "differences.",
+        type_hint=bool,
+        default_value=True,
+    )
+
+    result = OutputAttribute(
+        docstring="The reweighted binding free energy.", type_hint=Observable
+    )
+    effective_samples = OutputAttribute(
+        docstring="The smallest number of effective samples of the end states.",
+        type_hint=float,
+    )
+
+    def _reweight_state(self, state, platform, kT):
+        # Only the GBSA force is evaluated, the rest of the potential is the
+        # same for all parameter sets and cancels in MBAR
+        latest = self.references[-1]
+        with open(latest["system_path"]) as file:
+            system = openmm.XmlSerializer.deserialize(file.read())
+        for force in system.getForces():
+            force.setForceGroup(0)
+        force = find_gbsa_force(system)
+        force.setForceGroup(1)
+
+        context = openmm.Context(system, openmm.VerletIntegrator(0.001), platform)
+        atom_types = latest["atom_types"]
+        default_radii, _ = get_particle_radii(force)
+
+        # The dummy atoms are appended after the host-guest particles
+        positions, n_samples = [], []
+        for reference in self.references:
+            trajectory = mdtraj.load(
+                reference[state]["trajectory_path"],
+                top=reference[state]["topology_path"],
+            )
+            positions.append(trajectory.xyz[:, : system.getNumParticles()])
+            n_samples.append(trajectory.n_frames)
+        positions = np.concatenate(positions)
+
+        parameter_sets = [reference["radii"] for reference in self.references]
+        parameter_sets.append(self.gbsa_radii)
+        reduced_potentials = np.array(
+            [
+                gbsa_energies(
+                    context,
+                    force,
+                    radii_from_types(atom_types, radii, default_radii),
+                    positions,
+                )
+                / kT
+                for radii in parameter_sets
+            ]
+        )
+        delta_f, delta_f_error, effective_samples, weights = mbar_to_target(
+            reduced_potentials, np.array(n_samples)
+        )
+
+        # <dU/dradius> in the target state
+        derivatives = radius_derivatives(
+            context,
+            force,
+            atom_types,
+            self.gbsa_radii,
+            positions,
+            [key.smirks for key in self.gradient_parameters],
+            self.perturbation,
+            self.analytic_derivatives,
+        )
+        gradients = {
+            key: np.sum(weights * derivative)
+            for key, derivative in zip(self.gradient_parameters, derivatives)
+        }
+
+        return delta_f * kT, delta_f_error * kT, effective_samples, gradients
+
+    def _execute(self, directory, available_resources):
+        for key in self.gradient_parameters:
+            if key.tag != "GBSA" or key.attribute != "radius":
+                raise ValueError(f"Only GBSA radii can be reweighted, not {key}.")
+
+        platform = setup_platform_with_resources(available_resources)
+        kT = _kT(self.thermodynamic_state)
+
+        results = {state: self._reweight_state(state, platform, kT) for state in STATES}
+
+        # One estimate per reference. The end state differences all come from
+        # the same MBAR fit and are correlated, so only the reference closest
+        # to the target (the smallest uncertainty) is used.
+        values = np.array([reference["free_energy"] for reference in self.references])
+        variances = (
+            np.array(
+                [reference["free_energy_uncertainty"] for reference in self.references]
+            )
+            ** 2
+        )
+        values += results["bound"][0] - results["unbound"][0]
+        variances += results["bound"][1] ** 2 + results["unbound"][1] ** 2
+
+        closest = int(np.argmin(variances))
+        value = values[closest]
+        error = np.sqrt(variances[closest])
+
+        # dG_b = F_bound - F_unbound
+        self.result = Observable(
+            value=(value * energy_unit).plus_minus(error * energy_unit),
+            gradients=[
+                ParameterGradient(
+                    key=key,
+                    value=(results["bound"][3][key] - results["unbound"][3][key])
+                    * energy_unit
+                    / unit.nanometer,
+                )
+                for key in self.gradient_parameters
+            ],
+        )
+        self.effective_samples = float(min(results[state][2] for state in STATES))
+
+
+@workflow_protocol()
+class CombineReweightedFreeEnergies(Protocol):
+    # Boltzmann weighted combination of the orientations, which is left
+    # undefined when any orientation has too few effective samples so that the
+    # property is passed on to the next calculation layer
+
+    values = InputAttribute(
+        docstring="The reweighted free energy of each orientation.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+    effective_samples = InputAttribute(
+        docstring="The effective number of samples of each orientation.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+    degeneracies = InputAttribute(
+        docstring="The number of equivalent orientations each value stands for, "
+        "see orientation_symmetry.py.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+    minimum_effective_samples = InputAttribute(
+        docstring="The fewest effective samples an orientation may have.",
+        type_hint=int,
+        default_value=50,
+    )
+    thermodynamic_state = InputAttribute(
+        docstring="The state at which the free energies were computed.",
+        type_hint=ThermodynamicState,
+        default_value=UNDEFINED,
+    )
+
+    result = OutputAttribute(
+        docstring="The binding free energy over all orientations.",
+        type_hint=Observable,
+    )
+
+    def _execute(self, directory, available_resources):
+        if min(self.effective_samples) < self.minimum_effective_samples:
+            logger.info(
+                f"Only {min(self.effective_samples):.1f} effective samples (minimum "
+                f"{self.minimum_effective_samples}), the free energy will be simulated."
+            )
+            self.result = UNDEFINED
+            return
+
+        kT = _kT(self.thermodynamic_state)
+        values = np.array([value.value.m_as(energy_unit) for value in self.values])
+        errors = np.array([value.error.m_as(energy_unit) for value in self.values])
+        if self.degeneracies != UNDEFINED:
+            values = values - kT * np.log(self.degeneracies)
+
+        probabilities = softmax(-values / kT)
+        value = -kT * logsumexp(-values / kT)
+        error = np.sqrt(np.sum((probabilities * errors) ** 2))
+
+        gradients = []
+        for gradient in self.values[0].gradients:
+            gradients.append(
+                ParameterGradient(
+                    key=gradient.key,
+                    value=sum(
+                        probability
+                        * next(
+                            other.value
+                            for other in orientation.gradients
+                            if other.key == gradient.key
+                        )
+                        for probability, orientation in zip(probabilities, self.values)
+                    ),
+                )
+            )
+
+        self.result = Observable(
+            value=(value * energy_unit).plus_minus(error * energy_unit),
+            gradients=gradients,
+        )
+
+
+class APRReweightingSchema(WorkflowCalculationSchema):
+    index_directory = Attribute(
+        docstring="The directory of the stored APR references.",
+        type_hint=str,
+        default_value="apr_references",
+    )
+    maximum_references = Attribute(
+        docstring="The number of most recent references to reweight from.",
+        type_hint=int,
+        default_value=3,
+    )
+
+
+@calculation_layer()
+class APRReweightingLayer(WorkflowCalculationLayer):
+    # Estimates host-guest binding free energies by reweighting the APR
+    # calculations of earlier force fields. Properties without suitable
+    # references, or whose references have too few effective samples, are
+    # left to the next layer (normally the SimulationLayer).
+
+    @classmethod
+    def required_schema_type(cls):
+        return APRReweightingSchema
+
+    @classmethod
+    def _get_workflow_metadata(
+        cls,
+        working_directory,
+        physical_property,
+        force_field_path,
+        parameter_gradient_keys,
+        storage_backend,
+        calculation_schema,
+    ):
+        force_field_source = ForceFieldSource.from_json(force_field_path)
+        if not isinstance(force_field_source, SmirnoffForceFieldSource):
+            return None
+        if any(
+            key.tag != "GBSA" or key.attribute != "radius"
+            for key in parameter_gradient_keys
+        ):
+            return None
+
+        force_field = force_field_source.to_force_field()
+        force_field_hash = _non_gbsa_hash(force_field)
+
+        references = []
+        for orientation in physical_property.metadata["guest_orientations"]:
+            records = load_references(
+                calculation_schema.index_directory,
+                physical_property.substance,
+                orientation,
+                force_field_hash,
+            )
+            if len(records) == 0:
+                return None
+            references.append(records[-calculation_schema.maximum_references :])
+
+        global_metadata = Workflow.generate_default_metadata(
+            physical_property, force_field_path, parameter_gradient_keys
+        )
+        global_metadata["apr_references"] = references
+        global_metadata["gbsa_radii"] = gbsa_radii(force_field)
+        return global_metadata
+
+
+def add_reference_storage(simulation_schema, index_directory="apr_references"):
+    # Store the end states of every APR calculation of the simulation layer
+    store_reference = StoreAPRReference("store_reference_$(orientation_replicator)")
+    store_reference.index_directory = os.path.abspath(index_directory)
+    store_reference.substance = ProtocolPath("substance", "global")
+    store_reference.orientation = ReplicatorValue("orientation_replicator")
+    store_reference.orientation_free_energy = ProtocolPath(
+        "result", "orientation_free_energy_$(orientation_replicator)"
+    )
+    store_reference.parameterized_system = ProtocolPath(
+        "parameterized_system", "state_bound_apply_parameters_$(orientation_replicator)"
+    )
+    for state in STATES:
+        setattr(
+            store_reference,
+            f"{state}_topology_path",
+            ProtocolPath(
+                "output_coordinate_path",
+                f"state_{state}_add_dummy_atoms_0_$(orientation_replicator)",
+            ),
+        )
+        setattr(
+            store_reference,
+            f"{state}_trajectory_path",
+            ProtocolPath(
+                "trajectory_file_path",
+                f"state_{state}_production_0_$(orientation_replicator)",
+            ),
+        )
+
+    simulation_schema.workflow_schema.protocol_schemas.append(store_reference.schema)
+
+
+def default_reweighting_schema(
+    index_directory="apr_references",
+    minimum_effective_samples=50,
+    maximum_references=3,
+):
+    orientation_replicator = ProtocolReplicator("orientation_replicator")
+    orientation_replicator.template_values = ProtocolPath(
+        "guest_orientations", "global"
+    )
+
+    reweight = ReweightAPRFreeEnergy("reweight_free_energy_$(orientation_replicator)")
+    reweight.references = ProtocolPath(
+        "apr_references[$(orientation_replicator)]", "global"
+    )
+    reweight.gbsa_radii = ProtocolPath("gbsa_radii", "global")
+    reweight.thermodynamic_state = ProtocolPath("thermodynamic_state", "global")
+    reweight.gradient_parameters = ProtocolPath("parameter_gradient_keys", "global")
+
+    combine = CombineReweightedFreeEnergies("reweighted_free_energy")
+    combine.values = ProtocolPath("result", reweight.id)
+    combine.effective_samples = ProtocolPath("effective_samples", reweight.id)
+    combine.minimum_effective_samples = minimum_effective_samples
+    combine.thermodynamic_state = ProtocolPath("thermodynamic_state", "global")
+
+    workflow_schema = WorkflowSchema()
+    workflow_schema.protocol_schemas = [reweight.schema, combine.schema]
+    workflow_schema.protocol_replicators = [orientation_replicator]
+    workflow_schema.final_value_source = ProtocolPath("result", combine.id)
+
+    calculation_schema = APRReweightingSchema()
+    calculation_schema.workflow_schema = workflow_schema
+    calculation_schema.index_directory = os.path.abspath(index_directory)
+    calculation_schema.maximum_references = maximum_references
+    return calculation_schema
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+
+import numpy as np
+from openff.evaluator.protocols.openmm import OpenMMSimulation
+from openff.evaluator.protocols.paprika.openmm import PaprikaOpenMMSimulation
+from openff.evaluator.workflow import workflow_protocol
+from openff.units import unit
+
+try:
+    import openmm
+except ImportError:
+    from simtk import openmm
+
+logger = logging.getLogger(__name__)
+
+# Written by OpenMMSimulation every checkpoint_frequency frames, the state is
+# serialized to XML so it can be loaded on any platform and GPU model
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_STATE_FILE = "checkpoint_state.xml"
+
+# The simulations of a schema from HostGuestBindingAffinity.default_paprika_schema
+RESUMABLE_TYPES = {
+    "OpenMMSimulation": "ResumableOpenMMSimulation",
+    "PaprikaOpenMMSimulation": "ResumablePaprikaOpenMMSimulation",
+}
+
+
+def read_checkpoint(directory):
+    # The step of the checkpoint in a protocol directory, 0 without one and
+    # None if it cannot be read (e.g. the worker was killed while writing it)
+    checkpoint_path = os.path.join(directory, CHECKPOINT_FILE)
+    state_path = os.path.join(directory, CHECKPOINT_STATE_FILE)
+    if not os.path.isfile(checkpoint_path) or not os.path.isfile(state_path):
+        return 0
+
+    try:
+        with open(checkpoint_path) as file:
+            current_step = json.load(file)["current_step_number"]
+        with open(state_path) as file:
+            openmm.XmlSerializer.deserialize(file.read())
+    except Exception:
+        return None
+
+    return current_step
+
+
+def check_checkpoint(protocol_id, directory):
+    # Unreadable checkpoints are removed, otherwise every retry of the task
+    # would fail and use up its allowed failures
+    current_step = read_checkpoint(directory)
+
+    if current_step is None:
+        logger.warning(f"{protocol_id}: removing the unreadable checkpoint.")
+        for file_name in (CHECKPOINT_FILE, CHECKPOINT_STATE_FILE):
+            if os.path.isfile(os.path.join(directory, file_name)):
+                os.remove(os.path.join(directory, file_name))
+    elif current_step > 0:
+        logger.info(f"{protocol_id}: resuming from step {current_step}.")
+
+
+class ResumableMixin:
+    # Protocol directories live in the shared working directory of the
+    # server, so a protocol rescheduled by Dask on any worker (after a
+    # walltime kill or preemption) continues from its last checkpoint
+
+    def _execute(self, directory, available_resources):
+        check_checkpoint(self.id, directory)
+        super()._execute(directory, available_resources)
+
+
+@workflow_protocol()
+class ResumableOpenMMSimulation(ResumableMixin, OpenMMSimulation):
+    pass
+
+
+@workflow_protocol()
+class ResumablePaprikaOpenMMSimulation(ResumableMixin, PaprikaOpenMMSimulation):
+    pass
+
+
+def use_checkpointing(calculation_schema, checkpoint_interval=100 * unit.picosecond):
+    # Checkpoint every simulation of a schema at least once per interval of
+    # simulated time, which bounds the work lost when a worker dies
+    for protocol_schema in calculation_schema.workflow_schema.protocol_schemas:
+        if protocol_schema.type not in RESUMABLE_TYPES:
+            continue
+
+        inputs = protocol_schema.inputs
+        steps = (checkpoint_interval / inputs[".timestep"]).m_as(unit.dimensionless)
+        frames = int(np.floor(steps / inputs[".output_frequency"]))
+
+        protocol_schema.type = RESUMABLE_TYPES[protocol_schema.type]
+        inputs[".checkpoint_frequency"] = max(1, frames)
@@ -0,0 +1,108 @@
+import logging
+
+import mdtraj
+import numpy as np
+from openff.evaluator.forcefield import ParameterGradient
+from openff.evaluator.protocols.paprika.analysis import ComputePotentialEnergyGradient
+from openff.evaluator.utils.openmm import setup_platform_with_resources
+from openff.evaluator.workflow import workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute
+from openff.units import unit
+
+from gbsa_parameters import (
+    find_gbsa_force,
+    gbsa_atom_types,
+    gbsa_radii,
+    radius_derivatives,
+)
+
+try:
+    import openmm
+except ImportError:
+    from simtk import openmm
+
+logger = logging.getLogger(__name__)
+
+energy_unit = unit.kilojoule / unit.mole
+
+
+@workflow_protocol()
+class BatchedPotentialEnergyGradient(ComputePotentialEnergyGradient):
+    # <dU/dradius> of an end state trajectory for tagged GBSA radii. Instead
+    # of building a new System and Context for every perturbed force field,
+    # one Context is created and only the GBSA per-particle radii are updated
+    # in it, so the cost scales with frames x parameters. OBC radii are
+    # differentiated analytically in a single pass over the frames. Other
+    # parameters fall back to the original implementation.
+
+    perturbation = InputAttribute(
+        docstring="The finite difference step of the radii (nm).",
+        type_hint=float,
+        default_value=1.0e-4,
+    )
+    analytic_derivatives = InputAttribute(
+        docstring="Differentiate OBC energies analytically instead of by finite "
+        "differences.",
+        type_hint=bool,
+        default_value=True,
+    )
+
+    def _execute(self, directory, available_resources):
+        if any(
+            key.tag != "GBSA" or key.attribute != "radius"
+            for key in self.gradient_parameters
+        ):
+            return super()._execute(directory, available_resources)
+
+        force_field = self.input_system.force_field.to_force_field()
+        system = self.input_system.system
+        for force in system.getForces():
+            force.setForceGroup(0)
+        force = find_gbsa_force(system)
+        force.setForceGroup(1)
+
+        context = openmm.Context(
+            system,
+            openmm.VerletIntegrator(0.001),
+            setup_platform_with_resources(available_resources),
+        )
+
+        # The dummy atoms are appended after the host-guest particles
+        trajectory = mdtraj.load(self.trajectory_path, top=self.topology_path)
+        positions = trajectory.xyz[:, : system.getNumParticles()]
+
+        derivatives = radius_derivatives(
+            context,
+            force,
+            gbsa_atom_types(force_field, self.input_system.topology),
+            gbsa_radii(force_field),
+            positions,
+            [key.smirks for key in self.gradient_parameters],
+            self.perturbation,
+            self.analytic_derivatives,
+        )
+        logger.info(
+            f"{self.id}: {len(self.gradient_parameters)} gradients from "
+            f"{len(positions)} frames with one Context."
+        )
+
+        self.potential_energy_gradients = [
+            ParameterGradient(
+                key=key, value=np.mean(derivative) * energy_unit / unit.nanometer
+            )
+            for key, derivative in zip(self.gradient_parameters, derivatives)
+        ]
+
+
+def use_batched_gradients(
+    calculation_schema, perturbation=1.0e-4, analytic_derivatives=True
+):
+    # Replace the end state gradient protocols of a schema from
+    # HostGuestBindingAffinity.default_paprika_schema
+    for protocol_schema in calculation_schema.workflow_schema.protocol_schemas:
+        if protocol_schema.type != "ComputePotentialEnergyGradient":
+            continue
+
+        protocol_schema.type = "BatchedPotentialEnergyGradient"
+        protocol_schema.inputs[".perturbation"] = perturbation
+        protocol_schema.inputs[".analytic_derivatives"] = analytic_derivatives
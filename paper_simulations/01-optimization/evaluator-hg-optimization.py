@@ -1,26 +1,42 @@
+import contextlib
+import json
 import os
 import subprocess as sp
 import sys
 
 from forcebalance.evaluator_io import Evaluator_SMIRNOFF
 from openff.evaluator.backends import QueueWorkerResources
-from openff.evaluator.backends.dask import DaskSLURMBackend
 from openff.evaluator.client import ConnectionOptions, RequestOptions
 from openff.evaluator.datasets.taproom import TaproomDataSet
 from openff.evaluator.properties import HostGuestBindingAffinity
 from openff.evaluator.protocols.paprika.openmm import APRSimulationSteps
-from openff.evaluator.server import EvaluatorServer
 from openff.evaluator.utils import setup_timestamp_logging
 from openff.toolkit.typing.engines.smirnoff import ForceField
 from openff.units import unit
 from pkg_resources import resource_filename
 
+from apr_production import use_adaptive_production
+from apr_reweighting import add_reference_storage, default_reweighting_schema
+from checkpointing import use_checkpointing
+from energy_gradients import use_batched_gradients
+from fidelity import FidelitySchedule
+from force_field_storage import DeltaForceFieldStorage
+from host_sharing import share_host_protocols
+from orientation_symmetry import prune_orientations, use_orientation_degeneracy
+from parameter_relevance import add_result_cache, annotate_relevance
+from scheduling import PrioritizedDaskSLURMBackend
+from speculation import SpeculativeEvaluatorServer
+from validation import ValidationMonitor, validation_options
+from window_cache import use_window_cache
+
 os.environ["OE_LICENSE"] = "/gpfs/jsetiadi/oe_license.txt"
 
 
 def main():
     setup_timestamp_logging()
     server_port = 3241
+    # Estimate the test set with every n-th iteration, None to disable
+    validation_interval = 5
 
     os.makedirs("forcefield", exist_ok=True)
     os.makedirs("targets/host_guest_data", exist_ok=True)
@@ -43,19 +59,35 @@ def main():
     force_field.to_file("forcefield/openff-2.0.0-GBSA_OBC2-tagged.offxml")
 
     # Load in data from FreeSolv
+    training_codes = {
+        "acd": ["coc", "chp", "hep", "hx2", "ham", "pam"],
+        "bcd": ["coc", "cbu", "mo3", "mp4", "rim", "oam"],
+        "cb7": ["hxm", "c8m", "haz", "hpm", "cha", "chm"],
+        "cb8": ["amm", "con", "mpa", "qui", "thp", "mth"],
+        "oah": ["ben", "c3b", "c7c", "c4b", "trz", "hxa"],
+        "oam": ["hxa", "trz", "nbn", "hxy", "bra", "m4p"],
+    }
     host_guest_data_set = TaproomDataSet(
-        host_guest_codes={
-            "acd": ["coc", "chp", "hep", "hx2", "ham", "pam"],
-            "bcd": ["coc", "cbu", "mo3", "mp4", "rim", "oam"],
-            "cb7": ["hxm", "c8m", "haz", "hpm", "cha", "chm"],
-            "cb8": ["amm", "con", "mpa", "qui", "thp", "mth"],
-            "oah": ["ben", "c3b", "c7c", "c4b", "trz", "hxa"],
-            "oam": ["hxa", "trz", "nbn", "hxy", "bra", "m4p"],
-        },
+        host_guest_codes=training_codes,
         in_vacuum=True,
     )
+    # Record which tagged parameters type each host and guest, so that systems
+    # are only recomputed when one of their own parameters changes
+    relevance_index = annotate_relevance(host_guest_data_set, force_field)
+    with open("targets/host_guest_data/parameter_relevance.json", "w") as file:
+        json.dump(relevance_index, file, indent=2)
+    # Simulate only one of two orientations that are equivalent by the
+    # symmetry of the guest
+    degeneracies = prune_orientations(host_guest_data_set)
+    with open("targets/host_guest_data/orientation_degeneracies.json", "w") as file:
+        json.dump(degeneracies, file, indent=2)
     host_guest_data_set.json("targets/host_guest_data/training_set.json")
 
+    # The held-out systems of the benchmark, see 02-benchmark/evaluator-hg.py
+    test_data_set = TaproomDataSet(exclude_systems=training_codes, in_vacuum=True)
+    prune_orientations(test_data_set)
+    test_data_set.json("test_set.json")
+
     # Set up the calculation
     APR_settings = APRSimulationSteps(
         n_thermalization_steps=50000,
@@ -81,11 +113,73 @@ def main():
         use_implicit_solvent=True,
         enable_hmr=True,
     )
+    # Stop the production of each window once its restraint work converged
+    use_adaptive_production(
+        host_guest_schema,
+        target_uncertainty=0.1 * unit.kilocalorie / unit.mole,
+        minimum_fraction=0.2,
+        chunk_fraction=0.1,
+    )
+    # Let protocols rescheduled after a walltime kill continue from the last
+    # checkpoint in the shared working directory
+    use_checkpointing(host_guest_schema, checkpoint_interval=100 * unit.picosecond)
+    # Reuse the windows whose parameters did not change, e.g. after a rejected
+    # step or when a killed job is resumed
+    use_window_cache(
+        host_guest_schema,
+        cache_directory=os.path.abspath("window_cache"),
+        maximum_cache_size=200 * unit.gigabyte,
+    )
+    # Run the release phase, which only contains the host, once for all
+    # guests of a host in a batch
+    share_host_protocols(host_guest_schema)
+    # Count each simulated orientation as often as the pruned equivalent ones
+    use_orientation_degeneracy(host_guest_schema)
+    # Compute the radius gradients of all frames in one OpenMM Context
+    use_batched_gradients(host_guest_schema)
+    # Keep the end states of every APR calculation to reweight later iterations
+    add_reference_storage(host_guest_schema, "apr_references")
+    reweighting_schema = default_reweighting_schema(
+        "apr_references", minimum_effective_samples=50
+    )
+    use_orientation_degeneracy(reweighting_schema)
+    cache_schema = add_result_cache(host_guest_schema, "relevance_cache")
+
+    # The test set is estimated with the settings of the benchmark
+    validation_schema = HostGuestBindingAffinity.default_paprika_schema(
+        simulation_settings=APR_settings,
+        use_implicit_solvent=True,
+        enable_hmr=True,
+    )
+    use_adaptive_production(
+        validation_schema,
+        target_uncertainty=0.1 * unit.kilocalorie / unit.mole,
+        minimum_fraction=0.2,
+        chunk_fraction=0.1,
+    )
+    use_checkpointing(validation_schema, checkpoint_interval=100 * unit.picosecond)
+    use_window_cache(
+        validation_schema,
+        cache_directory=os.path.abspath("window_cache"),
+        maximum_cache_size=200 * unit.gigabyte,
+    )
+    share_host_protocols(validation_schema)
+    use_orientation_degeneracy(validation_schema)
 
     estimation_options = RequestOptions()
-    estimation_options.calculation_layers = ["SimulationLayer"]
+    estimation_options.calculation_layers = [
+        "RelevanceCacheLayer",
+        "APRReweightingLayer",
+        "RelevantSimulationLayer",
+    ]
     estimation_options.add_schema(
-        "SimulationLayer", "HostGuestBindingAffinity", host_guest_schema
+        "RelevanceCacheLayer", "HostGuestBindingAffinity", cache_schema
+    )
+    estimation_options.add_schema(
+        "APRReweightingLayer", "HostGuestBindingAffinity", reweighting_schema
+    )
+    estimation_options.add_schema(
+        "RelevantSimulationLayer", "HostGuestBindingAffinity", host_guest_schema
     )
 
     # Create the ForceBalance options object
@@ -127,6 +221,9 @@ def main():
         "export OE_LICENSE=/gpfs/jsetiadi/oe_license.txt",
         "# Change directory to working folder",
         f"cd {sys.argv[1]}",
+        "# Register the APR protocols of this folder on the workers",
+        f"export PYTHONPATH={sys.argv[1]}:${{PYTHONPATH}}",
+        'export DASK_DISTRIBUTED__WORKER__PRELOAD=\'["checkpointing", "apr_production", "apr_reweighting", "parameter_relevance", "window_cache", "energy_gradients", "orientation_symmetry"]\'',
         "# Create temporary directory for DASK memory spill",
         "SCRATCH=/scratch/${USER}/job_${SLURM_JOB_ID}",
         "mkdir -p ${SCRATCH}/jsetiadi/working_directory",
@@ -139,8 +236,10 @@ def main():
         'echo "List of vnodes: ${SLURM_JOB_NODELIST}"',
     ]
 
-    # Create Pool of Dask Workers
-    calculation_backend = DaskSLURMBackend(
+    # Create Pool of Dask Workers, the longest protocols are started first
+    calculation_backend = PrioritizedDaskSLURMBackend(
+        data_set_paths=["targets/host_guest_data/training_set.json", "test_set.json"],
+        database_path="telemetry.sqlite",
         minimum_number_of_workers=1,
         maximum_number_of_workers=28,
         resources_per_worker=QueueWorkerResources(
@@ -158,12 +257,35 @@ def main():
 
     # Start the Evaluator Server
     with calculation_backend:
-        evaluator_server = EvaluatorServer(
+        # Early iterations run shorter simulations over fewer windows, the
+        # fidelity rises as the gradient and steps of ForceBalance shrink.
+        # Idle workers estimate the points ForceBalance may request next.
+        evaluator_server = SpeculativeEvaluatorServer(
+            fidelity_schedule=FidelitySchedule(
+                optimize_directory="optimize.tmp/host_guest_data",
+                history_path="fidelity_history.json",
+            ),
+            input_file="optimize.in",
+            target_name="host_guest_data",
+            speculation_directory="speculation",
             calculation_backend=calculation_backend,
+            storage_backend=DeltaForceFieldStorage("stored_data"),
             port=server_port,
             delete_working_files=False,
         )
-        with evaluator_server:
+        # Workers left idle by the optimization estimate the test set
+        validation = contextlib.nullcontext()
+        if validation_interval is not None:
+            validation = ValidationMonitor(
+                test_set=test_data_set,
+                request_options=validation_options(validation_schema),
+                force_field_name="openff-2.0.0-GBSA_OBC2-tagged.offxml",
+                optimize_directory="optimize.tmp/host_guest_data",
+                table_path="validation.csv",
+                connection_options=ConnectionOptions(server_port=server_port),
+                interval=validation_interval,
+            )
+        with evaluator_server, validation:
             # Run ForceBalance
             force_balance_arguments = ["ForceBalance.py", "optimize.in"]
             with open("force_balance.log", "w") as file:
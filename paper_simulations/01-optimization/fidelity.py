@@ -0,0 +1,481 @@
+import copy
+import json
+import logging
+import os
+import sys
+import time
+from glob import glob
+
+import numpy as np
+from forcebalance.nifty import lp_load
+from openff.evaluator.server import EvaluatorServer
+
+from scheduling import VALIDATION_PRIORITY
+
+logger = logging.getLogger(__name__)
+
+# The simulation length of each level as a fraction of the original steps of
+# the APR windows and of the end states, and the stride through the attach,
+# pull and release windows. A level is used while the gradient norm and the
+# last step of ForceBalance are both at least its thresholds, the last level
+# is the original (full) calculation. The thresholds sit above the
+# convergence criteria of optimize.in (0.1), so the iterations which converge
+# are run at full fidelity.
+DEFAULT_LEVELS = [
+    {
+        "name": "low",
+        "production": 0.25,
+        "end_states": 0.2,
+        "window_stride": 2,
+        "gradient_norm": 1.0,
+        "step_size": 0.2,
+    },
+    {
+        "name": "medium",
+        "production": 0.5,
+        "end_states": 0.5,
+        "window_stride": 1,
+        "gradient_norm": 0.3,
+        "step_size": 0.15,
+    },
+    {
+        "name": "full",
+        "production": 1.0,
+        "end_states": 1.0,
+        "window_stride": 1,
+        "gradient_norm": 0.0,
+        "step_size": 0.0,
+    },
+]
+
+# The protocols whose results are stored between requests, see
+# parameter_relevance.py and apr_reweighting.py
+STORE_TYPES = {
+    "StoreRelevantResult": ".cache_directory",
+    "StoreAPRReference": ".index_directory",
+}
+
+
+def _round_steps(steps, output_frequency):
+    return max(1, int(round(steps / output_frequency))) * output_frequency
+
+
+def _scale_production(workflow_schema, level):
+    # Shorten the production of the APR windows and end states. The minimum
+    # and chunk of the adaptive production are scaled with the maximum.
+    for protocol_schema in workflow_schema.protocol_schemas:
+        inputs = protocol_schema.inputs
+        if "_production_" not in protocol_schema.id:
+            continue
+        if not isinstance(inputs.get(".steps_per_iteration"), int):
+            continue
+
+        fraction = level[
+            "end_states" if protocol_schema.id.startswith("state_") else "production"
+        ]
+        for name in [
+            ".steps_per_iteration",
+            ".minimum_number_of_steps",
+            ".chunk_number_of_steps",
+        ]:
+            if isinstance(inputs.get(name), int):
+                inputs[name] = _round_steps(
+                    inputs[name] * fraction, inputs[".output_frequency"]
+                )
+
+
+def is_full(level):
+    return (
+        level["production"] == 1.0
+        and level["end_states"] == 1.0
+        and level["window_stride"] == 1
+    )
+
+
+def _level_directory(directory, level):
+    # Results of a lower fidelity are kept apart from the full ones
+    return f"{directory.rstrip(os.sep)}_{level['name']}"
+
+
+def apply_fidelity(request_options, level):
+    # A copy of the request options with the simulations of the level, and
+    # with the relevance cache and APR references of the level
+    request_options = copy.deepcopy(request_options)
+    if is_full(level):
+        return request_options
+
+    for schemas in request_options.calculation_schemas.values():
+        for schema in schemas.values():
+            for name in ["cache_directory", "index_directory"]:
+                if isinstance(getattr(schema, name, None), str):
+                    setattr(
+                        schema, name, _level_directory(getattr(schema, name), level)
+                    )
+
+            workflow_schema = getattr(schema, "workflow_schema", None)
+            if workflow_schema is None:
+                continue
+            _scale_production(workflow_schema, level)
+            for protocol_schema in workflow_schema.protocol_schemas:
+                name = STORE_TYPES.get(protocol_schema.type)
+                if name is not None:
+                    protocol_schema.inputs[name] = _level_directory(
+                        protocol_schema.inputs[name], level
+                    )
+
+    return request_options
+
+
+def _trapezoid_weights(lambdas):
+    # The lambda_scaling of the taproom metadata, half the lambda interval
+    # around each window
+    differences = np.abs(np.diff(lambdas)) / 2.0
+    return np.concatenate(
+        [differences[:1], differences[:-1] + differences[1:], differences[-1:]]
+    )
+
+
+def _strided(n_windows, stride):
+    # Every stride-th window, always including the last one
+    indices = list(range(0, n_windows, stride))
+    if indices[-1] != n_windows - 1:
+        indices.append(n_windows - 1)
+    return indices
+
+
+def coarsen_windows(metadata, stride):
+    # The APR window metadata of a taproom property with every stride-th
+    # attach and release lambda and with evenly spaced pull windows over the
+    # same distance. The bound and unbound states stay the first and last
+    # windows.
+    if stride <= 1 or "attach_lambdas" not in metadata:
+        return metadata
+
+    metadata = copy.deepcopy(metadata)
+    lambda_scaling = dict(metadata["lambda_scaling"])
+
+    for phase in ["attach", "release"]:
+        lambdas = metadata[f"{phase}_lambdas"]
+        lambdas = [lambdas[index] for index in _strided(len(lambdas), stride)]
+        metadata[f"{phase}_lambdas"] = lambdas
+        metadata[f"{phase}_windows_indices"] = list(range(len(lambdas)))
+        lambda_scaling[phase] = _trapezoid_weights(lambdas)
+
+    n_pull_windows = int(np.ceil((metadata["n_pull_windows"] - 1) / stride)) + 1
+    metadata["n_pull_windows"] = n_pull_windows
+    metadata["pull_windows_indices"] = list(range(n_pull_windows))
+    metadata["unbound_window_index"] = [n_pull_windows - 1]
+    lambda_scaling["pull"] = np.ones(n_pull_windows)
+
+    metadata["lambda_scaling"] = lambda_scaling
+    return metadata
+
+
+def read_iterations(optimize_directory):
+    # The objective, gradient norm and mvals of every finished ForceBalance
+    # iteration of a target, and the index of the newest iteration folder
+    rows, latest = [], -1
+    for folder_name in sorted(glob(os.path.join(optimize_directory, "iter_*"))):
+        iteration = int(os.path.basename(folder_name).split("_")[-1])
+        latest = max(latest, iteration)
+
+        objective_path = os.path.join(folder_name, "objective.p")
+        mvals_path = os.path.join(folder_name, "mvals.txt")
+        if not os.path.isfile(objective_path) or not os.path.isfile(mvals_path):
+            continue
+
+        statistics = lp_load(objective_path)
+        rows.append(
+            {
+                "iteration": iteration,
+                "objective": float(statistics["X"]),
+                "gradient_norm": float(np.linalg.norm(statistics["G"])),
+                "gradient": np.asarray(statistics["G"], dtype=float),
+                "hessian": np.asarray(statistics["H"], dtype=float),
+                "mvals": np.loadtxt(mvals_path, ndmin=1),
+            }
+        )
+
+    for previous, row in zip(rows[:-1], rows[1:]):
+        row["step_size"] = float(np.linalg.norm(row["mvals"] - previous["mvals"]))
+    if len(rows) > 0:
+        rows[0]["step_size"] = np.inf
+
+    return rows, latest
+
+
+def select_level(rows, levels, minimum_index=0):
+    # The index of the level for the next iteration. The fidelity rises as the
+    # gradient and the steps shrink, and by one more level after a step that
+    # increased the objective, which may be noise of the coarse estimates. It
+    # never drops back.
+    if len(rows) == 0:
+        return minimum_index
+
+    last = rows[-1]
+    index = next(
+        (
+            index
+            for index, level in enumerate(levels[:-1])
+            if last["gradient_norm"] >= level["gradient_norm"]
+            and last["step_size"] >= level["step_size"]
+        ),
+        len(levels) - 1,
+    )
+    if len(rows) > 1 and last["objective"] > rows[-2]["objective"]:
+        index += 1
+
+    return min(max(index, minimum_index), len(levels) - 1)
+
+
+class FidelitySchedule:
+    # Chooses the fidelity of each Evaluator request from the progress of the
+    # ForceBalance target in optimize_directory, and records the fidelity of
+    # every iteration in history_path
+
+    def __init__(
+        self,
+        optimize_directory="optimize.tmp/host_guest_data",
+        history_path="fidelity_history.json",
+        levels=None,
+    ):
+        self._optimize_directory = optimize_directory
+        self._history_path = history_path
+        self._levels = DEFAULT_LEVELS if levels is None else levels
+
+    def history(self):
+        if not os.path.isfile(self._history_path):
+            return []
+        with open(self._history_path) as file:
+            return json.load(file)
+
+    def current_level(self):
+        # The level of the latest request, without recording a new one
+        names = [level["name"] for level in self._levels]
+        history = self.history()
+        if len(history) == 0:
+            return self._levels[0]
+        return self._levels[names.index(history[-1]["fidelity"])]
+
+    def next_level(self, request_id):
+        history = self.history()
+        names = [level["name"] for level in self._levels]
+        # A restarted optimization continues at the highest fidelity used
+        minimum_index = max(
+            (names.index(record["fidelity"]) for record in history), default=0
+        )
+
+        rows, latest = read_iterations(self._optimize_directory)
+        level = self._levels[select_level(rows, self._levels, minimum_index)]
+
+        record = {
+            "request_id": request_id,
+            "iteration": max(latest, 0),
+            "fidelity": level["name"],
+            "time": time.time(),
+        }
+        if len(rows) > 0:
+            record["gradient_norm"] = rows[-1]["gradient_norm"]
+            record["step_size"] = rows[-1]["step_size"]
+        history.append(record)
+
+        with open(f"{self._history_path}.tmp", "w") as file:
+            json.dump(history, file, indent=2)
+        os.replace(f"{self._history_path}.tmp", self._history_path)
+
+        logger.info(
+            f"Request {request_id} (iteration {record['iteration']}) runs at "
+            f"{level['name']} fidelity."
+        )
+        return level
+
+    def best_request(self):
+        # The request of the finished iteration with the lowest objective, the
+        # point ForceBalance compares its next step with
+        rows, _ = read_iterations(self._optimize_directory)
+        if len(rows) == 0:
+            return None
+        best = min(rows, key=lambda row: row["objective"])["iteration"]
+        return next(
+            (
+                record["request_id"]
+                for record in reversed(self.history())
+                if record["iteration"] == best
+            ),
+            None,
+        )
+
+
+class MultiFidelityEvaluatorServer(EvaluatorServer):
+    # Applies the fidelity chosen by a FidelitySchedule to every request
+    # before it is batched, so that all calculation layers see the same
+    # simulation settings, windows and stored results.
+    #
+    # ForceBalance accepts or rejects a step by comparing its objective with
+    # that of the best point so far, and grows or shrinks the trust radius
+    # with the ratio of the actual to the predicted change. Across a change of
+    # level that comparison would mix two fidelities. The request which
+    # raises the level therefore also re-estimates the best iteration at the
+    # new level, and the difference to the values reported for it is added to
+    # every later result of that level. The accept/reject decisions and the
+    # trust radius updates then only see differences between estimates of
+    # the same level. The offsets do not depend on the parameters, so the
+    # property gradients are unchanged, but the reported values, and with them
+    # the residuals ForceBalance fits, stay on the scale of the first level.
+
+    def __init__(self, fidelity_schedule, **kwargs):
+        super().__init__(**kwargs)
+        self._fidelity_schedule = fidelity_schedule
+        self._batch_requests = {}
+        # The level and submission of every ForceBalance request, the batches
+        # re-estimating the best iteration, and the offsets of each level
+        self._request_levels = {}
+        self._submissions = {}
+        self._reference_batches = {}
+        self._offsets = {}
+
+    def _request_level(self, request_id):
+        return self._fidelity_schedule.next_level(request_id)
+
+    def _start_iteration(self):
+        # Validation tasks do not preempt the regular ones, so the queued ones
+        # are dropped when ForceBalance submits an iteration, see validation.py
+        cancel = getattr(self._calculation_backend, "cancel_queued_background", None)
+        if cancel is None:
+            return
+        n_tasks = cancel(VALIDATION_PRIORITY)
+        if n_tasks > 0:
+            logger.info(f"Cancelled {n_tasks} queued validation tasks.")
+
+    def _fidelity_batches(self, submission, request_id, level):
+        batches = super()._prepare_batches(submission, request_id)
+        for batch in batches:
+            batch.options = apply_fidelity(batch.options, level)
+            for physical_property in batch.queued_properties:
+                physical_property.metadata = coarsen_windows(
+                    physical_property.metadata, level["window_stride"]
+                )
+        return batches
+
+    def _register_request(self, submission, request_id, level):
+        self._request_levels[request_id] = level["name"]
+        self._submissions[request_id] = copy.deepcopy(submission)
+
+    def _prepare_level(self, submission, request_id, previous, level):
+        # The batches of a ForceBalance request at the level, and of the
+        # re-estimate of the best iteration when the level changed
+        self._register_request(submission, request_id, level)
+        batches = self._fidelity_batches(submission, request_id, level)
+
+        reference = self._fidelity_schedule.best_request()
+        if level["name"] != previous["name"] and level["name"] not in self._offsets:
+            if reference in self._submissions:
+                reference_batches = self._fidelity_batches(
+                    copy.deepcopy(self._submissions[reference]), request_id, level
+                )
+                self._reference_batches.update(
+                    {batch.id: reference for batch in reference_batches}
+                )
+                batches += reference_batches
+                logger.info(
+                    f"Request {request_id} re-estimates request {reference} at "
+                    f"{level['name']} fidelity."
+                )
+            else:
+                logger.warning(
+                    f"The best iteration was not estimated by this server, "
+                    f"request {request_id} is compared across fidelities."
+                )
+
+        self._batch_requests.update({batch.id: request_id for batch in batches})
+        return batches
+
+    def _prepare_batches(self, submission, request_id):
+        if not submission.parameter_gradient_keys:
+            # Requests without gradients, e.g. the test set validation, are not
+            # ForceBalance iterations and always run at full fidelity
+            batches = super()._prepare_batches(submission, request_id)
+            self._batch_requests.update({batch.id: request_id for batch in batches})
+            return batches
+
+        self._start_iteration()
+        previous = self._fidelity_schedule.current_level()
+        level = self._request_level(request_id)
+        return self._prepare_level(submission, request_id, previous, level)
+
+    def _reported_values(self, request_id):
+        results, _ = self._query_request_status(request_id)
+        return {
+            physical_property.id: physical_property.value
+            for physical_property in results.estimated_properties.properties
+        }
+
+    def _finish_reference(self, batch):
+        # The offsets of the new level from the re-estimated best iteration.
+        # Its properties are not returned with the request.
+        reference = self._reference_batches.pop(batch.id)
+        level = self._request_levels[self._batch_requests[batch.id]]
+        reported = self._reported_values(reference)
+        offsets = self._offsets.setdefault(level, {})
+        for physical_property in batch.estimated_properties:
+            if physical_property.id in reported:
+                offsets[physical_property.id] = (
+                    reported[physical_property.id] - physical_property.value
+                )
+
+        batch.queued_properties = []
+        batch.estimated_properties = []
+        batch.unsuccessful_properties = []
+
+    def _query_request_status(self, client_request_id):
+        results, error = super()._query_request_status(client_request_id)
+        offsets = self._offsets.get(self._request_levels.get(client_request_id), {})
+        if len(offsets) == 0:
+            return results, error
+
+        results = copy.deepcopy(results)
+        for physical_property in results.estimated_properties.properties:
+            if physical_property.id in offsets:
+                physical_property.value += offsets[physical_property.id]
+        return results, error
+
+    def _launch_batch(self, batch):
+        # The server finishes a batch once no properties or calculation layers
+        # are left
+        finished = (
+            len(batch.queued_properties) == 0
+            or len(batch.options.calculation_layers) == 0
+        )
+        if finished and batch.id in self._reference_batches:
+            self._finish_reference(batch)
+
+        # The telemetry of the backend in scheduling.py records the request of
+        # every task
+        request = getattr(self._calculation_backend, "request", None)
+        if request is None:
+            return super()._launch_batch(batch)
+
+        with request(self._batch_requests.get(batch.id)):
+            return super()._launch_batch(batch)
+
+
+def main():
+    # python fidelity.py optimize.tmp/host_guest_data fidelity_history.json
+    optimize_directory, history_path = sys.argv[1], sys.argv[2]
+    rows, _ = read_iterations(optimize_directory)
+    fidelities = {
+        record["iteration"]: record["fidelity"]
+        for record in FidelitySchedule(optimize_directory, history_path).history()
+    }
+
+    print(f"{'iter':>4} {'X':>10} {'|G|':>10} {'step':>8}  fidelity")
+    for row in rows:
+        print(
+            f"{row['iteration']:>4} {row['objective']:>10.4f} "
+            f"{row['gradient_norm']:>10.4f} {row['step_size']:>8.4f}  "
+            f"{fidelities.get(row['iteration'], 'unknown')}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import difflib
+import hashlib
+import json
+import lzma
+import os
+import sys
+from glob import glob
+
+from openff.evaluator.forcefield import SmirnoffForceFieldSource
+from openff.evaluator.storage import LocalFileStorage
+from openff.evaluator.storage.data import ForceFieldData
+
+
+class DeltaForceFieldStorage(LocalFileStorage):
+    # A LocalFileStorage where SMIRNOFF force fields are stored once as a
+    # compressed base OFFXML plus a line delta per force field, addressed by
+    # the SHA-256 of their XML. Other objects are stored as JSON as before.
+
+    _index_file = "force_field_index.json"
+    _force_field_directory = "force_fields"
+
+    # Start a new base when more than this fraction of the lines differ
+    maximum_delta_fraction = 0.25
+
+    def __init__(self, root_directory="stored_data", cache_objects_in_memory=False):
+        self._force_field_root = os.path.join(
+            root_directory, self._force_field_directory
+        )
+        os.makedirs(self._force_field_root, exist_ok=True)
+
+        # storage key -> content hash, content hash -> storage key, and the
+        # content hashes of the stored base force fields
+        self._key_to_hash = {}
+        self._hash_to_key = {}
+        self._base_hashes = []
+        self._cached_bases = {}
+
+        index_path = os.path.join(root_directory, self._index_file)
+        if os.path.isfile(index_path):
+            with open(index_path) as file:
+                index = json.load(file)
+            self._key_to_hash = index["keys"]
+            self._base_hashes = index["bases"]
+            self._hash_to_key = {
+                content_hash: storage_key
+                for storage_key, content_hash in self._key_to_hash.items()
+            }
+
+        super().__init__(root_directory, cache_objects_in_memory)
+
+    @staticmethod
+    def _content_hash(inner_xml):
+        return hashlib.sha256(inner_xml.encode()).hexdigest()
+
+    @staticmethod
+    def _is_smirnoff_data(storage_object):
+        return isinstance(storage_object, ForceFieldData) and isinstance(
+            storage_object.force_field_source, SmirnoffForceFieldSource
+        )
+
+    def _path(self, content_hash, extension):
+        return os.path.join(self._force_field_root, f"{content_hash}.{extension}")
+
+    def _save_index(self):
+        index_path = os.path.join(self._root_directory, self._index_file)
+        with open(f"{index_path}.tmp", "w") as file:
+            json.dump({"bases": self._base_hashes, "keys": self._key_to_hash}, file)
+        os.replace(f"{index_path}.tmp", index_path)
+
+    def _load_base(self, base_hash):
+        if base_hash not in self._cached_bases:
+            with lzma.open(self._path(base_hash, "offxml.xz"), "rt") as file:
+                self._cached_bases[base_hash] = file.read().splitlines(keepends=True)
+        return self._cached_bases[base_hash]
+
+    def _write_delta(self, content_hash, lines):
+        # Pick the base with the smallest line delta
+        best_delta, best_size = None, None
+        for base_hash in self._base_hashes:
+            matcher = difflib.SequenceMatcher(
+                None, self._load_base(base_hash), lines, autojunk=False
+            )
+            operations = [
+                [i1, i2, lines[j1:j2]]
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                if tag != "equal"
+            ]
+            size = sum(len(operation[2]) for operation in operations)
+            if best_size is None or size < best_size:
+                best_delta = {"base": base_hash, "operations": operations}
+                best_size = size
+
+        if best_size is None or best_size > self.maximum_delta_fraction * len(lines):
+            with lzma.open(self._path(content_hash, "offxml.xz"), "wt") as file:
+                file.write("".join(lines))
+            self._base_hashes.append(content_hash)
+            self._cached_bases[content_hash] = lines
+            best_delta = {"base": content_hash, "operations": []}
+
+        with lzma.open(self._path(content_hash, "delta.xz"), "wt") as file:
+            json.dump(best_delta, file)
+
+    def _read_inner_xml(self, content_hash):
+        with lzma.open(self._path(content_hash, "delta.xz"), "rt") as file:
+            delta = json.load(file)
+
+        lines = self._load_base(delta["base"])
+        if len(delta["operations"]) == 0:
+            return "".join(lines)
+
+        # Apply the replaced line ranges in order
+        new_lines, position = [], 0
+        for start, end, replacement in delta["operations"]:
+            new_lines.extend(lines[position:start])
+            new_lines.extend(replacement)
+            position = end
+        new_lines.extend(lines[position:])
+        return "".join(new_lines)
+
+    def _store_object(
+        self, object_to_store, storage_key=None, ancillary_data_path=None
+    ):
+        if not self._is_smirnoff_data(object_to_store):
+            return super()._store_object(
+                object_to_store, storage_key, ancillary_data_path
+            )
+
+        inner_xml = object_to_store.force_field_source.inner_xml
+        content_hash = self._content_hash(inner_xml)
+
+        if not os.path.isfile(self._path(content_hash, "delta.xz")):
+            self._write_delta(content_hash, inner_xml.splitlines(keepends=True))
+
+        self._key_to_hash[storage_key] = content_hash
+        self._hash_to_key.setdefault(content_hash, storage_key)
+        self._save_index()
+
+    def _retrieve_object(self, storage_key, expected_type=None):
+        if storage_key not in self._key_to_hash:
+            return super()._retrieve_object(storage_key, expected_type)
+
+        if expected_type is not None and not issubclass(ForceFieldData, expected_type):
+            raise ValueError(
+                f"The retrieved object is a ForceFieldData, not a {expected_type}"
+            )
+
+        force_field_source = SmirnoffForceFieldSource()
+        force_field_source.inner_xml = self._read_inner_xml(
+            self._key_to_hash[storage_key]
+        )
+
+        force_field_data = ForceFieldData()
+        force_field_data.force_field_source = force_field_source
+        return force_field_data, None
+
+    def _object_exists(self, storage_key):
+        return storage_key in self._key_to_hash or super()._object_exists(storage_key)
+
+    def _has_object(self, storage_object):
+        if not self._is_smirnoff_data(storage_object):
+            return super()._has_object(storage_object)
+
+        # O(1) lookup by the hash of the force field contents
+        content_hash = self._content_hash(storage_object.force_field_source.inner_xml)
+        return self._hash_to_key.get(content_hash)
+
+    def import_local_storage(self):
+        # Move ForceFieldData JSON files written by LocalFileStorage into the
+        # deduplicated store, keeping their storage keys
+        for storage_key in self._stored_object_keys.get("ForceFieldData", []):
+            json_path = os.path.join(self._root_directory, f"{storage_key}.json")
+            if storage_key in self._key_to_hash or not os.path.isfile(json_path):
+                continue
+
+            stored_object, _ = super()._retrieve_object(storage_key, ForceFieldData)
+            if not self._is_smirnoff_data(stored_object):
+                continue
+
+            self._store_object(stored_object, storage_key)
+            os.remove(json_path)
+
+
+def main():
+    # Convert an existing stored_data directory in place
+    for root_directory in sys.argv[1:]:
+        before = sum(
+            os.path.getsize(path)
+            for path in glob(os.path.join(root_directory, "**", "*"), recursive=True)
+            if os.path.isfile(path)
+        )
+        storage = DeltaForceFieldStorage(root_directory)
+        storage.import_local_storage()
+        after = sum(
+            os.path.getsize(path)
+            for path in glob(os.path.join(root_directory, "**", "*"), recursive=True)
+            if os.path.isfile(path)
+        )
+        print(
+            f"{root_directory}: {before / 1024**2:.2f} MB -> {after / 1024**2:.2f} MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+import logging
+import re
+
+import numpy as np
+
+try:
+    import openmm
+except ImportError:
+    from simtk import openmm
+
+logger = logging.getLogger(__name__)
+
+# The Amber style CustomGBForce (OBC1, HCT) stores the offset radius
+# "or" = radius - offset and the scaled offset radius "sr" = scale * "or"
+CUSTOM_GB_PARAMETERS = ["charge", "or", "sr"]
+CUSTOM_GB_OFFSET = 0.009  # nanometer
+
+# (alpha, beta, gamma) of the OBC Born radii
+#   B = 1 / (1/or - tanh(alpha psi - beta psi^2 + gamma psi^3) / radius)
+OBC1_MODEL = (0.8, 0.0, 2.909125)
+OBC2_MODEL = (1.0, 0.8, 4.85)
+OBC_EXPRESSIONS = {
+    "tanh(0.8*psi+2.909125*psi^3)": OBC1_MODEL,
+    "tanh(psi-0.8*psi^2+4.85*psi^3)": OBC2_MODEL,
+}
+COULOMB_CONSTANT = 138.935485  # kJ/mol nm / e^2
+PROBE_RADIUS = 0.14  # nanometer
+
+
+def _is_custom_gb(force):
+    return (
+        isinstance(force, openmm.CustomGBForce)
+        and [
+            force.getPerParticleParameterName(index)
+            for index in range(force.getNumPerParticleParameters())
+        ]
+        == CUSTOM_GB_PARAMETERS
+    )
+
+
+def find_gbsa_force(system):
+    for force in system.getForces():
+        if isinstance(force, openmm.GBSAOBCForce) or _is_custom_gb(force):
+            return force
+    raise ValueError("The system does not contain a GBSA force.")
+
+
+def gbsa_atom_types(force_field, topology):
+    # The SMIRKS of the GBSA parameter assigned to each atom of the topology
+    matches = force_field.get_parameter_handler("GBSA").find_matches(topology)
+    atom_types = [None] * topology.n_atoms
+    for (atom_index,), match in matches.items():
+        atom_types[atom_index] = match.parameter_type.smirks
+    return atom_types
+
+
+def particle_types(atom_types, n_particles):
+    # The atom types of every particle of a system, the pAPRika dummy atoms
+    # are appended after the typed atoms and stay untyped
+    return list(atom_types) + [None] * (n_particles - len(atom_types))
+
+
+def gbsa_radii(force_field):
+    # {smirks: radius in nanometer}
+    return {
+        parameter.smirks: parameter.radius.m_as("nanometer")
+        for parameter in force_field.get_parameter_handler("GBSA").parameters
+    }
+
+
+def get_particle_radii(force):
+    # The radii and scale factors of all particles in nanometer
+    n_particles = force.getNumParticles()
+    radii, scales = np.empty(n_particles), np.empty(n_particles)
+
+    for index in range(n_particles):
+        if isinstance(force, openmm.GBSAOBCForce):
+            _, radius, scale = force.getParticleParameters(index)
+            radii[index] = radius.value_in_unit(openmm.unit.nanometer)
+            scales[index] = scale
+        else:
+            _, offset_radius, scaled_radius = force.getParticleParameters(index)
+            radii[index] = offset_radius + CUSTOM_GB_OFFSET
+            scales[index] = scaled_radius / offset_radius
+
+    return radii, scales
+
+
+def set_particle_radii(force, radii):
+    # Only the radii change, the charges and scale factors are kept. Call
+    # force.updateParametersInContext(context) to apply them to a Context.
+    for index, radius in enumerate(radii):
+        if isinstance(force, openmm.GBSAOBCForce):
+            charge, _, scale = force.getParticleParameters(index)
+            force.setParticleParameters(index, charge, radius, scale)
+        else:
+            charge, offset_radius, scaled_radius = force.getParticleParameters(index)
+            scale = scaled_radius / offset_radius
+            force.setParticleParameters(
+                index,
+                [
+                    charge,
+                    radius - CUSTOM_GB_OFFSET,
+                    scale * (radius - CUSTOM_GB_OFFSET),
+                ],
+            )
+
+
+def radii_from_types(atom_types, radii_by_smirks, default_radii):
+    # Per particle radii of a parameter set, particles without a tagged type
+    # keep their current radius
+    return np.array(
+        [
+            radii_by_smirks.get(atom_type, default)
+            for atom_type, default in zip(
+                particle_types(atom_types, len(default_radii)), default_radii
+            )
+        ]
+    )
+
+
+def gbsa_energies(context, force, radii, positions):
+    # The energies (kJ/mol) of force group 1, which should only hold the GBSA
+    # force, for every frame with one set of radii
+    set_particle_radii(force, radii)
+    force.updateParametersInContext(context)
+
+    energies = np.empty(len(positions))
+    for index, frame in enumerate(positions):
+        context.setPositions(frame)
+        state = context.getState(getEnergy=True, groups={1})
+        energies[index] = state.getPotentialEnergy().value_in_unit(
+            openmm.unit.kilojoule_per_mole
+        )
+    return energies
+
+
+def obc_model(force):
+    # The constants of an OBC1/OBC2 force without cutoff or salt: (alpha,
+    # beta, gamma), the GB prefactor -k (1/e_solute - 1/e_solvent), the ACE
+    # surface area energy 4 pi sigma and probe radius, and whether the
+    # integral includes atoms buried inside a descreening sphere, which only
+    # GBSAOBCForce does
+    if isinstance(force, openmm.GBSAOBCForce):
+        if force.getNonbondedMethod() != openmm.GBSAOBCForce.NoCutoff:
+            raise ValueError("Only GBSA forces without a cutoff are supported.")
+        surface_area = force.getSurfaceAreaEnergy()
+        if isinstance(surface_area, openmm.unit.Quantity):
+            surface_area = surface_area.value_in_unit(
+                openmm.unit.kilojoule_per_mole / openmm.unit.nanometer**2
+            )
+        prefactor = -COULOMB_CONSTANT * (
+            1.0 / force.getSoluteDielectric() - 1.0 / force.getSolventDielectric()
+        )
+        return OBC2_MODEL, prefactor, 4.0 * np.pi * surface_area, PROBE_RADIUS, True
+
+    if not _is_custom_gb(force):
+        raise ValueError("The GBSA force is not an OBC force.")
+    if force.getNonbondedMethod() != openmm.CustomGBForce.NoCutoff:
+        raise ValueError("Only GBSA forces without a cutoff are supported.")
+
+    computed_values = {
+        name: expression.replace(" ", "")
+        for name, expression, _ in (
+            force.getComputedValueParameters(index)
+            for index in range(force.getNumComputedValues())
+        )
+    }
+    model = next(
+        (
+            constants
+            for expression, constants in OBC_EXPRESSIONS.items()
+            if expression in computed_values.get("B", "")
+        ),
+        None,
+    )
+    if model is None:
+        raise ValueError("The GBSA force is not an OBC force.")
+
+    # The constants are appended to every energy expression by OpenMM
+    expressions = [
+        force.getEnergyTermParameters(index)[0].replace(" ", "")
+        for index in range(force.getNumEnergyTerms())
+    ]
+    constants = {
+        name: float(value)
+        for name, value in re.findall(r";(\w+)=([-+.\deE]+)", expressions[0])
+    }
+    if constants.get("kappa", 0.0) != 0.0:
+        raise ValueError("Only GBSA forces without salt are supported.")
+    prefactor = -COULOMB_CONSTANT * (
+        1.0 / constants["soluteDielectric"] - 1.0 / constants["solventDielectric"]
+    )
+
+    surface_area, probe_radius = 0.0, PROBE_RADIUS
+    for expression in expressions:
+        match = re.match(r"([-+.\deE]+)\*\(radius\+([.\deE]+)\)\^2", expression)
+        if match is not None:
+            surface_area, probe_radius = map(float, match.groups())
+
+    return model, prefactor, surface_area, probe_radius, False
+
+
+def obc_particle_derivatives(force, positions, model=None):
+    # Analytic dU/dradius (kJ/mol/nm) of the GB and ACE surface area energy
+    # for the radius of every particle in every frame, (n_frames, n_particles).
+    # Changing a radius changes the Born radius of the particle itself and of
+    # every particle it descreens, the scale factors are kept.
+    (alpha, beta, gamma), prefactor, surface_area, probe_radius, buried = (
+        obc_model(force) if model is None else model
+    )
+    radii, scales = get_particle_radii(force)
+    charges = [
+        force.getParticleParameters(index)[0]
+        for index in range(force.getNumParticles())
+    ]
+    charges = np.array(
+        [
+            (
+                charge.value_in_unit(openmm.unit.elementary_charge)
+                if isinstance(charge, openmm.unit.Quantity)
+                else charge
+            )
+            for charge in charges
+        ]
+    )
+    offset_radii = radii - CUSTOM_GB_OFFSET
+    scaled_radii = scales * offset_radii
+
+    n_particles = len(radii)
+    off_diagonal = ~np.eye(n_particles, dtype=bool)
+    # Blocks of frames keep the (frames, particles, particles) arrays small
+    block_size = max(1, 2**22 // n_particles**2)
+
+    derivatives = np.empty((len(positions), n_particles))
+    for start in range(0, len(positions), block_size):
+        frames = np.asarray(positions[start : start + block_size], dtype=float)
+        r = np.linalg.norm(frames[:, :, None] - frames[:, None, :], axis=-1)
+        r[:, ~off_diagonal] = 1.0
+
+        # H(r_ij, or_i, sr_j), the descreening of i by j, and its derivatives
+        # with respect to or_i and sr_j
+        or_i, sr_j = offset_radii[:, None], scaled_radii[None, :]
+        upper = r + sr_j
+        lower = np.maximum(or_i, np.abs(r - sr_j))
+        lower_is_or = or_i >= np.abs(r - sr_j)
+        overlap = (upper > or_i) & off_diagonal
+        a = 0.25 * (r - sr_j**2 / r)
+
+        integral = 0.5 * (
+            1.0 / lower
+            - 1.0 / upper
+            + a * (1.0 / upper**2 - 1.0 / lower**2)
+            + 0.5 * np.log(lower / upper) / r
+        )
+        d_lower = 0.5 * (-1.0 / lower**2 + 2.0 * a / lower**3 + 0.5 / (r * lower))
+        d_upper = 0.5 * (1.0 / upper**2 - 2.0 * a / upper**3 - 0.5 / (r * upper))
+        d_or = np.where(lower_is_or, d_lower, 0.0)
+        d_sr = (
+            np.where(lower_is_or, 0.0, d_lower * np.sign(sr_j - r))
+            + d_upper
+            - 0.25 * sr_j / r * (1.0 / upper**2 - 1.0 / lower**2)
+        )
+        if buried:
+            inside = or_i < sr_j - r
+            integral += np.where(inside, 1.0 / or_i - 1.0 / lower, 0.0)
+            d_or -= np.where(inside, 1.0 / or_i**2, 0.0)
+            d_sr += np.where(inside, 1.0 / lower**2, 0.0)
+
+        integral = np.where(overlap, integral, 0.0).sum(axis=-1)
+        d_or = np.where(overlap, d_or, 0.0).sum(axis=-1)
+        d_sr = np.where(overlap, d_sr, 0.0)
+
+        # Born radii
+        psi = offset_radii * integral
+        tanh = np.tanh(alpha * psi - beta * psi**2 + gamma * psi**3)
+        d_tanh = (1.0 - tanh**2) * (alpha - 2.0 * beta * psi + 3.0 * gamma * psi**2)
+        born = 1.0 / (1.0 / offset_radii - tanh / radii)
+
+        # dU/dB_i of the self, pair and surface area terms
+        product = born[:, :, None] * born[:, None, :]
+        exponential = np.exp(-(r**2) / (4.0 * product))
+        f = np.sqrt(r**2 + product * exponential)
+        pair = (
+            prefactor
+            * charges[:, None]
+            * charges[None, :]
+            * born[:, None, :]
+            * exponential
+            * (1.0 + r**2 / (4.0 * product))
+            / (2.0 * f**3)
+        )
+        sa_energy = surface_area * (radii + probe_radius) ** 2 * (radii / born) ** 6
+        d_born = (
+            -0.5 * prefactor * charges**2 / born**2
+            - np.where(off_diagonal, pair, 0.0).sum(axis=-1)
+            - 6.0 * sa_energy / born
+        )
+
+        # Chain rule through dB_i/dradius_k = -B_i^2 dQ_i/dradius_k with
+        # Q_i = 1/or_i - tanh_i/radius_i
+        weights = d_born * born**2 * d_tanh / radii
+        derivatives[start : start + block_size] = (
+            sa_energy * (2.0 / (radii + probe_radius) + 6.0 / radii)
+            - d_born * born**2 * (-1.0 / offset_radii**2 + tanh / radii**2)
+            + weights * (integral + offset_radii * d_or)
+            + scales * np.einsum("fi,fik->fk", weights * offset_radii, d_sr)
+        )
+
+    return derivatives
+
+
+def analytic_radius_derivatives(force, atom_types, smirks, positions):
+    # dU/dradius (kJ/mol/nm) of every frame for each SMIRKS at the current
+    # radii of the force, the sum over the particles of each type
+    particle_derivatives = obc_particle_derivatives(force, positions)
+    atom_types = np.array(
+        particle_types(atom_types, force.getNumParticles()), dtype=object
+    )
+    return np.array(
+        [particle_derivatives[:, atom_types == key].sum(axis=-1) for key in smirks]
+    )
+
+
+def radius_derivatives(
+    context,
+    force,
+    atom_types,
+    radii_by_smirks,
+    positions,
+    smirks,
+    perturbation,
+    analytic=True,
+):
+    # dU/dradius (kJ/mol/nm) of every frame for each SMIRKS. OBC forces are
+    # differentiated analytically, other models by central differences where
+    # the Context is only updated once per perturbed radius set.
+    default_radii, _ = get_particle_radii(force)
+    radii = radii_from_types(atom_types, radii_by_smirks, default_radii)
+
+    if analytic:
+        try:
+            obc_model(force)
+        except ValueError as error:
+            logger.info(f"Using finite differences for the GBSA radii: {error}")
+        else:
+            set_particle_radii(force, radii)
+            force.updateParametersInContext(context)
+            return analytic_radius_derivatives(force, atom_types, smirks, positions)
+
+    derivatives = np.empty((len(smirks), len(positions)))
+    for index, key in enumerate(smirks):
+        energies = []
+        for step in [perturbation, -perturbation]:
+            perturbed_radii = dict(radii_by_smirks)
+            perturbed_radii[key] += step
+            energies.append(
+                gbsa_energies(
+                    context,
+                    force,
+                    radii_from_types(atom_types, perturbed_radii, default_radii),
+                    positions,
+                )
+            )
+        derivatives[index] = (energies[0] - energies[1]) / (2.0 * perturbation)
+
+    # Leave the Context at the unperturbed radii
+    set_particle_radii(force, radii)
+    force.updateParametersInContext(context)
+    return derivatives
@@ -0,0 +1,124 @@
+import re
+
+from openff.evaluator.workflow.utils import ProtocolPath, ReplicatorValue
+
+# The taproom metadata which is the same for every guest of a host
+HOST_GLOBALS = {
+    "host_substance",
+    "host_coordinate_path",
+    "host_file_paths",
+    "force_field_path",
+    "dummy_atom_offset",
+    "thermodynamic_state",
+    "lambda_scaling",
+    "release_lambdas",
+    "release_windows_indices",
+    "guest_orientations.static_restraints",
+    "guest_orientations.conformational_restraints",
+}
+
+# The restraints of the release phase. The guest, wall and symmetry restraints
+# need the guest atoms and are not applied to the host alone.
+RELEASE_RESTRAINTS = ["static", "conformational"]
+
+
+def _references(value):
+    if isinstance(value, (ProtocolPath, ReplicatorValue)):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _references(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _references(item)
+
+
+def _dependencies(workflow_schema, ignored_inputs):
+    # The global metadata and the protocols each protocol schema reads from,
+    # replicated values count as reads of the replicator template
+    templates = {
+        replicator.id: replicator.template_values
+        for replicator in workflow_schema.protocol_replicators
+    }
+
+    dependencies = {}
+    for protocol_schema in workflow_schema.protocol_schemas:
+        global_names, protocol_ids, outputs = set(), set(), set()
+        for name, value in protocol_schema.inputs.items():
+            if name in ignored_inputs:
+                continue
+            for reference in _references(value):
+                if isinstance(reference, ReplicatorValue):
+                    reference = templates[reference.replicator_id]
+                    if not isinstance(reference, ProtocolPath):
+                        continue
+
+                protocol_path, property_name = reference.full_path.split(".", 1)
+                if protocol_path == "global":
+                    global_names.add(re.sub(r"\[[^]]*\]", "", property_name))
+                else:
+                    protocol_ids.add(protocol_path.split("/")[0])
+                    outputs.add((protocol_path.split("/")[0], property_name))
+
+        dependencies[protocol_schema.id] = (global_names, protocol_ids, outputs)
+    return dependencies
+
+
+def host_only_protocols(workflow_schema, ignored_inputs=(".gradient_parameters",)):
+    # The protocols which only depend on the host, the force field and the
+    # simulation settings. The workflow graph merges identical protocols, so
+    # these are run once for all guests of a host in a batch.
+    dependencies = _dependencies(workflow_schema, ignored_inputs)
+    host_only = {
+        protocol_id
+        for protocol_id, (global_names, _, _) in dependencies.items()
+        if global_names <= HOST_GLOBALS
+    }
+
+    changed = True
+    while changed:
+        changed = False
+        for protocol_id in list(host_only):
+            if not dependencies[protocol_id][1] <= host_only:
+                host_only.discard(protocol_id)
+                changed = True
+
+    return host_only
+
+
+def share_host_protocols(calculation_schema):
+    # Make the release phase of a schema from
+    # HostGuestBindingAffinity.default_paprika_schema identical for all guests
+    # of a host, after any call to use_adaptive_production, use_checkpointing
+    # or use_window_cache
+    workflow_schema = calculation_schema.workflow_schema
+    for protocol_schema in workflow_schema.protocol_schemas:
+        if protocol_schema.type != "GenerateReleaseRestraints":
+            continue
+        restraint_schemas = protocol_schema.inputs[".restraint_schemas"]
+        protocol_schema.inputs[".restraint_schemas"] = {
+            name: restraint_schemas[name]
+            for name in RELEASE_RESTRAINTS
+            if name in restraint_schemas
+        }
+
+    host_only = host_only_protocols(workflow_schema)
+
+    # The gradient keys are pruned to the parameters of each host-guest pair.
+    # The observables of the host-only windows are not differentiated unless
+    # another protocol reads them, the binding free energy gradient comes
+    # from the end states.
+    consumed = {
+        output
+        for _, _, outputs in _dependencies(workflow_schema, ()).values()
+        for output in outputs
+    }
+    for protocol_schema in workflow_schema.protocol_schemas:
+        if protocol_schema.id not in host_only:
+            continue
+        if (protocol_schema.id, "observables") in consumed:
+            continue
+        if isinstance(protocol_schema.inputs.get(".gradient_parameters"), ProtocolPath):
+            protocol_schema.inputs[".gradient_parameters"] = []
+
+    return sorted(host_only)
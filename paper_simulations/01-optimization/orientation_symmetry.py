@@ -0,0 +1,153 @@
+import logging
+
+import networkx as nx
+import numpy as np
+from networkx.algorithms.isomorphism import GraphMatcher
+from openff.evaluator.attributes import UNDEFINED
+from openff.evaluator.protocols.miscellaneous import AverageFreeEnergies
+from openff.evaluator.utils.observables import Observable
+from openff.evaluator.workflow import workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute
+from openff.evaluator.workflow.utils import ProtocolPath
+from openff.units import unit
+
+logger = logging.getLogger(__name__)
+
+energy_unit = unit.kilocalorie / unit.mole
+
+# The metadata entry with the number of equivalent orientations each
+# simulated orientation stands for
+DEGENERACY_KEY = "orientation_degeneracies"
+
+# The protocols which combine the orientations into the binding free energy
+COMBINE_TYPES = {
+    "AverageFreeEnergies": "DegenerateAverageFreeEnergies",
+    "CombineReweightedFreeEnergies": "CombineReweightedFreeEnergies",
+}
+
+
+def read_mol2_graph(file_path):
+    # The bond graph of a mol2 file, with the atom names and SYBYL types
+    graph = nx.Graph()
+    section = None
+    with open(file_path) as file:
+        for line in file:
+            if line.startswith("@<TRIPOS>"):
+                section = line.strip()[len("@<TRIPOS>") :]
+                continue
+            fields = line.split()
+            if len(fields) == 0:
+                continue
+
+            if section == "ATOM":
+                graph.add_node(int(fields[0]), name=fields[1], type=fields[5])
+            elif section == "BOND":
+                graph.add_edge(int(fields[1]), int(fields[2]), order=fields[3])
+
+    return graph
+
+
+def _anchor_names(orientation_mask):
+    # ":M4C@C1 :M4C@C5" -> ["C1", "C5"]
+    masks = orientation_mask.split()
+    if len(masks) != 2 or any("@" not in mask for mask in masks):
+        raise ValueError(
+            f"The guest orientation mask {orientation_mask!r} does not select "
+            f"exactly two anchor atoms."
+        )
+    return [mask.split("@")[-1] for mask in masks]
+
+
+def swaps_anchors(graph, first_name, second_name):
+    # Whether an automorphism of the guest exchanges its two anchor atoms,
+    # i.e. whether both ends of the guest are equivalent
+    def labelled(first, second):
+        labelled_graph = graph.copy()
+        for _, data in labelled_graph.nodes(data=True):
+            data["anchor"] = {first: 1, second: 2}.get(data["name"], 0)
+        return labelled_graph
+
+    return GraphMatcher(
+        labelled(first_name, second_name),
+        labelled(second_name, first_name),
+        node_match=lambda a, b: a["type"] == b["type"] and a["anchor"] == b["anchor"],
+        edge_match=lambda a, b: a["order"] == b["order"],
+    ).is_isomorphic()
+
+
+def prune_orientations(data_set):
+    # The taproom orientations of a guest differ in which of its two anchor
+    # ends enters the host first. When the ends are equivalent, both
+    # orientations give the same free energy, so only the first one is
+    # simulated and counted twice when the orientations are combined.
+    # Returns the degeneracies as {substance: [...]}.
+    symmetric = {}
+    degeneracies = {}
+    for physical_property in data_set.properties:
+        metadata = physical_property.metadata
+        orientations = metadata["guest_orientations"]
+        guest_path = metadata["guest_file_paths"]["guest_mol2_path"]
+
+        if guest_path not in symmetric:
+            symmetric[guest_path] = swaps_anchors(
+                read_mol2_graph(guest_path),
+                *_anchor_names(metadata["guest_orientation_mask"]),
+            )
+
+        if len(orientations) == 2 and symmetric[guest_path]:
+            metadata["guest_orientations"] = orientations[:1]
+            metadata[DEGENERACY_KEY] = [2]
+        else:
+            metadata[DEGENERACY_KEY] = [1] * len(orientations)
+        degeneracies[physical_property.substance.identifier] = metadata[DEGENERACY_KEY]
+
+    logger.info(
+        f"{sum(sum(values) - len(values) for values in degeneracies.values())} "
+        f"equivalent guest orientations are not simulated."
+    )
+    return degeneracies
+
+
+@workflow_protocol()
+class DegenerateAverageFreeEnergies(AverageFreeEnergies):
+    # The Boltzmann weighted average of the orientations, where each value
+    # stands for degeneracies[i] equivalent orientations
+
+    degeneracies = InputAttribute(
+        docstring="The number of equivalent orientations each value stands for.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+
+    def _execute(self, directory, available_resources):
+        kT = (unit.molar_gas_constant * self.thermodynamic_state.temperature).m_as(
+            energy_unit
+        )
+        # The input values are left unchanged, the parent averages the shifted
+        # ones
+        values = self.values
+        self.values = [
+            Observable(
+                value=(
+                    (value.value.m_as(energy_unit) - kT * np.log(degeneracy))
+                    * energy_unit
+                ).plus_minus(value.error),
+                gradients=value.gradients,
+            )
+            for value, degeneracy in zip(values, self.degeneracies)
+        ]
+        try:
+            super()._execute(directory, available_resources)
+        finally:
+            self.values = values
+
+
+def use_orientation_degeneracy(calculation_schema):
+    # Weight the orientations of a simulation or reweighting schema by the
+    # degeneracies that prune_orientations added to the metadata
+    for protocol_schema in calculation_schema.workflow_schema.protocol_schemas:
+        if protocol_schema.type not in COMBINE_TYPES:
+            continue
+
+        protocol_schema.type = COMBINE_TYPES[protocol_schema.type]
+        protocol_schema.inputs[".degeneracies"] = ProtocolPath(DEGENERACY_KEY, "global")
@@ -0,0 +1,397 @@
+import copy
+import hashlib
+import json
+import os
+from concurrent.futures import Future
+
+from openff.evaluator.attributes import UNDEFINED, Attribute
+from openff.evaluator.datasets import CalculationSource
+from openff.evaluator.forcefield import ForceFieldSource, ParameterGradient
+from openff.evaluator.forcefield.gradients import ParameterGradientKey
+from openff.evaluator.layers import (
+    CalculationLayer,
+    CalculationLayerResult,
+    CalculationLayerSchema,
+    calculation_layer,
+)
+from openff.evaluator.layers.simulation import SimulationLayer
+from openff.evaluator.substances import Substance
+from openff.evaluator.thermodynamics import ThermodynamicState
+from openff.evaluator.utils.observables import Observable
+from openff.evaluator.utils.serialization import TypedJSONDecoder, TypedJSONEncoder
+from openff.evaluator.workflow import Protocol, workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute, OutputAttribute
+from openff.evaluator.workflow.utils import ProtocolPath
+from openff.toolkit.topology import Molecule
+from openff.units import unit
+
+# Names of the substance component roles in the index
+ROLES = {"rec": "host", "lig": "guest"}
+
+
+def gradient_key_name(key):
+    return f"{key.tag}/{key.smirks}/{key.attribute}"
+
+
+def tagged_parameter_keys(force_field):
+    # The parameters ForceBalance optimizes, i.e. those with a cosmetic
+    # parameterize="..." attribute
+    keys = []
+    for tag in force_field.registered_parameter_handlers:
+        for parameter in force_field.get_parameter_handler(tag).parameters:
+            if "parameterize" not in parameter._cosmetic_attribs:
+                continue
+            for attribute in parameter._parameterize.split(","):
+                keys.append(
+                    ParameterGradientKey(tag, parameter.smirks, attribute.strip())
+                )
+    return keys
+
+
+def _component_parameters(component, force_field, keys):
+    # The names of the tagged parameters that type any atom of a component
+    molecule = Molecule.from_smiles(component.smiles, allow_undefined_stereo=True)
+    labels = force_field.label_molecules(molecule.to_topology())[0]
+    return sorted(
+        gradient_key_name(key)
+        for key in keys
+        if any(parameter.smirks == key.smirks for parameter in labels[key.tag].values())
+    )
+
+
+def annotate_relevance(data_set, force_field):
+    # Store the tagged parameters that type any atom of the host or guest in
+    # the metadata of each property, and return them per molecule as
+    # {substance: {"host": [...], "guest": [...]}}. The atom indices are left
+    # out, the SMILES atom order differs from the taproom mol2 files.
+    keys = tagged_parameter_keys(force_field)
+    index = {}
+
+    for physical_property in data_set.properties:
+        identifier = physical_property.substance.identifier
+        if identifier not in index:
+            index[identifier] = {
+                ROLES.get(component.role.value, component.role.value): (
+                    _component_parameters(component, force_field, keys)
+                )
+                for component in physical_property.substance.components
+            }
+
+        physical_property.metadata["relevant_parameters"] = sorted(
+            {name for names in index[identifier].values() for name in names}
+        )
+
+    return index
+
+
+def relevance_hash(force_field, relevant_parameters):
+    # A hash of the force field in which only the relevant tagged values are
+    # kept, so that systems are not recomputed when other parameters move
+    force_field = copy.deepcopy(force_field)
+    values = {}
+    for key in tagged_parameter_keys(force_field):
+        parameter = force_field.get_parameter_handler(key.tag).parameters[key.smirks]
+        value = getattr(parameter, key.attribute)
+        if gradient_key_name(key) in relevant_parameters:
+            values[gradient_key_name(key)] = str(value)
+        setattr(parameter, key.attribute, value * 0)
+
+    content = force_field.to_string() + json.dumps(values, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def relevant_parameters(substance, force_field):
+    # The same labelling as annotate_relevance, for properties whose metadata
+    # was not annotated
+    keys = tagged_parameter_keys(force_field)
+    return sorted(
+        {
+            name
+            for component in substance.components
+            for name in _component_parameters(component, force_field, keys)
+        }
+    )
+
+
+def _property_relevance(physical_property, force_field):
+    relevant = physical_property.metadata.get("relevant_parameters")
+    if relevant is None:
+        relevant = relevant_parameters(physical_property.substance, force_field)
+    return relevant
+
+
+def schema_hash(workflow_schema):
+    # A hash of the settings of the workflow which estimates the cached values,
+    # so that results of other simulation settings are never returned
+    return hashlib.sha256(workflow_schema.json().encode()).hexdigest()
+
+
+def _cache_path(
+    cache_directory,
+    workflow_hash,
+    substance,
+    thermodynamic_state,
+    force_field,
+    relevant,
+):
+    key = hashlib.sha256(
+        json.dumps(
+            [
+                workflow_hash,
+                substance.identifier,
+                str(thermodynamic_state.temperature),
+                str(thermodynamic_state.pressure),
+                relevance_hash(force_field, relevant),
+            ]
+        ).encode()
+    ).hexdigest()
+    return os.path.join(cache_directory, f"{key}.json")
+
+
+def _zero_gradient(force_field, key, value_unit):
+    parameter = force_field.get_parameter_handler(key.tag).parameters[key.smirks]
+    parameter_unit = getattr(
+        getattr(parameter, key.attribute), "units", unit.dimensionless
+    )
+    return ParameterGradient(key=key, value=0.0 * value_unit / parameter_unit)
+
+
+class RelevantGradientsMixin:
+    # Only request the gradients of the parameters that type the system, the
+    # others are exactly zero and are added back by StoreRelevantResult
+
+    @classmethod
+    def _get_workflow_metadata(
+        cls,
+        working_directory,
+        physical_property,
+        force_field_path,
+        parameter_gradient_keys,
+        storage_backend,
+        calculation_schema,
+    ):
+        force_field = ForceFieldSource.from_json(force_field_path).to_force_field()
+        relevant = _property_relevance(physical_property, force_field)
+
+        all_parameter_gradient_keys = parameter_gradient_keys
+        parameter_gradient_keys = [
+            key for key in parameter_gradient_keys if gradient_key_name(key) in relevant
+        ]
+
+        global_metadata = super()._get_workflow_metadata(
+            working_directory,
+            physical_property,
+            force_field_path,
+            parameter_gradient_keys,
+            storage_backend,
+            calculation_schema,
+        )
+        if global_metadata is not None:
+            global_metadata["all_parameter_gradient_keys"] = all_parameter_gradient_keys
+            global_metadata["relevant_parameters"] = relevant
+        return global_metadata
+
+
+@calculation_layer()
+class RelevantSimulationLayer(RelevantGradientsMixin, SimulationLayer):
+    pass
+
+
+@workflow_protocol()
+class StoreRelevantResult(Protocol):
+    # Completes the gradients of a workflow result with zeros for the pruned
+    # parameters and stores it under the relevant parameter hash
+
+    value = InputAttribute(
+        docstring="The estimated value.",
+        type_hint=Observable,
+        default_value=UNDEFINED,
+    )
+    cache_directory = InputAttribute(
+        docstring="The directory of the cached results.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    schema_hash = InputAttribute(
+        docstring="The hash of the workflow schema the value was estimated with.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    substance = InputAttribute(
+        docstring="The substance of the property.",
+        type_hint=Substance,
+        default_value=UNDEFINED,
+    )
+    thermodynamic_state = InputAttribute(
+        docstring="The state of the property.",
+        type_hint=ThermodynamicState,
+        default_value=UNDEFINED,
+    )
+    force_field_path = InputAttribute(
+        docstring="The force field the value was estimated with.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    parameter_gradient_keys = InputAttribute(
+        docstring="All of the requested gradient keys.",
+        type_hint=list,
+        default_value=[],
+    )
+    relevant_parameters = InputAttribute(
+        docstring="The tagged parameters which type the substance.",
+        type_hint=list,
+        default_value=UNDEFINED,
+    )
+
+    result = OutputAttribute(
+        docstring="The value with the gradients of all keys.", type_hint=Observable
+    )
+
+    def _execute(self, directory, available_resources):
+        force_field = ForceFieldSource.from_json(self.force_field_path).to_force_field()
+
+        computed = {gradient.key for gradient in self.value.gradients}
+        gradients = list(self.value.gradients) + [
+            _zero_gradient(force_field, key, self.value.value.units)
+            for key in self.parameter_gradient_keys
+            if key not in computed
+        ]
+        self.result = Observable(
+            value=self.value.value.plus_minus(self.value.error), gradients=gradients
+        )
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+        cache_path = _cache_path(
+            self.cache_directory,
+            self.schema_hash,
+            self.substance,
+            self.thermodynamic_state,
+            force_field,
+            self.relevant_parameters,
+        )
+        with open(f"{cache_path}.{os.getpid()}.tmp", "w") as file:
+            json.dump(self.result, file, cls=TypedJSONEncoder)
+        os.replace(f"{cache_path}.{os.getpid()}.tmp", cache_path)
+
+
+def add_result_cache(calculation_schema, cache_directory="relevance_cache"):
+    # Route the final value of a workflow through StoreRelevantResult, and
+    # return the schema of the RelevanceCacheLayer which reads the results back.
+    # Call it after every other change to the workflow schema.
+    workflow_schema = calculation_schema.workflow_schema
+    workflow_hash = schema_hash(workflow_schema)
+
+    store_result = StoreRelevantResult("store_relevant_result")
+    store_result.value = workflow_schema.final_value_source
+    store_result.cache_directory = os.path.abspath(cache_directory)
+    store_result.schema_hash = workflow_hash
+    store_result.substance = ProtocolPath("substance", "global")
+    store_result.thermodynamic_state = ProtocolPath("thermodynamic_state", "global")
+    store_result.force_field_path = ProtocolPath("force_field_path", "global")
+    store_result.parameter_gradient_keys = ProtocolPath(
+        "all_parameter_gradient_keys", "global"
+    )
+    store_result.relevant_parameters = ProtocolPath("relevant_parameters", "global")
+
+    workflow_schema.protocol_schemas.append(store_result.schema)
+    workflow_schema.final_value_source = ProtocolPath("result", store_result.id)
+
+    cache_schema = RelevanceCacheSchema()
+    cache_schema.cache_directory = os.path.abspath(cache_directory)
+    cache_schema.schema_hash = workflow_hash
+    return cache_schema
+
+
+def _cached_result(physical_property, schema, force_field, keys):
+    cache_path = _cache_path(
+        schema.cache_directory,
+        schema.schema_hash,
+        physical_property.substance,
+        physical_property.thermodynamic_state,
+        force_field,
+        _property_relevance(physical_property, force_field),
+    )
+    if not os.path.isfile(cache_path):
+        return CalculationLayerResult()
+
+    with open(cache_path) as file:
+        observable = json.load(file, cls=TypedJSONDecoder)
+
+    gradients = {gradient.key: gradient for gradient in observable.gradients}
+
+    physical_property = copy.deepcopy(physical_property)
+    physical_property.value = observable.value
+    physical_property.uncertainty = observable.error
+    physical_property.gradients = [
+        (
+            gradients[key]
+            if key in gradients
+            else _zero_gradient(force_field, key, observable.value.units)
+        )
+        for key in keys
+    ]
+    physical_property.source = CalculationSource(
+        fidelity=RelevanceCacheLayer.__name__, provenance={"cache_path": cache_path}
+    )
+
+    result = CalculationLayerResult()
+    result.physical_property = physical_property
+    return result
+
+
+class RelevanceCacheSchema(CalculationLayerSchema):
+    cache_directory = Attribute(
+        docstring="The directory of the cached results.",
+        type_hint=str,
+        default_value="relevance_cache",
+    )
+    schema_hash = Attribute(
+        docstring="The hash of the workflow schema the results were estimated with.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+
+
+@calculation_layer()
+class RelevanceCacheLayer(CalculationLayer):
+    # Returns the stored result of a system when none of the parameters that
+    # type it changed since it was last estimated
+
+    @classmethod
+    def required_schema_type(cls):
+        return RelevanceCacheSchema
+
+    @classmethod
+    def schedule_calculation(
+        cls,
+        calculation_backend,
+        storage_backend,
+        layer_directory,
+        batch,
+        callback,
+        synchronous=False,
+    ):
+        # The lookup only reads small JSON files, so it runs on the server
+        # rather than as one task per property on the workers
+        force_field = storage_backend.retrieve_force_field(
+            batch.force_field_id
+        ).to_force_field()
+
+        results = []
+        for physical_property in batch.queued_properties:
+            property_type = physical_property.__class__.__name__
+            schema = batch.options.calculation_schemas[property_type][cls.__name__]
+            results.append(
+                _cached_result(
+                    physical_property,
+                    schema,
+                    force_field,
+                    batch.parameter_gradient_keys,
+                )
+            )
+
+        results_future = Future()
+        results_future.set_result(results)
+        CalculationLayer._process_results(
+            results_future, batch, cls.__name__, storage_backend, callback
+        )
@@ -0,0 +1,470 @@
+import contextlib
+import functools
+import heapq
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import numpy as np
+from distributed import Future
+from openff.evaluator.backends.dask import DaskSLURMBackend
+from openff.evaluator.datasets import PhysicalPropertyDataSet
+from openff.evaluator.workflow import Protocol, ProtocolGroup
+from openff.toolkit.topology import Molecule
+from openff.units import unit
+
+from telemetry import (
+    SPAN_TOPIC,
+    iterations,
+    load_spans,
+    record_span,
+    send_span,
+    stage,
+    worker_name,
+)
+
+# The components simulated in each APR phase, the release phase only contains
+# the host and the unbound end state only the guest
+PHASE_COMPONENTS = {
+    "attach": ("host", "guest"),
+    "pull": ("host", "guest"),
+    "release": ("host",),
+    "state_bound": ("host", "guest"),
+    "state_unbound": ("guest",),
+}
+ROLES = {"rec": "host", "lig": "guest"}
+# The priority of a task is its predicted run time in seconds, capped below
+# the spacing of the background tiers
+PRIORITY_RANGE = 10**8
+# Seconds per atom step before any timings were recorded, roughly a host-guest
+# complex in implicit solvent on one GPU
+DEFAULT_RATE = 2.0e-6
+# Background tasks rank below every regular task, so they only run on
+# workers that would otherwise be idle. Speculative candidates go before the
+# test set validation.
+SPECULATIVE_PRIORITY = -(10**9)
+VALIDATION_PRIORITY = -2 * 10**9
+# Seconds between two refits of the rates. A request submits hundreds of
+# tasks at once, and the timings only change when tasks finish.
+RATES_INTERVAL = 300.0
+
+
+def system_name(physical_property):
+    # "host-guest" from the taproom mol2 files, e.g. "bcd-hex"
+    metadata = physical_property.metadata
+    host, guest = (
+        os.path.splitext(os.path.basename(file_path))[0]
+        for file_path in (
+            metadata["host_file_paths"]["host_mol2_path"],
+            metadata["guest_file_paths"]["guest_mol2_path"],
+        )
+    )
+    return f"{host}-{guest}"
+
+
+def load_systems(data_set_paths):
+    # {property id: (host-guest name, {"host": atoms, "guest": atoms})} of
+    # every property in the data sets
+    properties = [
+        physical_property
+        for data_set_path in data_set_paths
+        for physical_property in PhysicalPropertyDataSet.from_json(
+            data_set_path
+        ).properties
+    ]
+
+    systems = {}
+    for physical_property in properties:
+        atoms = {}
+        for component in physical_property.substance.components:
+            molecule = Molecule.from_smiles(
+                component.smiles, allow_undefined_stereo=True
+            )
+            atoms[ROLES.get(component.role.value, component.role.value)] = (
+                molecule.n_atoms
+            )
+
+        systems[physical_property.id] = (system_name(physical_property), atoms)
+
+    return systems
+
+
+def _protocols(protocol):
+    if isinstance(protocol, ProtocolGroup):
+        for child in protocol.protocols.values():
+            yield from _protocols(child)
+    else:
+        yield protocol
+
+
+def _number_of_steps(protocol):
+    steps = getattr(protocol, "steps_per_iteration", None)
+    iterations = getattr(protocol, "total_number_of_iterations", None)
+    if not isinstance(steps, int) or not isinstance(iterations, int):
+        return 0
+    return steps * iterations
+
+
+def _phase(protocol_id):
+    for phase in sorted(PHASE_COMPONENTS, key=len, reverse=True):
+        if protocol_id.startswith(phase):
+            return phase
+    return None
+
+
+def _timed_task(function, database_path, span, *args, **kwargs):
+    # Runs on the worker and records the span of the protocol
+    start = time.time()
+    result = function(*args, **kwargs)
+    end = time.time()
+
+    simulated_time = span["simulated_time"]
+    send_span(
+        database_path,
+        {
+            **span,
+            "worker": worker_name(),
+            "start": start,
+            "end": end,
+            "ns_per_day": (
+                None
+                if simulated_time is None
+                else simulated_time / ((end - start) / 86400.0)
+            ),
+        },
+    )
+    return result
+
+
+def load_timings(database_path):
+    if not os.path.isfile(database_path):
+        return []
+    return load_spans(database_path)
+
+
+def fit_rates(records):
+    # Seconds per atom step of each host-guest system and phase from earlier
+    # iterations, with the median over all records as the fallback
+    rates = defaultdict(list)
+    for record in records:
+        if record["cost"] > 0:
+            rate = (record["end"] - record["start"]) / record["cost"]
+            rates[(record["system"], record["phase"])].append(rate)
+            rates[None].append(rate)
+    return {key: float(np.median(values)) for key, values in rates.items()}
+
+
+class PrioritizedDaskSLURMBackend(DaskSLURMBackend):
+    # Submits the protocols with the longest predicted run time first, so that
+    # the long end states of the large hosts do not start last and leave the
+    # other GPUs idle. The cost of a task is atoms x steps, converted to
+    # seconds with the rates timed in earlier iterations.
+
+    def __init__(self, data_set_paths, database_path="telemetry.sqlite", **kwargs):
+        super().__init__(**kwargs)
+        self._systems = load_systems(data_set_paths)
+        self._database_path = os.path.abspath(database_path)
+        self._rates, self._rates_time, self._rates_checked = {}, None, -np.inf
+        self._span_ids = {}
+        self._lock = threading.Lock()
+        self._context = threading.local()
+        self._background_futures = defaultdict(dict)
+        self._background_priorities = {}
+
+    def start(self):
+        super().start()
+        # The workers send their spans to the server, see telemetry.send_span
+        self._client.subscribe_topic(SPAN_TOPIC, self._record_span)
+
+    def _record_span(self, event):
+        _, span = event
+        record_span(self._database_path, span)
+
+    def _update_rates(self):
+        # Refit when the workers recorded new timings, at most once per
+        # RATES_INTERVAL
+        now = time.time()
+        if now - self._rates_checked < RATES_INTERVAL:
+            return
+        self._rates_checked = now
+
+        if not os.path.isfile(self._database_path):
+            return
+        modified_time = os.path.getmtime(self._database_path)
+        if modified_time != self._rates_time:
+            self._rates = fit_rates(load_timings(self._database_path))
+            self._rates_time = modified_time
+
+    def _span(self, args):
+        # The span of a task, with the cost (atom steps) and the predicted
+        # seconds of the protocols it runs. A ProtocolGroup task keeps the
+        # phase, window and orientation its protocols agree on, and the steps
+        # of each stage.
+        self._update_rates()
+        tasks = [arg for arg in args if isinstance(arg, Protocol)]
+        span = {
+            "id": uuid.uuid4().hex,
+            "dependencies": [
+                self._span_ids[arg.key]
+                for arg in args
+                if isinstance(arg, Future) and arg.key in self._span_ids
+            ],
+            "request": getattr(self._context, "request", None),
+            "system": None,
+            "steps": 0,
+            "stage_steps": defaultdict(int),
+            "atoms": 0,
+            "cost": 0,
+            "simulated_time": None,
+        }
+
+        for task in tasks:
+            property_id, _, protocol_id = task.id.rpartition("|")
+            span["property_id"] = property_id
+            span["protocol_id"] = protocol_id
+            span["protocol_type"] = type(task).__name__
+
+        labels = defaultdict(set)
+        for protocol in (protocol for task in tasks for protocol in _protocols(task)):
+            property_id, _, protocol_id = protocol.id.rpartition("|")
+
+            indices = [int(index) for index in re.findall(r"_(\d+)", protocol_id)]
+            if len(indices) > 0:
+                labels["orientation"].add(indices[-1])
+            if len(indices) > 1:
+                labels["window"].add(indices[-2])
+
+            if property_id in self._systems:
+                span["system"] = self._systems[property_id][0]
+
+            phase = _phase(protocol_id)
+            if property_id not in self._systems or phase is None:
+                continue
+
+            _, atoms = self._systems[property_id]
+            steps = _number_of_steps(protocol)
+            n_atoms = sum(
+                atoms.get(component, 0) for component in PHASE_COMPONENTS[phase]
+            )
+
+            labels["phase"].add(phase)
+            span["steps"] += steps
+            if steps > 0:
+                span["stage_steps"][stage(protocol_id)] += steps
+            span["atoms"] = max(span["atoms"], n_atoms)
+            span["cost"] += steps * n_atoms
+            if isinstance(getattr(protocol, "timestep", None), unit.Quantity):
+                span["simulated_time"] = (span["simulated_time"] or 0.0) + (
+                    steps * protocol.timestep
+                ).m_as(unit.nanosecond)
+
+        for name in ["phase", "window", "orientation"]:
+            span[name] = labels[name].pop() if len(labels[name]) == 1 else None
+        span["stage_steps"] = dict(span["stage_steps"])
+
+        rate = self._rates.get(
+            (span["system"], span["phase"]), self._rates.get(None, DEFAULT_RATE)
+        )
+        span["predicted"] = span["cost"] * rate
+        return span
+
+    @contextlib.contextmanager
+    def request(self, request_id):
+        # The spans of the tasks submitted by this thread inside the block
+        # record the request, so that the telemetry can be split by iteration
+        self._context.request = request_id
+        try:
+            yield
+        finally:
+            self._context.request = None
+
+    @contextlib.contextmanager
+    def background(self, tag, priority=SPECULATIVE_PRIORITY):
+        # Tasks submitted by this thread inside the block run below the
+        # regular tasks and can be cancelled together with cancel_background
+        self._context.tag, self._context.priority = tag, priority
+        try:
+            yield
+        finally:
+            self._context.tag = None
+
+    def cancel_background(self, tag):
+        # Queued tasks are dropped, tasks already running on a worker finish
+        with self._lock:
+            futures = list(self._background_futures.pop(tag, {}).values())
+        if len(futures) > 0:
+            self._client.cancel(futures)
+        return len(futures)
+
+    def cancel_queued_background(self, priority):
+        # Drops the tasks of every tag submitted at the priority which were not
+        # yet sent to a worker, the tasks already on a worker finish
+        processing = {
+            key for keys in self._client.processing().values() for key in keys
+        }
+        with self._lock:
+            futures = [
+                future
+                for tag, tag_futures in self._background_futures.items()
+                if self._background_priorities.get(tag) == priority
+                for key, future in tag_futures.items()
+                if key not in processing
+            ]
+        if len(futures) > 0:
+            self._client.cancel(futures)
+        return len(futures)
+
+    def keep_background(self, tag):
+        # The tasks of the tag are no longer cancelled with cancel_background
+        with self._lock:
+            self._background_futures.pop(tag, None)
+
+    def submit_task(self, function, *args, **kwargs):
+        from openff.evaluator.workflow.plugins import registered_workflow_protocols
+
+        tag = getattr(self._context, "tag", None)
+        span = self._span(args)
+        span["submitted"] = time.time()
+        span["background"] = tag is not None
+
+        priority = min(int(span["predicted"]), PRIORITY_RANGE - 1)
+        if tag is not None:
+            priority += self._context.priority
+
+        protocols_to_import = [
+            protocol_class.__module__ + "." + protocol_class.__qualname__
+            for protocol_class in registered_workflow_protocols.values()
+        ]
+
+        # The submission of the parent backend, with the priority. Dask runs
+        # the ready task with the highest priority first.
+        key = kwargs.pop("key", None)
+        future = self._client.submit(
+            self._wrapped_function,
+            _timed_task,
+            function,
+            self._database_path,
+            span,
+            *args,
+            available_resources=self._resources_per_worker,
+            registered_workflow_protocols=protocols_to_import,
+            gpu_assignments={},
+            per_worker_logging=True,
+            key=key,
+            priority=priority,
+            **kwargs,
+        )
+
+        with self._lock:
+            self._span_ids[future.key] = span["id"]
+            if tag is not None:
+                self._background_futures[tag][future.key] = future
+                self._background_priorities[tag] = self._context.priority
+        future.add_done_callback(functools.partial(self._release, tag))
+        return future
+
+    def _release(self, tag, future):
+        # Forget a finished or cancelled task, tasks submitted after it
+        # finished are not recorded as its dependents
+        with self._lock:
+            self._span_ids.pop(future.key, None)
+            if tag in self._background_futures:
+                self._background_futures[tag].pop(future.key, None)
+                if len(self._background_futures[tag]) == 0:
+                    del self._background_futures[tag]
+                    self._background_priorities.pop(tag, None)
+
+
+def _list_schedule(tasks, n_workers):
+    # The makespan of running (id, duration, dependencies) tasks on the first
+    # free worker. A task is ready once its dependencies in the list finished,
+    # and the first ready task in the list runs first.
+    ids = {task_id for task_id, _, _ in tasks}
+    pending, finished = list(tasks), {}
+    workers = [0.0] * n_workers
+
+    while len(pending) > 0:
+        now = heapq.heappop(workers)
+        ready = [
+            task
+            for task in pending
+            if all(finished.get(key, np.inf) <= now for key in task[2] if key in ids)
+        ]
+        if len(ready) == 0:
+            # The worker idles until the next running task finishes
+            heapq.heappush(workers, min(end for end in finished.values() if end > now))
+            continue
+
+        task_id, duration, _ = ready[0]
+        pending.remove(ready[0])
+        finished[task_id] = now + duration
+        heapq.heappush(workers, finished[task_id])
+
+    return max(finished.values(), default=0.0)
+
+
+def makespan_report(database_path, n_workers):
+    # The tasks are replayed with the dependencies recorded at submission, so
+    # the windows of an orientation still wait for its equilibration
+    rows, earlier_records = [], []
+    for batch in iterations(load_timings(database_path)):
+        # Predicted with the rates of the earlier batches only, as the backend
+        # would have, so the first batch has no prediction
+        rates = fit_rates(earlier_records)
+        predicted = {
+            record["id"]: record["cost"]
+            * rates.get((record["system"], record["phase"]), rates.get(None, np.nan))
+            for record in batch
+        }
+        earlier_records.extend(batch)
+
+        def schedule(durations, key):
+            if np.isnan(list(durations.values())).any():
+                return np.nan
+            return _list_schedule(
+                [
+                    (record["id"], durations[record["id"]], record["dependencies"])
+                    for record in sorted(batch, key=key)
+                ],
+                n_workers,
+            )
+
+        actual = {record["id"]: record["end"] - record["start"] for record in batch}
+        rows.append(
+            {
+                "tasks": len(batch),
+                # Longest job first with the predicted run times
+                "predicted": schedule(
+                    predicted, lambda record: -predicted[record["id"]]
+                ),
+                "actual": max(record["end"] for record in batch)
+                - min(record["start"] for record in batch),
+                # The same tasks in submission order and longest actual first
+                "fifo": schedule(actual, lambda record: record["submitted"]),
+                "optimal": schedule(actual, lambda record: -actual[record["id"]]),
+            }
+        )
+    return rows
+
+
+def main():
+    # python scheduling.py telemetry.sqlite 28
+    database_path, n_workers = sys.argv[1], int(sys.argv[2])
+    print(
+        f"{'batch':>5} {'tasks':>6} {'predicted':>10} {'actual':>10} "
+        f"{'fifo':>10} {'lpt':>10}  (hours)"
+    )
+    for index, row in enumerate(makespan_report(database_path, n_workers)):
+        print(
+            f"{index:>5} {row['tasks']:>6} {row['predicted'] / 3600:>10.2f} "
+            f"{row['actual'] / 3600:>10.2f} {row['fifo'] / 3600:>10.2f} "
+            f"{row['optimal'] / 3600:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
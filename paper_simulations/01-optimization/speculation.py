@@ -0,0 +1,354 @@
+import copy
+import hashlib
+import logging
+import os
+import threading
+import uuid
+
+import numpy as np
+from forcebalance.forcefield import FF
+from forcebalance.parser import parse_inputs
+from openff.evaluator.client import ConnectionOptions, EvaluatorClient
+from openff.evaluator.forcefield import SmirnoffForceFieldSource
+from openff.toolkit.typing.engines.smirnoff import ForceField
+
+from fidelity import MultiFidelityEvaluatorServer, read_iterations
+from scheduling import SPECULATIVE_PRIORITY
+
+logger = logging.getLogger(__name__)
+
+# The property metadata which marks the requests of the candidates
+CANDIDATE_KEY = "speculative_candidate"
+
+
+def trust_region_step(gradient, hessian, trust_radius, eig_lowerbound=0.01):
+    # The minimum of the quadratic model within the trust radius, i.e. the
+    # Newton-Raphson step of ForceBalance with a Levenberg-Marquardt shift
+    identity = np.eye(len(gradient))
+    hessian = 0.5 * (hessian + hessian.T)
+    lowest = np.linalg.eigvalsh(hessian)[0]
+    if lowest < eig_lowerbound:
+        hessian = hessian + (eig_lowerbound - lowest) * identity
+
+    def step(shift):
+        return -np.linalg.solve(hessian + shift * identity, gradient)
+
+    if np.linalg.norm(step(0.0)) <= trust_radius:
+        return step(0.0)
+
+    lower, upper = 0.0, np.linalg.norm(gradient) / trust_radius
+    for _ in range(100):
+        shift = 0.5 * (lower + upper)
+        if np.linalg.norm(step(shift)) > trust_radius:
+            lower = shift
+        else:
+            upper = shift
+    return step(upper)
+
+
+def candidate_mvals(rows, current_mvals, options, weight=1.0, trust_factors=(1.0,)):
+    # The points ForceBalance may request after the current iteration. If
+    # the current step is accepted, the next step starts from it, with the
+    # gradient predicted by the quadratic model of the best finished
+    # iteration (one candidate per trust radius factor). If it is rejected,
+    # a shorter step is taken from the best iteration. The objective includes
+    # the L2 prior of the mvals.
+    if len(rows) == 0:
+        return {}
+
+    best = min(rows, key=lambda row: row["objective"])
+    penalty = options["penalty_additive"]
+    identity = np.eye(len(best["mvals"]))
+    gradient = weight * best["gradient"] + 2.0 * penalty * best["mvals"]
+    hessian = weight * best["hessian"] + 2.0 * penalty * identity
+
+    displacement = current_mvals - best["mvals"]
+    step_length = max(np.linalg.norm(displacement), options["mintrust"])
+
+    candidates = {}
+    for factor in trust_factors:
+        candidates[f"accepted_{factor:g}"] = current_mvals + trust_region_step(
+            gradient + hessian @ displacement,
+            hessian,
+            factor * step_length,
+            options["eig_lowerbound"],
+        )
+    if np.linalg.norm(displacement) > 0.0:
+        candidates["rejected"] = best["mvals"] + trust_region_step(
+            gradient,
+            hessian,
+            max(
+                np.linalg.norm(displacement) / (1.0 + options["adaptive_factor"]),
+                options["mintrust"],
+            ),
+            options["eig_lowerbound"],
+        )
+    return candidates
+
+
+def _force_field_hash(force_field_source):
+    return hashlib.sha256(force_field_source.json().encode()).hexdigest()
+
+
+def _finish_early(batches):
+    # The server finishes a batch once no calculation layers are left, so a
+    # cancelled candidate is not moved on to the next layer and its request
+    # finishes with the remaining properties unsuccessful
+    for batch in batches:
+        batch.options.calculation_layers = []
+
+
+class SpeculativeEvaluatorServer(MultiFidelityEvaluatorServer):
+    # While the workers run an iteration, also estimates the points
+    # ForceBalance may request next. The candidates are submitted to this
+    # server at the lowest Dask priority, so they only use workers that would
+    # otherwise be idle, e.g. in the tail of an iteration. A candidate is
+    # recognised by the marker its properties carry, not by its force field.
+    # When ForceBalance requests the point of a running candidate at the same
+    # fidelity, the candidate is promoted and its results are returned for the
+    # request. The remaining candidates are cancelled, what they finished is
+    # reused through the window cache, the relevance cache and the APR
+    # references of the reweighting layer. Requires a backend with
+    # background(), see scheduling.py.
+
+    def __init__(
+        self,
+        fidelity_schedule,
+        input_file="optimize.in",
+        target_name="host_guest_data",
+        speculation_directory="speculation",
+        trust_factors=(1.0,),
+        **kwargs,
+    ):
+        super().__init__(fidelity_schedule, **kwargs)
+
+        self._options, target_options = parse_inputs(input_file)
+        self._weight = next(
+            options["weight"]
+            for options in target_options
+            if options["name"] == target_name
+        )
+        self._optimize_directory = os.path.join(
+            f"{os.path.splitext(input_file)[0]}.tmp", target_name
+        )
+        self._speculation_directory = os.path.abspath(speculation_directory)
+        self._trust_factors = trust_factors
+        self._connection_options = ConnectionOptions(
+            server_port=kwargs.get("port", 8000)
+        )
+        self._force_field = None
+        self._token = uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        # The batches and force field hashes of the candidates of the current
+        # iteration, and the candidate returned for each promoted request
+        self._speculative_requests = {}
+        self._speculative_batches = {}
+        self._candidate_hashes = {}
+        self._promoted = {}
+        self._generation = 0
+
+    def _request_level(self, request_id):
+        # Candidates run at the fidelity of the iteration they follow
+        if request_id in self._speculative_requests:
+            return self._fidelity_schedule.current_level()
+        return super()._request_level(request_id)
+
+    def _candidate_generation(self, submission):
+        # The generation of a candidate submitted by _speculate, None for the
+        # requests of ForceBalance
+        for physical_property in submission.dataset.properties:
+            marker = (physical_property.metadata or {}).get(CANDIDATE_KEY)
+            if marker is not None and marker["server"] == self._token:
+                return marker["generation"]
+        return None
+
+    def _prepare_batches(self, submission, request_id):
+        if not submission.parameter_gradient_keys:
+            # Not an iteration of ForceBalance, e.g. the test set validation
+            return super()._prepare_batches(submission, request_id)
+
+        generation = self._candidate_generation(submission)
+        if generation is None:
+            return self._prepare_iteration(submission, request_id)
+
+        with self._lock:
+            self._speculative_requests[request_id] = []
+        batches = super()._prepare_batches(submission, request_id)
+
+        with self._lock:
+            # ForceBalance may have moved on since the candidate was submitted
+            # or while its batches were prepared
+            cancelled = (
+                generation != self._generation
+                or request_id not in self._speculative_requests
+            )
+            if cancelled:
+                self._speculative_requests.pop(request_id, None)
+            else:
+                self._speculative_requests[request_id] = [batch.id for batch in batches]
+                self._speculative_batches.update({batch.id: batch for batch in batches})
+                self._candidate_hashes[request_id] = _force_field_hash(
+                    submission.force_field_source
+                )
+        if cancelled:
+            _finish_early(batches)
+        return batches
+
+    def _prepare_iteration(self, submission, request_id):
+        # ForceBalance has chosen its next point
+        force_field_hash = _force_field_hash(submission.force_field_source)
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            candidate = next(
+                (
+                    candidate
+                    for candidate, candidate_hash in self._candidate_hashes.items()
+                    if candidate_hash == force_field_hash
+                ),
+                None,
+            )
+
+        self._start_iteration()
+        previous = self._fidelity_schedule.current_level()
+        level = self._request_level(request_id)
+        if candidate is not None and level["name"] == previous["name"]:
+            self._register_request(submission, request_id, level)
+            self._promote(candidate, request_id)
+            batches = []
+        else:
+            self._cancel_speculation()
+            batches = self._prepare_level(submission, request_id, previous, level)
+
+        threading.Thread(
+            target=self._speculate,
+            args=(submission, generation),
+            daemon=True,
+        ).start()
+        return batches
+
+    def _promote(self, candidate, request_id):
+        # The candidate becomes the request of ForceBalance. Its queued tasks
+        # keep their Dask priority, which can not be changed once submitted,
+        # but with the other candidates cancelled nothing regular is queued
+        # ahead of them. The tasks it submits from now on run at the regular
+        # priority and are recorded for the request.
+        with self._lock:
+            batch_ids = self._speculative_requests.pop(candidate)
+            del self._candidate_hashes[candidate]
+            for batch_id in batch_ids:
+                del self._speculative_batches[batch_id]
+            self._promoted[request_id] = candidate
+
+        for batch_id in batch_ids:
+            self._calculation_backend.keep_background(batch_id)
+            self._batch_requests[batch_id] = request_id
+        self._cancel_speculation()
+        logger.info(f"Request {request_id} is served by candidate {candidate}.")
+
+    def _query_request_status(self, client_request_id):
+        candidate = self._promoted.get(client_request_id)
+        if candidate is None:
+            return super()._query_request_status(client_request_id)
+
+        results, error = super()._query_request_status(candidate)
+        results = copy.deepcopy(results)
+        for properties in (
+            results.queued_properties,
+            results.estimated_properties,
+            results.unsuccessful_properties,
+        ):
+            for physical_property in properties.properties:
+                (physical_property.metadata or {}).pop(CANDIDATE_KEY, None)
+        return results, error
+
+    def _launch_batch(self, batch):
+        if batch.id not in self._speculative_batches:
+            return super()._launch_batch(batch)
+
+        with self._calculation_backend.background(batch.id, SPECULATIVE_PRIORITY):
+            return super()._launch_batch(batch)
+
+    def _cancel_speculation(self):
+        with self._lock:
+            requests, self._speculative_requests = self._speculative_requests, {}
+            batches, self._speculative_batches = self._speculative_batches, {}
+            self._candidate_hashes = {}
+
+        _finish_early(batches.values())
+        n_tasks = sum(
+            self._calculation_backend.cancel_background(batch_id)
+            for batch_id in batches
+        )
+        if len(requests) > 0:
+            logger.info(
+                f"Cancelled {len(requests)} speculative requests ({n_tasks} tasks)."
+            )
+
+    def _force_field_source(self, mvals, name):
+        # The force field ForceBalance writes for the mvals
+        if self._force_field is None:
+            self._force_field = FF(self._options)
+
+        directory = os.path.join(self._speculation_directory, name)
+        os.makedirs(directory, exist_ok=True)
+        self._force_field.make(mvals, use_pvals=False, printdir=directory)
+
+        force_field = ForceField(
+            os.path.join(directory, self._options["forcefield"][0]),
+            allow_cosmetic_attributes=True,
+        )
+        return SmirnoffForceFieldSource.from_object(force_field)
+
+    def _speculate(self, submission, generation):
+        try:
+            rows, latest = read_iterations(self._optimize_directory)
+            mvals_path = os.path.join(
+                self._optimize_directory, f"iter_{latest:04d}", "mvals.txt"
+            )
+            if latest < 0 or not os.path.isfile(mvals_path):
+                return
+
+            candidates = candidate_mvals(
+                rows,
+                np.loadtxt(mvals_path, ndmin=1),
+                self._options,
+                self._weight,
+                self._trust_factors,
+            )
+
+            # The candidates are recognised by their properties
+            property_set = copy.deepcopy(submission.dataset)
+            for physical_property in property_set.properties:
+                physical_property.metadata[CANDIDATE_KEY] = {
+                    "server": self._token,
+                    "generation": generation,
+                }
+
+            client = EvaluatorClient(self._connection_options)
+            for label, mvals in candidates.items():
+                force_field_source = self._force_field_source(
+                    mvals, f"iter_{latest:04d}_{label}"
+                )
+                with self._lock:
+                    # ForceBalance may have moved on in the meantime
+                    if generation != self._generation:
+                        return
+
+                request, error = client.request_estimate(
+                    property_set=property_set,
+                    force_field_source=force_field_source,
+                    options=submission.options,
+                    parameter_gradient_keys=submission.parameter_gradient_keys,
+                )
+                if error is not None:
+                    logger.warning(f"Candidate {label} was not submitted: {error}")
+                    continue
+                logger.info(
+                    f"Submitted candidate {label} after iteration {latest} "
+                    f"(request {request.id})."
+                )
+
+        except Exception:
+            logger.exception("Could not submit the speculative candidates.")
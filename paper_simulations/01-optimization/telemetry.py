@@ -0,0 +1,285 @@
+import json
+import socket
+import sqlite3
+import sys
+from collections import defaultdict
+
+import numpy as np
+
+# One row per protocol task. submitted is set by the server, start and end by
+# the worker which ran the protocol. request is the Evaluator request the task
+# belongs to, and background is set for the speculative candidates and the
+# test set validation. A task which runs a group of protocols keeps the
+# labels its protocols agree on, and its steps per stage in stage_steps.
+SPAN_COLUMNS = {
+    "id": "TEXT PRIMARY KEY",
+    "dependencies": "TEXT",
+    "request": "TEXT",
+    "background": "INTEGER",
+    "protocol_id": "TEXT",
+    "protocol_type": "TEXT",
+    "property_id": "TEXT",
+    "system": "TEXT",
+    "phase": "TEXT",
+    "stage": "TEXT",
+    "window": "INTEGER",
+    "orientation": "INTEGER",
+    "worker": "TEXT",
+    "submitted": "REAL",
+    "start": "REAL",
+    "end": "REAL",
+    "steps": "INTEGER",
+    "stage_steps": "TEXT",
+    "atoms": "INTEGER",
+    "cost": "REAL",
+    "predicted": "REAL",
+    "ns_per_day": "REAL",
+}
+
+# The Dask event topic the workers send their spans on
+SPAN_TOPIC = "telemetry"
+
+# Protocol id fragments of the stages of an APR window
+STAGES = [
+    "thermalization",
+    "equilibration",
+    "production",
+    "minimization",
+    "analyze",
+    "gradient",
+]
+
+
+def _connect(database_path):
+    # The database is only written by the server, see send_span
+    connection = sqlite3.connect(database_path, timeout=120)
+    columns = ", ".join(f'"{name}" {kind}' for name, kind in SPAN_COLUMNS.items())
+    connection.execute(f"CREATE TABLE IF NOT EXISTS spans ({columns})")
+
+    # Databases of earlier runs get the columns added since
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(spans)")}
+    for name, kind in SPAN_COLUMNS.items():
+        if name in existing:
+            continue
+        try:
+            connection.execute(f'ALTER TABLE spans ADD COLUMN "{name}" {kind}')
+        except sqlite3.OperationalError:
+            # Added by another process in the meantime
+            pass
+    return connection
+
+
+def worker_name():
+    try:
+        from distributed import get_worker
+
+        return get_worker().address
+    except (ImportError, ValueError):
+        return socket.gethostname()
+
+
+def stage(protocol_id):
+    for name in STAGES:
+        if name in protocol_id:
+            return name
+    return "other"
+
+
+def record_span(database_path, span):
+    span = {
+        **span,
+        "dependencies": json.dumps(span.get("dependencies", [])),
+        "stage_steps": json.dumps(span.get("stage_steps", {})),
+        "stage": span.get("stage", stage(span.get("protocol_id") or "")),
+    }
+    names = [name for name in SPAN_COLUMNS if name in span]
+    columns = ", ".join(f'"{name}"' for name in names)
+
+    connection = _connect(database_path)
+    with connection:
+        connection.execute(
+            f"INSERT OR REPLACE INTO spans ({columns}) "
+            f"VALUES ({', '.join('?' * len(names))})",
+            [span[name] for name in names],
+        )
+    connection.close()
+
+
+def send_span(database_path, span):
+    # A worker sends its spans to the server, which subscribes to SPAN_TOPIC
+    # and is the only process writing the database. SQLite locking is not
+    # reliable on the parallel file system the workers share. Outside of a
+    # Dask worker the span is written directly.
+    try:
+        from distributed import get_worker
+
+        worker = get_worker()
+    except (ImportError, ValueError):
+        record_span(database_path, span)
+        return
+    worker.log_event(SPAN_TOPIC, span)
+
+
+def load_spans(database_path):
+    connection = _connect(database_path)
+    connection.row_factory = sqlite3.Row
+    spans = [
+        {
+            **row,
+            "dependencies": json.loads(row["dependencies"]),
+            "stage_steps": json.loads(row["stage_steps"] or "{}"),
+        }
+        for row in map(
+            dict, connection.execute('SELECT * FROM spans WHERE "end" IS NOT NULL')
+        )
+    ]
+    connection.close()
+    return spans
+
+
+def _submission_batches(spans):
+    # All tasks of an Evaluator request are submitted up front, a new
+    # iteration starts with a task submitted after every earlier task finished
+    batches, end = [], -np.inf
+    for span in sorted(spans, key=lambda span: span["submitted"]):
+        if span["submitted"] > end:
+            batches.append([])
+        batches[-1].append(span)
+        end = max(end, span["end"])
+    return batches
+
+
+def iterations(spans, background=False):
+    # The spans of each request in submission order. Spans recorded without
+    # a request are split by submission time instead. The background tasks
+    # overlap the iterations and are left out unless background is set.
+    requests, unassigned = defaultdict(list), []
+    for span in sorted(spans, key=lambda span: span["submitted"]):
+        if span["background"] and not background:
+            continue
+        if span["request"] is None:
+            unassigned.append(span)
+        else:
+            requests[span["request"]].append(span)
+
+    batches = list(requests.values()) + _submission_batches(unassigned)
+    return sorted(batches, key=lambda batch: batch[0]["submitted"])
+
+
+def critical_path(spans):
+    # Walk back from the last task to finish through the dependency which
+    # finished last, the chain of tasks that set the length of the iteration
+    by_id = {span["id"]: span for span in spans}
+    span = max(spans, key=lambda span: span["end"])
+
+    path = [span]
+    while True:
+        dependencies = [by_id[key] for key in span["dependencies"] if key in by_id]
+        if len(dependencies) == 0:
+            break
+        span = max(dependencies, key=lambda span: span["end"])
+        path.append(span)
+
+    return path[::-1]
+
+
+def _queue_wait(span, by_id):
+    # The time a task waited for a free worker once its dependencies finished
+    ready = max(
+        [span["submitted"]]
+        + [by_id[key]["end"] for key in span["dependencies"] if key in by_id]
+    )
+    return max(0.0, span["start"] - ready)
+
+
+def summarize(spans, n_workers=None, n_slowest=5):
+    by_id = {span["id"]: span for span in spans}
+    start = min(span["submitted"] for span in spans)
+    wall_time = max(span["end"] for span in spans) - start
+    workers = n_workers or len({span["worker"] for span in spans})
+    busy_time = sum(span["end"] - span["start"] for span in spans)
+
+    # The time of a task is split over its stages by their steps
+    stages = defaultdict(float)
+    for span in spans:
+        duration = span["end"] - span["start"]
+        steps = sum(span["stage_steps"].values())
+        if steps == 0:
+            stages[span["stage"]] += duration
+            continue
+        for name, stage_steps in span["stage_steps"].items():
+            stages[name] += duration * stage_steps / steps
+    stages["queue wait"] = sum(_queue_wait(span, by_id) for span in spans)
+
+    systems = defaultdict(lambda: [0.0, []])
+    for span in spans:
+        systems[span["system"]][0] += span["end"] - span["start"]
+        if span["ns_per_day"] is not None:
+            systems[span["system"]][1].append(span["ns_per_day"])
+
+    path = critical_path(spans)
+    return {
+        "tasks": len(spans),
+        "wall_time": wall_time,
+        "utilisation": busy_time / (workers * wall_time),
+        "stages": dict(stages),
+        "critical_path": [
+            (span["protocol_id"], span["system"], span["end"] - span["start"])
+            for span in path
+        ],
+        "critical_path_wait": sum(_queue_wait(span, by_id) for span in path),
+        "slowest_systems": sorted(
+            (
+                (
+                    system,
+                    time,
+                    np.mean(speeds) if len(speeds) > 0 else np.nan,
+                )
+                for system, (time, speeds) in systems.items()
+            ),
+            key=lambda row: row[1],
+            reverse=True,
+        )[:n_slowest],
+    }
+
+
+def main():
+    # python telemetry.py telemetry.sqlite [number of GPU workers]
+    database_path = sys.argv[1]
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    spans = load_spans(database_path)
+    for index, iteration_spans in enumerate(iterations(spans)):
+        summary = summarize(iteration_spans, n_workers)
+        request = iteration_spans[0]["request"]
+        print(
+            f"Iteration {index}"
+            f"{'' if request is None else f' (request {request})'}: "
+            f"{summary['tasks']} tasks, "
+            f"{summary['wall_time'] / 3600:.2f} h, "
+            f"GPU utilisation {100 * summary['utilisation']:.1f}%"
+        )
+        print("  Hours per stage:")
+        for name, time in sorted(summary["stages"].items(), key=lambda item: -item[1]):
+            print(f"    {name:<16} {time / 3600:10.2f}")
+        print(
+            f"  Critical path ({len(summary['critical_path'])} tasks, "
+            f"{summary['critical_path_wait'] / 3600:.2f} h waiting in the queue):"
+        )
+        for protocol_id, system, time in summary["critical_path"]:
+            print(f"    {time / 3600:8.2f} h  {system or '-'}  {protocol_id}")
+        print("  Slowest systems:")
+        for system, time, speed in summary["slowest_systems"]:
+            print(f"    {system or '-':<12} {time / 3600:8.2f} h  {speed:8.1f} ns/day")
+
+    background = [span for span in spans if span["background"]]
+    if len(background) > 0:
+        print(
+            f"Background: {len(background)} tasks, "
+            f"{sum(span['end'] - span['start'] for span in background) / 3600:.2f} "
+            f"GPU hours"
+        )
+
+
+if __name__ == "__main__":
+    main()
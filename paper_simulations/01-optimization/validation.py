@@ -0,0 +1,337 @@
+import csv
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from openff.evaluator.attributes import UNDEFINED
+from openff.evaluator.client import ConnectionOptions, EvaluatorClient, RequestOptions
+from openff.evaluator.datasets import PhysicalPropertyDataSet
+from openff.evaluator.forcefield import SmirnoffForceFieldSource
+from openff.evaluator.layers import calculation_layer
+from openff.evaluator.layers.simulation import SimulationLayer
+from openff.toolkit.typing.engines.smirnoff import ForceField
+from openff.units import unit
+
+from fidelity import read_iterations
+from scheduling import VALIDATION_PRIORITY, system_name
+
+logger = logging.getLogger(__name__)
+
+energy_unit = unit.kilocalorie / unit.mole
+
+TABLE_FIELDS = [
+    "iteration",
+    "system",
+    "experiment",
+    "calculated",
+    "uncertainty",
+]
+
+
+@calculation_layer()
+class ValidationLayer(SimulationLayer):
+    # A simulation layer whose tasks rank below every regular task. Dask does
+    # not preempt running tasks, so the server also drops the queued
+    # validation tasks whenever ForceBalance submits an iteration (see
+    # MultiFidelityEvaluatorServer), and ValidationMonitor resubmits the
+    # systems they belonged to. A new iteration then waits for at most one
+    # validation task per worker. The trade-off is that the test set of an
+    # iteration can need several attempts when the optimization leaves few
+    # idle workers; the windows that finished come back from the window
+    # cache. Requires a backend with background(), see scheduling.py.
+
+    @classmethod
+    def schedule_calculation(
+        cls,
+        calculation_backend,
+        storage_backend,
+        layer_directory,
+        batch,
+        callback,
+        synchronous=False,
+    ):
+        with calculation_backend.background(batch.id, VALIDATION_PRIORITY):
+            super().schedule_calculation(
+                calculation_backend,
+                storage_backend,
+                layer_directory,
+                batch,
+                callback,
+                synchronous,
+            )
+
+
+def validation_options(simulation_schema):
+    request_options = RequestOptions()
+    request_options.calculation_layers = ["ValidationLayer"]
+    request_options.add_schema(
+        "ValidationLayer", "HostGuestBindingAffinity", simulation_schema
+    )
+    return request_options
+
+
+def _magnitude(quantity):
+    if quantity is None or UNDEFINED == quantity:
+        return np.nan
+    return quantity.m_as(energy_unit)
+
+
+def _count_systems(rows):
+    counts = defaultdict(int)
+    for iteration, _ in rows:
+        counts[iteration] += 1
+    return counts
+
+
+def read_table(table_path):
+    if not os.path.isfile(table_path):
+        return []
+    with open(table_path) as file:
+        return [
+            {
+                **row,
+                "iteration": int(row["iteration"]),
+                **{
+                    name: float(row[name])
+                    for name in ["experiment", "calculated", "uncertainty"]
+                },
+            }
+            for row in csv.DictReader(file)
+        ]
+
+
+def summarize(rows):
+    # The test set error of every validated iteration (kcal/mol)
+    by_iteration = defaultdict(list)
+    for row in rows:
+        by_iteration[row["iteration"]].append(row)
+
+    summary = []
+    for iteration, iteration_rows in sorted(by_iteration.items()):
+        experiment = np.array([row["experiment"] for row in iteration_rows])
+        calculated = np.array([row["calculated"] for row in iteration_rows])
+        error = calculated - experiment
+        summary.append(
+            {
+                "iteration": iteration,
+                "n_systems": len(iteration_rows),
+                "rmse": float(np.sqrt(np.mean(error**2))),
+                "mue": float(np.mean(np.abs(error))),
+                "r2": (
+                    float(np.corrcoef(experiment, calculated)[0, 1] ** 2)
+                    if len(iteration_rows) > 2
+                    else np.nan
+                ),
+            }
+        )
+    return summary
+
+
+class ValidationMonitor:
+    # Estimates the held-out test set with the force field of every
+    # interval-th finished ForceBalance iteration while the optimization
+    # runs. The estimates are streamed into a table with one row per
+    # iteration and system, so the test set error can be followed (and the
+    # optimization stopped) without a separate benchmark campaign.
+
+    def __init__(
+        self,
+        test_set,
+        request_options,
+        force_field_name,
+        optimize_directory="optimize.tmp/host_guest_data",
+        table_path="validation.csv",
+        connection_options=None,
+        interval=5,
+        poll_interval=600,
+        maximum_attempts=5,
+    ):
+        self._test_set = test_set
+        self._references = {
+            physical_property.id: physical_property for physical_property in test_set
+        }
+        self._request_options = request_options
+        self._force_field_name = force_field_name
+        self._optimize_directory = optimize_directory
+        self._table_path = table_path
+        self._connection_options = (
+            ConnectionOptions() if connection_options is None else connection_options
+        )
+        self._interval = interval
+        self._poll_interval = poll_interval
+        self._maximum_attempts = maximum_attempts
+
+        # Resumed optimizations do not validate the finished iterations again
+        self._rows = {
+            (row["iteration"], row["system"]): row for row in read_table(table_path)
+        }
+        self._finished = {
+            iteration
+            for iteration, n_systems in _count_systems(self._rows).items()
+            if n_systems == len(self._references)
+        }
+        self._requests = {}
+        self._attempts = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exception_type, *args):
+        self._stop.set()
+        self._thread.join()
+        if exception_type is not None:
+            return
+
+        # Validate the final iteration and wait for the outstanding requests
+        self._poll(final=True)
+        while len(self._requests) > 0:
+            time.sleep(self._poll_interval)
+            self._poll()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._poll()
+            except Exception:
+                logger.exception("Could not update the test set validation.")
+            self._stop.wait(self._poll_interval)
+
+    def _poll(self, final=False):
+        rows, _ = read_iterations(self._optimize_directory)
+        iterations = [
+            row["iteration"] for row in rows if row["iteration"] % self._interval == 0
+        ]
+        if final and len(rows) > 0:
+            iterations.append(rows[-1]["iteration"])
+
+        for iteration in iterations:
+            if iteration not in self._finished and iteration not in self._requests:
+                self._submit(iteration)
+
+        for iteration, request in list(self._requests.items()):
+            self._collect(iteration, request)
+
+        self._write()
+
+    def _submit(self, iteration, properties=None):
+        # The whole test set, or the systems of an earlier attempt which were
+        # not estimated
+        property_set = self._test_set
+        if properties is not None:
+            property_set = PhysicalPropertyDataSet()
+            property_set.add_properties(*properties)
+
+        force_field = ForceField(
+            os.path.join(
+                self._optimize_directory,
+                f"iter_{iteration:04d}",
+                self._force_field_name,
+            ),
+            allow_cosmetic_attributes=True,
+        )
+        request, error = EvaluatorClient(self._connection_options).request_estimate(
+            property_set=property_set,
+            force_field_source=SmirnoffForceFieldSource.from_object(force_field),
+            options=self._request_options,
+        )
+        if error is not None:
+            logger.warning(f"The test set of iteration {iteration} failed: {error}")
+            return
+
+        self._requests[iteration] = request
+        self._attempts[iteration] += 1
+        logger.info(
+            f"Submitted the test set of iteration {iteration} (request {request.id})."
+        )
+
+    def _collect(self, iteration, request):
+        results, error = request.results(synchronous=False)
+        if error is not None:
+            logger.warning(f"The test set of iteration {iteration} failed: {error}")
+            del self._requests[iteration]
+            return
+
+        for physical_property in results.estimated_properties:
+            reference = self._references[physical_property.id]
+            name = system_name(reference)
+            self._rows[(iteration, name)] = {
+                "iteration": iteration,
+                "system": name,
+                "experiment": _magnitude(reference.value),
+                "calculated": _magnitude(physical_property.value),
+                "uncertainty": _magnitude(physical_property.uncertainty),
+            }
+
+        if len(results.queued_properties) > 0:
+            return
+
+        del self._requests[iteration]
+        if (
+            len(results.unsuccessful_properties) > 0
+            and self._attempts[iteration] < self._maximum_attempts
+        ):
+            # Most likely validation tasks dropped for an iteration
+            self._submit(
+                iteration,
+                [
+                    self._references[physical_property.id]
+                    for physical_property in results.unsuccessful_properties
+                ],
+            )
+            return
+
+        self._finished.add(iteration)
+        if len(results.unsuccessful_properties) > 0:
+            logger.warning(
+                f"{len(results.unsuccessful_properties)} test set systems of "
+                f"iteration {iteration} could not be estimated."
+            )
+        self._report(iteration)
+
+    def _report(self, iteration):
+        summary = summarize(self._rows.values())
+        row = next(row for row in summary if row["iteration"] == iteration)
+        best = min(summary, key=lambda row: row["rmse"])
+        logger.info(
+            f"Test set of iteration {iteration}: RMSE {row['rmse']:.2f}, "
+            f"MUE {row['mue']:.2f} kcal/mol over {row['n_systems']} systems "
+            f"(best: iteration {best['iteration']}, RMSE {best['rmse']:.2f})."
+        )
+
+    def _write(self):
+        rows = sorted(
+            self._rows.values(), key=lambda row: (row["iteration"], row["system"])
+        )
+        with open(f"{self._table_path}.tmp", "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=TABLE_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(f"{self._table_path}.tmp", self._table_path)
+
+
+def main():
+    # python validation.py validation.csv
+    summary = summarize(read_table(sys.argv[1]))
+    if len(summary) == 0:
+        return
+    best = min(summary, key=lambda row: row["rmse"])
+
+    print(f"{'iter':>4} {'N':>4} {'RMSE':>8} {'MUE':>8} {'R2':>6}")
+    for row in summary:
+        print(
+            f"{row['iteration']:>4} {row['n_systems']:>4} {row['rmse']:>8.3f} "
+            f"{row['mue']:>8.3f} {row['r2']:>6.3f}"
+            f"{'  best' if row is best else ''}"
+        )
+
+
+if __name__ == "__main__":
+    main()
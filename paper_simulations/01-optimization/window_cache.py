@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from openff.evaluator.attributes import UNDEFINED
+from openff.evaluator.utils.serialization import TypedJSONDecoder, TypedJSONEncoder
+from openff.evaluator.workflow import workflow_protocol
+from openff.evaluator.workflow.attributes import InputAttribute, OutputAttribute
+from openff.units import unit
+
+from apr_production import AdaptivePaprikaOpenMMSimulation
+from checkpointing import ResumablePaprikaOpenMMSimulation
+from parameter_relevance import relevance_hash, relevant_parameters
+
+logger = logging.getLogger(__name__)
+
+# The inputs which, together with the force field, determine the result of a
+# window. File paths are left out as they change with every request.
+CACHE_SETTINGS = [
+    "thermodynamic_state",
+    "ensemble",
+    "timestep",
+    "steps_per_iteration",
+    "total_number_of_iterations",
+    "output_frequency",
+    "phase",
+    "window_number",
+    "lambda_scaling",
+    "target_uncertainty",
+    "minimum_number_of_steps",
+    "chunk_number_of_steps",
+]
+
+# Scanning the cache is slow on shared file systems, so the least recently
+# used windows are removed at most once per interval (seconds)
+EVICTION_INTERVAL = 3600.0
+
+CACHED_TYPES = {
+    "PaprikaOpenMMSimulation": "CachedPaprikaOpenMMSimulation",
+    "ResumablePaprikaOpenMMSimulation": "CachedPaprikaOpenMMSimulation",
+    "AdaptivePaprikaOpenMMSimulation": "CachedAdaptivePaprikaOpenMMSimulation",
+}
+
+
+def _directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def evict_windows(cache_directory, maximum_size):
+    # Remove the least recently used windows until the cache fits, the
+    # modification time of an entry is updated on every hit. Entries removed
+    # by another worker during the scan are skipped.
+    modified_times, sizes = {}, {}
+    for name in os.listdir(cache_directory):
+        if name.startswith("."):
+            continue
+        entry = os.path.join(cache_directory, name)
+        try:
+            modified_times[entry] = os.path.getmtime(entry)
+            sizes[entry] = _directory_size(entry)
+        except FileNotFoundError:
+            continue
+    entries = sorted(modified_times, key=modified_times.get)
+
+    total_size = sum(sizes.values())
+    for entry in entries:
+        if total_size <= maximum_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total_size -= sizes[entry]
+
+
+def _eviction_due(cache_directory, interval=EVICTION_INTERVAL):
+    # Whether this worker should scan the cache, the modification time of a
+    # marker file records the last scan of any worker
+    marker_path = os.path.join(cache_directory, ".last_eviction")
+    try:
+        if time.time() - os.path.getmtime(marker_path) < interval:
+            return False
+    except FileNotFoundError:
+        pass
+
+    with open(marker_path, "a"):
+        pass
+    os.utime(marker_path)
+    return True
+
+
+class WindowCacheMixin:
+    # Stores the outputs of an APR window or end state simulation under a key
+    # of the host, guest, orientation, window, settings and the tagged
+    # parameters that type the system, and restores them instead of running
+    # the simulation when the same window is requested again
+
+    cache_directory = InputAttribute(
+        docstring="The directory of the cached windows, e.g. on local scratch.",
+        type_hint=str,
+        default_value=UNDEFINED,
+    )
+    maximum_cache_size = InputAttribute(
+        docstring="The size above which the least recently used windows are removed.",
+        type_hint=unit.Quantity,
+        default_value=UNDEFINED,
+    )
+
+    cache_hit = OutputAttribute(
+        docstring="Whether the outputs were restored from the cache.",
+        type_hint=bool,
+    )
+
+    def _window_key(self):
+        system = self.parameterized_system
+        force_field = system.force_field.to_force_field()
+
+        settings = {
+            name: str(getattr(self, name))
+            for name in CACHE_SETTINGS
+            if hasattr(self, name)
+        }
+        content = json.dumps(
+            [
+                system.substance.identifier,
+                # The id holds the phase, window and orientation indices
+                self.id.split("|")[-1],
+                settings,
+                relevance_hash(
+                    force_field, relevant_parameters(system.substance, force_field)
+                ),
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _cached_outputs(self):
+        return [
+            name for name in self.get_attributes(OutputAttribute) if name != "cache_hit"
+        ]
+
+    def _restore(self, entry_path, directory):
+        # Returns False when the entry is evicted by another worker while it
+        # is read, the outputs are then simulated as for a cache miss
+        try:
+            with open(os.path.join(entry_path, "outputs.json")) as file:
+                outputs = json.load(file, cls=TypedJSONDecoder)
+
+            values = {}
+            for name, (is_file, value) in outputs.items():
+                if is_file:
+                    shutil.copy(os.path.join(entry_path, value), directory)
+                    value = os.path.join(directory, value)
+                values[name] = value
+
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return False
+
+        for name, value in values.items():
+            setattr(self, name, value)
+        return True
+
+    def _store(self, entry_path, directory):
+        # Written to a temporary folder first so that other workers never see
+        # a partial entry
+        temporary_path = os.path.join(self.cache_directory, f".{uuid.uuid4().hex}.tmp")
+        os.makedirs(temporary_path)
+
+        outputs = {}
+        for name in self._cached_outputs():
+            value = getattr(self, name)
+            is_file = (
+                isinstance(value, str)
+                and os.path.isfile(value)
+                and os.path.abspath(value).startswith(os.path.abspath(directory))
+            )
+            if is_file:
+                shutil.copy(value, temporary_path)
+                value = os.path.basename(value)
+            outputs[name] = (is_file, value)
+
+        with open(os.path.join(temporary_path, "outputs.json"), "w") as file:
+            json.dump(outputs, file, cls=TypedJSONEncoder)
+
+        try:
+            os.rename(temporary_path, entry_path)
+        except OSError:
+            # Another worker stored the same window first
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    def _execute(self, directory, available_resources):
+        # Environment variables such as ${USER} are expanded on the worker
+        self.cache_directory = os.path.expandvars(self.cache_directory)
+        os.makedirs(self.cache_directory, exist_ok=True)
+        entry_path = os.path.join(self.cache_directory, self._window_key())
+
+        if self._restore(entry_path, directory):
+            self.cache_hit = True
+            logger.info(f"{self.id}: restored from {entry_path}.")
+            return
+
+        super()._execute(directory, available_resources)
+        self.cache_hit = False
+
+        self._store(entry_path, directory)
+        if _eviction_due(self.cache_directory):
+            evict_windows(self.cache_directory, self.maximum_cache_size.m_as(unit.byte))
+
+
+@workflow_protocol()
+class CachedPaprikaOpenMMSimulation(WindowCacheMixin, ResumablePaprikaOpenMMSimulation):
+    pass
+
+
+@workflow_protocol()
+class CachedAdaptivePaprikaOpenMMSimulation(
+    WindowCacheMixin, AdaptivePaprikaOpenMMSimulation
+):
+    pass
+
+
+def use_window_cache(
+    calculation_schema, cache_directory, maximum_cache_size=50 * unit.gigabyte
+):
+    # Cache every APR window and end state simulation of a schema from
+    # HostGuestBindingAffinity.default_paprika_schema, after any call to
+    # use_adaptive_production or use_checkpointing
+    for protocol_schema in calculation_schema.workflow_schema.protocol_schemas:
+        if protocol_schema.type not in CACHED_TYPES:
+            continue
+
+        protocol_schema.type = CACHED_TYPES[protocol_schema.type]
+        protocol_schema.inputs[".cache_directory"] = cache_directory
+        protocol_schema.inputs[".maximum_cache_size"] = maximum_cache_size
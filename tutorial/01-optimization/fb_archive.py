@@ -0,0 +1,302 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import zstandard
+
+MAGIC = b"FBZ1"
+# Index offset, index length and the magic at the end of the file
+FOOTER = struct.Struct("<QQ4s")
+
+# Files with these extensions are compressed against the first stored file of
+# the same extension, so the near identical OFFXML copies of each iteration
+# only cost the lines that changed
+REFERENCE_EXTENSIONS = (".offxml",)
+
+
+def _content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _extension(name):
+    return os.path.splitext(name)[1]
+
+
+class IterationArchive:
+    # A single file holding many ForceBalance snapshots (e.g. the
+    # host_guest_data_N.tar.bz2 backups). Every distinct file is one
+    # independent zstd frame, and a JSON index at the end of the file maps the
+    # snapshot members to their frames, so one iteration can be read without
+    # decompressing the others.
+
+    level = 10
+
+    def __init__(self, file_path, mode="r"):
+        self._file_path = file_path
+        self._snapshots = {}
+        self._blobs = {}
+        self._references = {}
+        self._dictionaries = {}
+
+        if mode == "w" or (mode == "a" and not os.path.isfile(file_path)):
+            self._file = open(file_path, "w+b")
+            self._file.write(MAGIC)
+            self._end = len(MAGIC)
+        else:
+            self._file = open(file_path, "r+b" if mode == "a" else "rb")
+            self._read_index()
+
+        self._writable = mode in ("w", "a")
+        self._modified = False
+        self._size = self._end
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, *args):
+        if exception_type is not None and self._writable:
+            # Drop the frames of the failed snapshot, the old index still
+            # ends the file
+            self._modified = False
+            self._file.truncate(self._size)
+        self.close()
+
+    def _read_index(self):
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        offset, length, magic = FOOTER.unpack(self._file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{self._file_path} is not a ForceBalance archive")
+
+        self._file.seek(offset)
+        index = json.loads(zstandard.decompress(self._file.read(length)))
+        self._snapshots = index["snapshots"]
+        self._blobs = index["blobs"]
+        self._references = index["references"]
+        # New frames go after the old footer, so the archive stays readable
+        # until the new index is written
+        self._end = self._file.seek(0, os.SEEK_END)
+
+    def _write_index(self):
+        index = json.dumps(
+            {
+                "snapshots": self._snapshots,
+                "blobs": self._blobs,
+                "references": self._references,
+            }
+        ).encode()
+        data = zstandard.ZstdCompressor(level=self.level).compress(index)
+
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._file.write(FOOTER.pack(self._end, len(data), MAGIC))
+        self._file.truncate()
+
+    def close(self):
+        if self._writable and self._modified:
+            self._write_index()
+        self._file.close()
+
+    def _dictionary(self, content_hash):
+        # A new dictionary object per use, as they are not shared across threads
+        if content_hash not in self._dictionaries:
+            self._dictionaries[content_hash] = self._read_blob(content_hash)
+        return zstandard.ZstdCompressionDict(
+            self._dictionaries[content_hash],
+            dict_type=zstandard.DICT_TYPE_RAWCONTENT,
+        )
+
+    def _compress(self, data, reference):
+        parameters = {"level": self.level, "write_content_size": True}
+        if reference is not None:
+            parameters["dict_data"] = self._dictionary(reference)
+        return zstandard.ZstdCompressor(**parameters).compress(data)
+
+    def _read_blob(self, content_hash):
+        offset, length, reference = self._blobs[content_hash]
+        self._file.seek(offset)
+        data = self._file.read(length)
+
+        if reference is None:
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zstandard.ZstdDecompressor(
+            dict_data=self._dictionary(reference)
+        ).decompress(data)
+
+    def add_snapshot(self, name, files, n_threads=None):
+        # files: {member path: bytes or None for directories}
+        if not self._writable:
+            raise ValueError("The archive was opened read only")
+
+        new_blobs = {}
+        members = {}
+        for path, data in files.items():
+            if data is None:
+                members[path] = None
+                continue
+
+            content_hash = _content_hash(data)
+            members[path] = content_hash
+            if content_hash in self._blobs or content_hash in new_blobs:
+                continue
+
+            # The first file of each reference type is stored on its own and
+            # becomes the dictionary for the later ones
+            reference = None
+            extension = _extension(path)
+            if extension in REFERENCE_EXTENSIONS:
+                if extension not in self._references:
+                    self._references[extension] = content_hash
+                    self._blobs[content_hash] = self._write_frame(
+                        self._compress(data, None), None
+                    )
+                    continue
+                reference = self._references[extension]
+            new_blobs[content_hash] = (data, reference)
+
+        # Load the references before the file is shared with the threads, zstd
+        # releases the GIL so the frames are compressed in parallel
+        for _, reference in new_blobs.values():
+            if reference is not None:
+                self._dictionary(reference)
+
+        with ThreadPoolExecutor(n_threads) as executor:
+            frames = executor.map(
+                lambda item: self._compress(*item), new_blobs.values()
+            )
+            for (content_hash, (_, reference)), frame in zip(new_blobs.items(), frames):
+                self._blobs[content_hash] = self._write_frame(frame, reference)
+
+        self._snapshots[name] = members
+        self._modified = True
+
+    def _write_frame(self, frame, reference):
+        self._file.seek(self._end)
+        self._file.write(frame)
+        offset = self._end
+        self._end += len(frame)
+        return [offset, len(frame), reference]
+
+    def add_directory(self, name, directory):
+        root = os.path.dirname(os.path.normpath(directory))
+        files = {}
+        for path in sorted(glob(os.path.join(directory, "**"), recursive=True)):
+            member = os.path.relpath(path, root)
+            if os.path.isdir(path):
+                files[member] = None
+            else:
+                with open(path, "rb") as file:
+                    files[member] = file.read()
+        self.add_snapshot(name, files)
+
+    def add_tarball(self, name, tar_path, extra_files=None):
+        files = {}
+        with tarfile.open(tar_path) as tar:
+            for member in tar:
+                path = member.name.rstrip("/")
+                if member.isdir():
+                    files[path] = None
+                elif member.isfile():
+                    files[path] = tar.extractfile(member).read()
+        files.update(extra_files or {})
+        self.add_snapshot(name, files)
+
+    def snapshots(self):
+        return list(self._snapshots)
+
+    def members(self, snapshot):
+        return list(self._snapshots[snapshot])
+
+    def iterations(self, snapshot):
+        return sorted(
+            {
+                int(match.group(1))
+                for match in map(
+                    re.compile(r".*iter_(\d+)").match, self._snapshots[snapshot]
+                )
+                if match is not None
+            }
+        )
+
+    def read(self, snapshot, member):
+        return self._read_blob(self._snapshots[snapshot][member])
+
+    def read_iteration(self, snapshot, iteration):
+        # {member path: bytes} of one iter_NNNN folder, only its frames are read
+        folder = f"iter_{iteration:04}/"
+        return {
+            path: self._read_blob(content_hash)
+            for path, content_hash in self._snapshots[snapshot].items()
+            if content_hash is not None and folder in path
+        }
+
+    def extract(self, snapshot, destination, iteration=None):
+        if iteration is None:
+            files = {
+                path: self._read_blob(content_hash)
+                for path, content_hash in self._snapshots[snapshot].items()
+                if content_hash is not None
+            }
+        else:
+            files = self.read_iteration(snapshot, iteration)
+
+        for path, data in files.items():
+            file_path = os.path.join(destination, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as file:
+                file.write(data)
+
+
+def convert_backups(backup_folder, archive_path):
+    # Add every host_guest_data_N.tar.bz2 (and the optimize_N.sav next to the
+    # backup folder, if any) to the archive as snapshot host_guest_data_N
+    parent_folder = os.path.dirname(os.path.normpath(backup_folder))
+
+    def number(tar_path):
+        return int(re.search(r"_(\d+)\.tar\.bz2$", tar_path).group(1))
+
+    with IterationArchive(archive_path, "a") as archive:
+        for tar_path in sorted(glob(f"{backup_folder}/*.tar.bz2"), key=number):
+            name = os.path.basename(tar_path)[: -len(".tar.bz2")]
+            if name in archive.snapshots():
+                continue
+
+            extra_files = {}
+            sav_path = os.path.join(parent_folder, f"optimize_{number(tar_path)}.sav")
+            if os.path.isfile(sav_path):
+                with open(sav_path, "rb") as file:
+                    extra_files["optimize.sav"] = file.read()
+
+            archive.add_tarball(name, tar_path, extra_files)
+
+
+def main():
+    command, archive_path = sys.argv[1:3]
+
+    if command == "convert":
+        # python fb_archive.py convert optimize.fbz optimize.bak
+        before = sum(os.path.getsize(path) for path in glob(f"{sys.argv[3]}/*.tar.bz2"))
+        convert_backups(sys.argv[3], archive_path)
+        after = os.path.getsize(archive_path)
+        print(f"{before / 1024**2:.2f} MB -> {after / 1024**2:.2f} MB")
+
+    elif command == "list":
+        # python fb_archive.py list optimize.fbz
+        with IterationArchive(archive_path) as archive:
+            for snapshot in archive.snapshots():
+                print(f"{snapshot}: iterations {archive.iterations(snapshot)}")
+
+    elif command == "extract":
+        # python fb_archive.py extract optimize.fbz host_guest_data_3 [iteration]
+        iteration = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        with IterationArchive(archive_path) as archive:
+            archive.extract(sys.argv[3], ".", iteration)
+
+
+if __name__ == "__main__":
+    main()
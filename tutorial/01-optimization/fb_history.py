@@ -0,0 +1,214 @@
+import os
+import sys
+import xml.etree.ElementTree as ElementTree
+from glob import glob
+
+import numpy as np
+from forcebalance.nifty import lp_load
+from openff.units import unit
+
+# results_reader.py is in the tutorial folder, it only needs numpy and
+# openff-units
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from results_reader import read_results_table  # noqa: E402
+
+# The units the tagged parameters are stored in, by dimensionality
+PARAMETER_UNITS = [
+    unit.angstrom,
+    unit.kilocalorie / unit.mole,
+    unit.kilocalorie / unit.mole / unit.angstrom**2,
+    unit.dimensionless,
+]
+
+
+def _parse_quantity(text):
+    # "0.15 * nanometer" or "1.632214397109e-01*nanometer", lengths in
+    # Angstrom, angles in degrees, energies in kcal/mol (per radian squared
+    # for angle force constants) and bond force constants in kcal/mol/Å^2
+    quantity = unit.Quantity(text)
+    if not isinstance(quantity, unit.Quantity):
+        return float(quantity)
+    angle = any(name in str(quantity.units) for name in ("radian", "degree"))
+    if angle and quantity.dimensionless:
+        return quantity.m_as(unit.degree)
+    for parameter_unit in PARAMETER_UNITS:
+        if quantity.dimensionality == parameter_unit.dimensionality:
+            return quantity.m_as(parameter_unit)
+    raise ValueError(f"The unit of the parameter value {text} is not supported.")
+
+
+def parameterized_attributes(offxml_path):
+    # Read the tagged attributes with a single XML pass instead of building
+    # a ForceField, e.g. {"GBSA/[#8:1]/radius": 1.5}
+    parameters = {}
+    handlers = []
+    for event, element in ElementTree.iterparse(offxml_path, events=("start", "end")):
+        if event == "start":
+            handlers.append(element.tag)
+            continue
+
+        handlers.pop()
+        if "parameterize" in element.attrib:
+            # The handler is the parent element, e.g. <GBSA><Atom .../></GBSA>
+            handler = handlers[-1] if handlers else element.tag
+            for attribute in element.attrib["parameterize"].split(","):
+                attribute = attribute.strip()
+                key = f"{handler}/{element.attrib.get('smirks')}/{attribute}"
+                parameters[key] = _parse_quantity(element.attrib[attribute])
+        element.clear()
+
+    return parameters
+
+
+def _signature(folder_name):
+    # The latest modification time of the files we read from an iteration
+    times = [
+        os.path.getmtime(file_path)
+        for file_path in glob(os.path.join(folder_name, "*"))
+        if os.path.isfile(file_path)
+    ]
+    return max(times) if times else 0.0
+
+
+def _read_iteration(folder_name):
+    row = {"objective": np.nan, "gradient_norm": np.nan}
+
+    file_path = os.path.join(folder_name, "objective.p")
+    if os.path.isfile(file_path):
+        statistics = lp_load(file_path)
+        row["objective"] = statistics["X"]
+        row["gradient_norm"] = np.linalg.norm(statistics["G"])
+
+    file_path = os.path.join(folder_name, "mvals.txt")
+    row["mvals"] = np.loadtxt(file_path, ndmin=1) if os.path.isfile(file_path) else []
+
+    row["parameters"] = {}
+    for file_path in glob(os.path.join(folder_name, "*.offxml")):
+        row["parameters"].update(parameterized_attributes(file_path))
+
+    row["systems"] = {}
+    file_path = os.path.join(folder_name, "results.json")
+    if os.path.isfile(file_path):
+        table = read_results_table(file_path)
+        for host, guest, value, uncertainty in zip(
+            table["host"], table["guest"], table["value"], table["uncertainty"]
+        ):
+            row["systems"][f"{host}/{guest}"] = (value, uncertainty)
+
+    return row
+
+
+def _load_cache(cache_path):
+    if cache_path is None or not os.path.isfile(cache_path):
+        return {}
+
+    cache = np.load(cache_path)
+    rows = {}
+    for index, iteration in enumerate(cache["iteration"]):
+        rows[int(iteration)] = {
+            "signature": cache["signature"][index],
+            "objective": cache["objective"][index],
+            "gradient_norm": cache["gradient_norm"][index],
+            "mvals": cache["mvals"][index][~np.isnan(cache["mvals"][index])],
+            "parameters": {
+                name: value
+                for name, value in zip(
+                    cache["parameter_names"], cache["parameters"][index]
+                )
+                if not np.isnan(value)
+            },
+            "systems": {
+                name: (value, uncertainty)
+                for name, value, uncertainty in zip(
+                    cache["system_names"],
+                    cache["dG"][index],
+                    cache["dG_uncertainty"][index],
+                )
+                if not np.isnan(value)
+            },
+        }
+    return rows
+
+
+def _to_columns(rows):
+    iterations = sorted(rows)
+    parameter_names = sorted(
+        {name for row in rows.values() for name in row["parameters"]}
+    )
+    system_names = sorted({name for row in rows.values() for name in row["systems"]})
+    n_mvals = max([len(row["mvals"]) for row in rows.values()], default=0)
+
+    history = {
+        "iteration": np.array(iterations, dtype=int),
+        "signature": np.array([rows[i]["signature"] for i in iterations], dtype=float),
+        "objective": np.array([rows[i]["objective"] for i in iterations], dtype=float),
+        "gradient_norm": np.array(
+            [rows[i]["gradient_norm"] for i in iterations], dtype=float
+        ),
+        "mvals": np.full((len(iterations), n_mvals), np.nan),
+        "parameter_names": np.array(parameter_names, dtype=str),
+        "parameters": np.full((len(iterations), len(parameter_names)), np.nan),
+        "system_names": np.array(system_names, dtype=str),
+        "dG": np.full((len(iterations), len(system_names)), np.nan),
+        "dG_uncertainty": np.full((len(iterations), len(system_names)), np.nan),
+    }
+    for index, iteration in enumerate(iterations):
+        row = rows[iteration]
+        history["mvals"][index, : len(row["mvals"])] = row["mvals"]
+        for column, name in enumerate(parameter_names):
+            history["parameters"][index, column] = row["parameters"].get(name, np.nan)
+        for column, name in enumerate(system_names):
+            value, uncertainty = row["systems"].get(name, (np.nan, np.nan))
+            history["dG"][index, column] = value
+            history["dG_uncertainty"][index, column] = uncertainty
+
+    return history
+
+
+def update_history(optimize_folder, cache_path="history.npz"):
+    # Only the iteration directories that are new or were modified since the
+    # last call are read again, the others come from the cache
+    rows = _load_cache(cache_path)
+    changed = False
+
+    folders = {
+        int(os.path.basename(folder_name).split("_")[-1]): folder_name
+        for folder_name in glob(os.path.join(optimize_folder, "iter_*"))
+    }
+    for iteration in list(rows):
+        if iteration not in folders:
+            del rows[iteration]
+            changed = True
+
+    for iteration, folder_name in folders.items():
+        signature = _signature(folder_name)
+        if iteration in rows and rows[iteration]["signature"] == signature:
+            continue
+
+        rows[iteration] = _read_iteration(folder_name)
+        rows[iteration]["signature"] = signature
+        changed = True
+
+    history = _to_columns(rows)
+    if changed and cache_path is not None:
+        np.savez(cache_path, **history)
+
+    return history
+
+
+def main():
+    history = update_history(sys.argv[1], *sys.argv[2:3])
+    for index, iteration in enumerate(history["iteration"]):
+        parameters = ", ".join(
+            f"{name} = {value:.4f}"
+            for name, value in zip(
+                history["parameter_names"], history["parameters"][index]
+            )
+        )
+        print(
+            f"iter {iteration:4d}  X = {history['objective'][index]:10.4f}  {parameters}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import platform
+import subprocess as sp
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+from bootstrap import (
+    bootstrap,
+    dG_bootstrap,
+    dH_bootstrap,
+    states_dG_bootstrap,
+    states_dH_bootstrap,
+)
+from evaluator_results import extract_results, ijson, read_results_table
+
+HOST_CODES = ["acd", "bcd", "cb7", "cb8", "oah", "oam"]
+
+
+def synthetic_data(n_systems, rng):
+    # Experimental and calculated binding free energies in kcal/mol
+    x = rng.normal(-5.0, 2.0, n_systems)
+    data = {
+        "x": x,
+        "x_sem": rng.uniform(0.1, 0.3, n_systems),
+        "y": x + rng.normal(0.5, 1.0, n_systems),
+        "y_sem": rng.uniform(0.2, 0.6, n_systems),
+        # Two binding orientations per system
+        "dG": x[:, None] + rng.normal(0.0, 0.5, (n_systems, 2)),
+        "dG_sem": rng.uniform(0.2, 0.6, (n_systems, 2)),
+        "dH": x[:, None] + rng.normal(-3.0, 1.0, (n_systems, 2)),
+        "dH_sem": rng.uniform(0.5, 1.5, (n_systems, 2)),
+    }
+    return data
+
+
+def write_synthetic_results(json_file, n_systems, rng, provenance_size=40000):
+    # Mimic the layout of an Evaluator RequestResult, including the large
+    # provenance and gradient payloads that dominate the file size
+    properties = []
+    for index in range(n_systems):
+        host = HOST_CODES[index % len(HOST_CODES)]
+        guest = f"g{index:04}"
+        properties.append(
+            {
+                "id": f"{index:032x}",
+                "value": {
+                    "value": float(rng.normal(-20.0, 8.0)),
+                    "unit": "kJ / mol",
+                    "@type": "openff.evaluator.unit.Quantity",
+                },
+                "uncertainty": {
+                    "value": float(rng.uniform(0.5, 2.0)),
+                    "unit": "kJ / mol",
+                    "@type": "openff.evaluator.unit.Quantity",
+                },
+                "source": {
+                    "fidelity": "SimulationLayer",
+                    "provenance": "x" * provenance_size,
+                    "@type": "openff.evaluator.datasets.provenance.CalculationSource",
+                },
+                "metadata": {
+                    "host_file_paths": {
+                        "host_mol2_path": f"/taproom/systems/{host}/{host}.mol2"
+                    },
+                    "guest_file_paths": {
+                        "guest_mol2_path": f"/taproom/systems/{host}/{guest}/{guest}.mol2"
+                    },
+                    "attach_lambdas": list(np.linspace(0.0, 1.0, 15)),
+                    "pull_windows_indices": list(range(46)),
+                },
+                "gradients": [
+                    {
+                        "key": {
+                            "tag": "GBSA",
+                            "smirks": smirks,
+                            "attribute": "radius",
+                            "@type": "openff.evaluator.forcefield.gradients.ParameterGradientKey",
+                        },
+                        "value": {
+                            "value": float(rng.normal(0.0, 500.0)),
+                            "unit": "kJ / mol / nm",
+                            "@type": "openff.evaluator.unit.Quantity",
+                        },
+                        "@type": "openff.evaluator.forcefield.gradients.ParameterGradient",
+                    }
+                    for smirks in [
+                        "[#1:1]",
+                        "[#1:1]~[#7]",
+                        "[#6:1]",
+                        "[#7:1]",
+                        "[#8:1]",
+                    ]
+                ],
+                "@type": "openff.evaluator.properties.binding.HostGuestBindingAffinity",
+            }
+        )
+
+    results = {
+        "queued_properties": {"properties": []},
+        "estimated_properties": {"properties": properties},
+        "unsuccessful_properties": {"properties": []},
+        "exceptions": [],
+        "@type": "openff.evaluator.client.client.RequestResult",
+    }
+    with open(json_file, "w") as file:
+        json.dump(results, file)
+
+
+def measure(function, *args, **kwargs):
+    # tracemalloc slows down every allocation, so the timing and the peak
+    # memory come from separate calls
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1024**2
+
+
+def legacy_dG_bootstrap(data, cycles):
+    # One call per system, as the analysis was written before batching
+    for dG, dG_sem in zip(data["dG"], data["dG_sem"]):
+        dG_bootstrap(dG[0], dG_sem[0], dG[1], dG_sem[1], cycles=cycles)
+
+
+def legacy_dH_bootstrap(data, cycles):
+    for dH, dH_sem, dG, dG_sem in zip(
+        data["dH"], data["dH_sem"], data["dG"], data["dG_sem"]
+    ):
+        dH_bootstrap(
+            dH[0],
+            dH_sem[0],
+            dH[1],
+            dH_sem[1],
+            dG[0],
+            dG_sem[0],
+            dG[1],
+            dG_sem[1],
+            cycles=cycles,
+        )
+
+
+def run_benchmarks(n_systems_list, cycles_list, repeats, seed):
+    rng = np.random.default_rng(seed)
+    records = []
+
+    def record(name, n_systems, n_cycles, function, *args, **kwargs):
+        # Keep the fastest of the repeats, and its peak memory
+        timings = [measure(function, *args, **kwargs) for _ in range(repeats)]
+        seconds, peak_memory = min(timings)
+        records.append(
+            {
+                "benchmark": name,
+                "n_systems": n_systems,
+                "cycles": n_cycles,
+                "seconds": seconds,
+                "cycles_per_second": n_cycles / seconds if n_cycles else None,
+                "systems_per_second": n_systems / seconds,
+                "peak_memory_mb": peak_memory,
+            }
+        )
+        print(
+            f"{name:>22} {n_systems:>6} systems {n_cycles:>8} cycles "
+            f"{seconds:>10.4f} s {peak_memory:>10.2f} MB"
+        )
+
+    for n_systems in n_systems_list:
+        data = synthetic_data(n_systems, rng)
+
+        for cycles in cycles_list:
+            record(
+                "bootstrap",
+                n_systems,
+                cycles,
+                bootstrap,
+                data["x"],
+                data["x_sem"],
+                data["y"],
+                data["y_sem"],
+                cycles=cycles,
+                seed=seed,
+            )
+            record(
+                "dG_bootstrap",
+                n_systems,
+                cycles,
+                legacy_dG_bootstrap,
+                data,
+                cycles,
+            )
+            record(
+                "states_dG_bootstrap",
+                n_systems,
+                cycles,
+                states_dG_bootstrap,
+                data["dG"],
+                data["dG_sem"],
+                cycles=cycles,
+                seed=seed,
+            )
+            record(
+                "dH_bootstrap",
+                n_systems,
+                cycles,
+                legacy_dH_bootstrap,
+                data,
+                cycles,
+            )
+            record(
+                "states_dH_bootstrap",
+                n_systems,
+                cycles,
+                states_dH_bootstrap,
+                data["dH"],
+                data["dH_sem"],
+                data["dG"],
+                data["dG_sem"],
+                cycles=cycles,
+                seed=seed,
+            )
+
+        # Extraction of the calculated values from an Evaluator results.json
+        with tempfile.TemporaryDirectory() as directory:
+            json_file = os.path.join(directory, "results.json")
+            write_synthetic_results(json_file, n_systems, rng)
+            file_size = os.path.getsize(json_file) / 1024**2
+
+            record("extract_results", n_systems, 0, extract_results, json_file)
+            records[-1]["file_size_mb"] = file_size
+            # Without ijson both would time json.load
+            if ijson is not None:
+                record(
+                    "read_results_streaming",
+                    n_systems,
+                    0,
+                    read_results_table,
+                    json_file,
+                    with_gradients=True,
+                    streaming=True,
+                )
+                records[-1]["file_size_mb"] = file_size
+            record(
+                "read_results_json",
+                n_systems,
+                0,
+                read_results_table,
+                json_file,
+                with_gradients=True,
+                streaming=False,
+            )
+            records[-1]["file_size_mb"] = file_size
+
+    return records
+
+
+def git_commit():
+    try:
+        return (
+            sp.check_output(["git", "rev-parse", "HEAD"], stderr=sp.DEVNULL)
+            .decode()
+            .strip()
+        )
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the bootstrap and result extraction analysis on synthetic data."
+    )
+    parser.add_argument("--n-systems", type=int, nargs="+", default=[6, 36, 150, 1000])
+    parser.add_argument("--cycles", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=2022)
+    parser.add_argument("--output", default="benchmark_analysis.json")
+    args = parser.parse_args()
+
+    records = run_benchmarks(args.n_systems, args.cycles, args.repeats, args.seed)
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.node(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "settings": vars(args),
+        "results": records,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,12 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-from tqdm import tqdm
 from scipy import stats
+from scipy.special import logsumexp, softmax
+
+R = 1.987204118e-3  # kcal/mol-K
+STATISTICS = ["slope", "intercept", "R", "R**2", "RMSE", "MSE", "MUE", "Tau"]
 
 
 def summarize(x, y):
@@ -28,116 +34,430 @@ def summarize(x, y):
     return summary_statistics
 
 
-def bootstrap(
-    x, x_sem, y, y_sem, cycles=1000, with_replacement=True, with_uncertainty=True
+def kendall_tau_batch(x, y, block_size=2**22):
+    # x is (rows, n) and y is (rows, n) or (..., rows, n), e.g. several
+    # force fields evaluated against the same resampled x
+    n_samples = x.shape[-1]
+    n_rows = x.shape[-2]
+    i, j = np.triu_indices(n_samples, k=1)
+    tau = np.empty(np.broadcast_shapes(x.shape, y.shape)[:-1])
+
+    # Tau-b from the signs of all pairwise differences, with the rows
+    # processed in blocks so that the (rows, pairs) arrays stay bounded
+    rows_per_block = max(1, block_size // max(1, len(i) * (y.size // x.size)))
+    for start in range(0, n_rows, rows_per_block):
+        rows = slice(start, start + rows_per_block)
+        block_x = x[..., rows, :]
+        block_y = y[..., rows, :]
+        sign_x = np.sign(block_x[..., j] - block_x[..., i]).astype(np.int8)
+        sign_y = np.sign(block_y[..., j] - block_y[..., i]).astype(np.int8)
+
+        concordance = np.sum(sign_x * sign_y, axis=-1, dtype=np.int64)
+        untied_x = np.sum(sign_x != 0, axis=-1, dtype=np.int64)
+        untied_y = np.sum(sign_y != 0, axis=-1, dtype=np.int64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tau[..., rows] = concordance / np.sqrt(untied_x * untied_y)
+
+    return tau
+
+
+def summarize_batch(x, y):
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+
+    summary_statistics = np.empty(np.broadcast_shapes(x.shape, y.shape)[:-1] + (8,))
+
+    # Slope, intercept, R from the centered moments of each row
+    x_mean = np.mean(x, axis=-1)
+    y_mean = np.mean(y, axis=-1)
+    x_centered = x - x_mean[..., None]
+    y_centered = y - y_mean[..., None]
+    ss_xx = np.sum(x_centered**2, axis=-1)
+    ss_yy = np.sum(y_centered**2, axis=-1)
+    ss_xy = np.sum(x_centered * y_centered, axis=-1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        summary_statistics[..., 0] = ss_xy / ss_xx
+        summary_statistics[..., 2] = np.clip(ss_xy / np.sqrt(ss_xx * ss_yy), -1.0, 1.0)
+    summary_statistics[..., 1] = y_mean - summary_statistics[..., 0] * x_mean
+    # R**2
+    summary_statistics[..., 3] = summary_statistics[..., 2] ** 2
+    # RMSE
+    summary_statistics[..., 4] = np.sqrt(np.mean((y - x) ** 2, axis=-1))
+    # MSE
+    summary_statistics[..., 5] = np.mean(y - x, axis=-1)
+    # MUE
+    summary_statistics[..., 6] = np.mean(np.absolute(y - x), axis=-1)
+    # Tau
+    summary_statistics[..., 7] = kendall_tau_batch(x, y)
+
+    return summary_statistics
+
+
+def _resample_indices(n_samples, cycles, with_replacement, rng):
+    # Draw the indices of every cycle at once
+    if with_replacement:
+        return rng.integers(n_samples, size=(cycles, n_samples))
+    return np.broadcast_to(np.arange(n_samples), (cycles, n_samples))
+
+
+def resample(
+    x,
+    x_sem,
+    y,
+    y_sem,
+    cycles,
+    with_replacement=True,
+    with_uncertainty=True,
+    rng=None,
 ):
-    summary_statistics = np.empty((cycles, 8))
-    for cycle in range(cycles):
-        new_x = np.empty_like(x)
-        new_y = np.empty_like(y)
-        for index in range(len(x)):
-            if with_replacement:
-                j = np.random.randint(len(x))
-            else:
-                j = index
-            if with_uncertainty and x_sem is not None:
-                new_x[index] = np.random.normal(x[j], x_sem[j])
-            elif with_uncertainty and x_sem is None:
-                new_x[index] = x[j]
-            if with_uncertainty and y_sem is not None:
-                new_y[index] = np.random.normal(y[j], y_sem[j])
-            elif with_uncertainty and y_sem is None:
-                new_y[index] = y[j]
-        summary_statistics[cycle] = summarize(new_x, new_y)
-
-    ci = np.empty((8, 2))
-    for statistic in range(8):
-        sorted_statistic = np.sort(summary_statistics[:, statistic])
-        ci[statistic][0] = sorted_statistic[int(0.025 * cycles)]
-        ci[statistic][1] = sorted_statistic[int(0.975 * cycles)]
+    if rng is None:
+        rng = np.random.default_rng()
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    indices = _resample_indices(len(x), cycles, with_replacement, rng)
+
+    new_x = x[indices]
+    new_y = y[indices]
+
+    # Add noise from the uncertainties of the resampled points
+    if with_uncertainty and x_sem is not None:
+        new_x = rng.normal(new_x, np.asarray(x_sem, dtype=float)[indices])
+    if with_uncertainty and y_sem is not None:
+        new_y = rng.normal(new_y, np.asarray(y_sem, dtype=float)[indices])
 
+    return new_x, new_y
+
+
+def _single_kernel(arguments, cycles, rng):
+    x, x_sem, y, y_sem, with_replacement, with_uncertainty = arguments
+    new_x, new_y = resample(
+        x,
+        x_sem,
+        y,
+        y_sem,
+        cycles,
+        with_replacement=with_replacement,
+        with_uncertainty=with_uncertainty,
+        rng=rng,
+    )
+    return summarize_batch(new_x, new_y)
+
+
+def _paired_kernel(arguments, cycles, rng):
+    x, x_sem, y, y_sem, reference, with_replacement, with_uncertainty = arguments
+
+    # The same resampled systems and experimental draws for every force field
+    indices = _resample_indices(len(x), cycles, with_replacement, rng)
+    new_x = x[indices]
+    new_y = y[:, indices]
+    if with_uncertainty and x_sem is not None:
+        new_x = rng.normal(new_x, x_sem[indices])
+    if with_uncertainty and y_sem is not None:
+        new_y = rng.normal(new_y, y_sem[:, indices])
+
+    # (cycles, force fields, statistics) and the differences to the reference
+    statistics = np.moveaxis(summarize_batch(new_x, new_y), 0, 1)
+    deltas = statistics - statistics[:, [reference]]
+    return np.concatenate([statistics, deltas], axis=1)
+
+
+def _tails(values, n_low, n_high):
+    # Smallest n_low and largest n_high values of each column
+    low, high = values, values
+    if len(values) > n_low:
+        low = np.partition(values, n_low - 1, axis=0)[:n_low]
+    if len(values) > n_high:
+        high = np.partition(values, len(values) - n_high, axis=0)[-n_high:]
+    return low, high
+
+
+def _bootstrap_blocks(kernel, arguments, blocks, n_low, n_high):
+    # Each block of cycles has its own random stream so that the result does
+    # not depend on how the blocks are distributed over the workers
+    moments = []
+    block_statistics = []
+    for block_index, block_cycles, seed in blocks:
+        statistics = kernel(arguments, block_cycles, np.random.default_rng(seed))
+        mean = np.mean(statistics, axis=0)
+        m2 = np.sum((statistics - mean) ** 2, axis=0)
+        moments.append((block_index, block_cycles, mean, m2))
+        block_statistics.append(statistics)
+
+    # Only the moments and the tails needed for the CI are sent back
+    low, high = _tails(np.concatenate(block_statistics), n_low, n_high)
+    return moments, low, high
+
+
+def _merge_blocks(partials, cycles, n_high):
+    moments = sorted(
+        (moment for partial in partials for moment in partial[0]),
+        key=lambda moment: moment[0],
+    )
+
+    # Combine the block means and sums of squares in block order
+    count = 0
+    mean = np.zeros_like(moments[0][2])
+    m2 = np.zeros_like(moments[0][3])
+    for _, block_cycles, block_mean, block_m2 in moments:
+        total = count + block_cycles
+        delta = block_mean - mean
+        mean = mean + delta * block_cycles / total
+        m2 = m2 + block_m2 + delta**2 * count * block_cycles / total
+        count = total
+
+    low = np.sort(np.concatenate([partial[1] for partial in partials]), axis=0)
+    high = np.sort(np.concatenate([partial[2] for partial in partials]), axis=0)
+    ci_low = low[int(0.025 * cycles)]
+    ci_high = high[len(high) - n_high]
+
+    return mean, np.sqrt(m2 / cycles), ci_low, ci_high
+
+
+def _run_blocks(kernel, arguments, cycles, chunk_size, seed, n_workers):
+    # Split the cycles into blocks of chunk_size, which also bounds the memory
+    # of the (cycles, n) resample arrays, each seeded from one SeedSequence
+    block_sizes = [
+        min(chunk_size, cycles - start) for start in range(0, cycles, chunk_size)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(block_sizes))
+    blocks = list(zip(range(len(block_sizes)), block_sizes, seeds))
+
+    n_low = int(0.025 * cycles) + 1
+    n_high = cycles - int(0.975 * cycles)
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if n_workers > 1:
+        tasks = np.array_split(np.arange(len(blocks)), min(n_workers, len(blocks)))
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = [
+                executor.submit(
+                    _bootstrap_blocks,
+                    kernel,
+                    arguments,
+                    [blocks[index] for index in task],
+                    n_low,
+                    n_high,
+                )
+                for task in tasks
+            ]
+            partials = [future.result() for future in futures]
+    else:
+        partials = [_bootstrap_blocks(kernel, arguments, blocks, n_low, n_high)]
+
+    return _merge_blocks(partials, cycles, n_high)
+
+
+def _format_results(mean, sem, ci_low, ci_high):
     results = {
-        "mean": {
-            "slope": np.mean(summary_statistics[:, 0]),
-            "intercept": np.mean(summary_statistics[:, 1]),
-            "R": np.mean(summary_statistics[:, 2]),
-            "R**2": np.mean(summary_statistics[:, 3]),
-            "RMSE": np.mean(summary_statistics[:, 4]),
-            "MSE": np.mean(summary_statistics[:, 5]),
-            "MUE": np.mean(summary_statistics[:, 6]),
-            "Tau": np.mean(summary_statistics[:, 7]),
-        },
-        "sem": {
-            "slope": np.std(summary_statistics[:, 0]),
-            "intercept": np.std(summary_statistics[:, 1]),
-            "R": np.std(summary_statistics[:, 2]),
-            "R**2": np.std(summary_statistics[:, 3]),
-            "RMSE": np.std(summary_statistics[:, 4]),
-            "MSE": np.std(summary_statistics[:, 5]),
-            "MUE": np.std(summary_statistics[:, 6]),
-            "Tau": np.std(summary_statistics[:, 7]),
-        },
-        "ci_low": {
-            "slope": ci[0][0],
-            "intercept": ci[1][0],
-            "R": ci[2][0],
-            "R**2": ci[3][0],
-            "RMSE": ci[4][0],
-            "MSE": ci[5][0],
-            "MUE": ci[6][0],
-            "Tau": ci[7][0],
-        },
-        "ci_high": {
-            "slope": ci[0][1],
-            "intercept": ci[1][1],
-            "R": ci[2][1],
-            "R**2": ci[3][1],
-            "RMSE": ci[4][1],
-            "MSE": ci[5][1],
-            "MUE": ci[6][1],
-            "Tau": ci[7][1],
-        },
+        "mean": dict(zip(STATISTICS, mean)),
+        "sem": dict(zip(STATISTICS, sem)),
+        "ci_low": dict(zip(STATISTICS, ci_low)),
+        "ci_high": dict(zip(STATISTICS, ci_high)),
     }
     return results
 
 
-def dG_bootstrap(
-    x, x_sem, y, y_sem, cycles=1000, with_replacement=True, with_uncertainty=True
+def bootstrap(
+    x,
+    x_sem,
+    y,
+    y_sem,
+    cycles=1000,
+    with_replacement=True,
+    with_uncertainty=True,
+    chunk_size=10000,
+    seed=None,
+    n_workers=1,
+):
+    arguments = (x, x_sem, y, y_sem, with_replacement, with_uncertainty)
+    mean, sem, ci_low, ci_high = _run_blocks(
+        _single_kernel, arguments, cycles, chunk_size, seed, n_workers
+    )
+    return _format_results(mean, sem, ci_low, ci_high)
+
+
+def paired_bootstrap(
+    x,
+    x_sem,
+    y,
+    y_sem,
+    cycles=1000,
+    with_replacement=True,
+    with_uncertainty=True,
+    reference=None,
+    chunk_size=10000,
+    seed=None,
+    n_workers=1,
 ):
-    summary_statistics = np.empty((cycles))
-    R = 1.987204118e-3  # kcal/mol-K
-    temperature = 300  # K
+    # y and y_sem are dictionaries of force field name -> calculated values
+    names = list(y)
+    if reference is None:
+        reference = names[0]
+
+    x = np.asarray(x, dtype=float)
+    if x_sem is not None:
+        x_sem = np.asarray(x_sem, dtype=float)
+    y_values = np.array([y[name] for name in names], dtype=float)
+    y_sem_values = None
+    if y_sem is not None:
+        y_sem_values = np.array(
+            [
+                np.zeros(len(x)) if y_sem.get(name) is None else y_sem[name]
+                for name in names
+            ],
+            dtype=float,
+        )
+
+    arguments = (
+        x,
+        x_sem,
+        y_values,
+        y_sem_values,
+        names.index(reference),
+        with_replacement,
+        with_uncertainty,
+    )
+    mean, sem, ci_low, ci_high = _run_blocks(
+        _paired_kernel, arguments, cycles, chunk_size, seed, n_workers
+    )
+
+    results = {"reference": reference, "statistics": {}, "delta": {}}
+    for index, name in enumerate(names):
+        results["statistics"][name] = _format_results(
+            mean[index], sem[index], ci_low[index], ci_high[index]
+        )
+        if name == reference:
+            continue
+
+        # Differences (force field - reference) evaluated on the same resamples
+        delta = index + len(names)
+        results["delta"][name] = _format_results(
+            mean[delta], sem[delta], ci_low[delta], ci_high[delta]
+        )
+
+    return results
+
+
+def combine_free_energies(dG, temperature=300.0):
+    beta = 1.0 / (R * temperature)
+
+    # Combine the states along the last axis with log-sum-exp
+    return -logsumexp(-beta * np.asarray(dG, dtype=float), axis=-1) / beta
+
+
+def combine_enthalpies(dH, dG, temperature=300.0):
     beta = 1.0 / (R * temperature)
 
-    for cycle in tqdm(range(cycles)):
-        new_x = np.empty_like(x)
-        new_y = np.empty_like(y)
-
-        if with_uncertainty and x_sem is not None:
-            new_x = np.random.normal(x, x_sem)
-        elif with_uncertainty and x_sem is None:
-            new_x = x
-        if with_uncertainty and y_sem is not None:
-            new_y = np.random.normal(y, y_sem)
-        elif with_uncertainty and y_sem is None:
-            new_y = y
-        summary_statistics[cycle] = (
-            -R * temperature * np.log(np.exp(-beta * new_x) + np.exp(-beta * new_y))
+    # Boltzmann weights of the states along the last axis
+    weights = softmax(-beta * np.asarray(dG, dtype=float), axis=-1)
+    return np.sum(weights * np.asarray(dH, dtype=float), axis=-1)
+
+
+def _perturb(value, value_sem, cycles, with_uncertainty, rng):
+    value = np.asarray(value, dtype=float)
+    if with_uncertainty and value_sem is not None:
+        return rng.normal(
+            value, np.asarray(value_sem, dtype=float), size=(cycles,) + value.shape
         )
+    return np.broadcast_to(value, (cycles,) + value.shape)
+
+
+def _collect_state_results(summary_statistics):
+    cycles = len(summary_statistics)
 
-        sorted_statistic = np.sort(summary_statistics)
-        ci = np.empty((2))
-        ci[0] = sorted_statistic[int(0.025 * cycles)]
-        ci[1] = sorted_statistic[int(0.975 * cycles)]
+    sorted_statistic = np.sort(summary_statistics, axis=0)
+    ci = np.stack(
+        [
+            sorted_statistic[int(0.025 * cycles)],
+            sorted_statistic[int(0.975 * cycles)],
+        ],
+        axis=-1,
+    )
 
     results = {
-        "mean": np.mean(summary_statistics),
-        "sem": np.std(summary_statistics),
+        "mean": np.mean(summary_statistics, axis=0),
+        "sem": np.std(summary_statistics, axis=0),
         "ci": ci,
     }
     return results
 
 
+def states_dG_bootstrap(
+    dG,
+    dG_sem,
+    cycles=1000,
+    with_uncertainty=True,
+    temperature=300.0,
+    chunk_size=10000,
+    seed=None,
+):
+    # dG is (n_states,) for one system or (n_systems, n_states) for a data set
+    dG = np.asarray(dG, dtype=float)
+    summary_statistics = np.empty((cycles,) + dG.shape[:-1])
+    rng = np.random.default_rng(seed)
+
+    for start in range(0, cycles, chunk_size):
+        stop = min(start + chunk_size, cycles)
+        new_dG = _perturb(dG, dG_sem, stop - start, with_uncertainty, rng)
+        summary_statistics[start:stop] = combine_free_energies(new_dG, temperature)
+
+    return _collect_state_results(summary_statistics)
+
+
+def states_dH_bootstrap(
+    dH,
+    dH_sem,
+    dG,
+    dG_sem,
+    cycles=1000,
+    with_uncertainty=True,
+    temperature=300.0,
+    chunk_size=10000,
+    seed=None,
+):
+    dH = np.asarray(dH, dtype=float)
+    summary_statistics = np.empty((cycles,) + dH.shape[:-1])
+    rng = np.random.default_rng(seed)
+
+    for start in range(0, cycles, chunk_size):
+        stop = min(start + chunk_size, cycles)
+        new_dH = _perturb(dH, dH_sem, stop - start, with_uncertainty, rng)
+        new_dG = _perturb(dG, dG_sem, stop - start, with_uncertainty, rng)
+        summary_statistics[start:stop] = combine_enthalpies(new_dH, new_dG, temperature)
+
+    return _collect_state_results(summary_statistics)
+
+
+def _stack_states(x, y):
+    if x is None:
+        return None
+    return np.stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)], axis=-1)
+
+
+def dG_bootstrap(
+    x, x_sem, y, y_sem, cycles=1000, with_replacement=True, with_uncertainty=True
+):
+    # Two orientations, kept for backwards compatibility
+    dG_sem = None
+    if x_sem is not None or y_sem is not None:
+        dG_sem = _stack_states(
+            np.zeros_like(x) if x_sem is None else x_sem,
+            np.zeros_like(y) if y_sem is None else y_sem,
+        )
+
+    return states_dG_bootstrap(
+        _stack_states(x, y),
+        dG_sem,
+        cycles=cycles,
+        with_uncertainty=with_uncertainty,
+    )
+
+
 def dH_bootstrap(
     dH_x,
     dH_x_sem,
@@ -151,50 +471,25 @@ def dH_bootstrap(
     with_replacement=True,
     with_uncertainty=True,
 ):
-    summary_statistics = np.empty((cycles))
-    R = 1.987204118e-3  # kcal/mol-K
-    temperature = 300  # K
-    beta = 1.0 / (R * temperature)
-
-    for cycle in tqdm(range(cycles)):
-        new_dH_x = np.empty_like(dH_x)
-        new_dH_y = np.empty_like(dH_y)
-
-        new_dG_x = np.empty_like(dG_x)
-        new_dG_y = np.empty_like(dG_y)
-
-        # Resample dH
-        if with_uncertainty and dH_x_sem is not None:
-            new_dH_x = np.random.normal(dH_x, dH_x_sem)
-        elif with_uncertainty and dH_x_sem is None:
-            new_dH_x = dH_x
-        if with_uncertainty and dH_y_sem is not None:
-            new_dH_y = np.random.normal(dH_y, dH_y_sem)
-        elif with_uncertainty and dH_y_sem is None:
-            new_dH_y = dH_y
-
-        # Resample dG
-        if with_uncertainty and dG_x_sem is not None:
-            new_dG_x = np.random.normal(dG_x, dG_x_sem)
-        elif with_uncertainty and dG_x_sem is None:
-            new_dG_x = dG_x
-        if with_uncertainty and dG_y_sem is not None:
-            new_dG_y = np.random.normal(dG_y, dG_y_sem)
-        elif with_uncertainty and dG_y_sem is None:
-            new_dG_y = dG_y
-
-        summary_statistics[cycle] = (
-            new_dH_x * np.exp(-beta * new_dG_x) + new_dH_y * np.exp(-beta * new_dG_y)
-        ) / (np.exp(-beta * new_dG_x) + np.exp(-beta * new_dG_y))
-
-    sorted_statistic = np.sort(summary_statistics)
-    ci = np.empty((2))
-    ci[0] = sorted_statistic[int(0.025 * cycles)]
-    ci[1] = sorted_statistic[int(0.975 * cycles)]
+    # Two orientations, kept for backwards compatibility
+    dH_sem = None
+    if dH_x_sem is not None or dH_y_sem is not None:
+        dH_sem = _stack_states(
+            np.zeros_like(dH_x) if dH_x_sem is None else dH_x_sem,
+            np.zeros_like(dH_y) if dH_y_sem is None else dH_y_sem,
+        )
+    dG_sem = None
+    if dG_x_sem is not None or dG_y_sem is not None:
+        dG_sem = _stack_states(
+            np.zeros_like(dG_x) if dG_x_sem is None else dG_x_sem,
+            np.zeros_like(dG_y) if dG_y_sem is None else dG_y_sem,
+        )
 
-    results = {
-        "mean": np.mean(summary_statistics),
-        "sem": np.std(summary_statistics),
-        "ci": ci,
-    }
-    return results
+    return states_dH_bootstrap(
+        _stack_states(dH_x, dH_y),
+        dH_sem,
+        _stack_states(dG_x, dG_y),
+        dG_sem,
+        cycles=cycles,
+        with_uncertainty=with_uncertainty,
+    )
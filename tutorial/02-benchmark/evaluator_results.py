@@ -0,0 +1,15 @@
+import os
+import sys
+
+# The reader is shared with 01-optimization/fb_history.py and is in the
+# tutorial folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from results_reader import (  # noqa: E402, F401
+    convert_units,
+    energy_unit,
+    extract_results,
+    gradient_unit,
+    ijson,
+    read_results_table,
+    table_by_system,
+)
@@ -1,8 +1,7 @@
 import os
+import sys
 
 from openff.units import unit
-from openff.evaluator.backends import ComputeResources
-from openff.evaluator.backends.dask import DaskLocalCluster
 from openff.evaluator.client import ConnectionOptions, EvaluatorClient, RequestOptions
 from openff.evaluator.datasets.taproom import TaproomDataSet
 from openff.evaluator.forcefield import SmirnoffForceFieldSource
@@ -12,7 +11,11 @@ from openff.evaluator.server import EvaluatorServer
 from openff.evaluator.utils import setup_timestamp_logging
 from openff.toolkit.typing.engines.smirnoff import ForceField
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0,1,2,3"
+# local_backend.py is in the tutorial folder
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir)
+)
+from local_backend import create_backend  # noqa: E402
 
 
 def main():
@@ -53,15 +56,9 @@ def main():
         "SimulationLayer", "HostGuestBindingAffinity", host_guest_schema
     )
 
-    # Create Pool of Dask Workers
-    calculation_backend = DaskLocalCluster(
-        number_of_workers=4,
-        resources_per_worker=ComputeResources(
-            number_of_threads=1,
-            number_of_gpus=1,
-            preferred_gpu_toolkit=ComputeResources.GPUToolkit.CUDA,
-        ),
-    )
+    # Create Pool of Dask Workers, one per GPU or, on CPU only nodes, as many
+    # windows per node as the calibration found fastest
+    calculation_backend = create_backend(memory_per_window=2 * unit.gigabyte)
     calculation_backend.start()
 
     # Start the Evaluator Server
@@ -0,0 +1,187 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+from openff.evaluator.backends import ComputeResources
+from openff.evaluator.backends.dask import DaskLocalCluster
+from openff.units import unit
+
+try:
+    import openmm
+except ImportError:
+    from simtk import openmm
+
+# A host-guest complex in implicit solvent has about 150-250 atoms
+CALIBRATION_ATOMS = 200
+
+
+def available_resources():
+    # The cores of this job (the SLURM cpuset if there is one), its memory and
+    # the visible GPUs
+    if hasattr(os, "sched_getaffinity"):
+        n_cores = len(os.sched_getaffinity(0))
+    else:
+        n_cores = os.cpu_count()
+
+    if "SLURM_MEM_PER_NODE" in os.environ:
+        memory = int(os.environ["SLURM_MEM_PER_NODE"]) * unit.megabyte
+    else:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * unit.byte
+
+    gpus = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if gpus is None:
+        n_gpus = _count_cuda_devices()
+    else:
+        n_gpus = len([gpu for gpu in gpus.split(",") if gpu.strip() not in ("", "-1")])
+
+    return n_cores, memory.to(unit.gigabyte), n_gpus
+
+
+def _count_cuda_devices():
+    try:
+        output = subprocess.check_output(["nvidia-smi", "-L"], text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    return len([line for line in output.splitlines() if line.startswith("GPU")])
+
+
+def _calibration_system(n_atoms):
+    # A compact cluster of charged Lennard-Jones particles with an OBC GB
+    # force, a stand-in for a host-guest complex in implicit solvent
+    system = openmm.System()
+    nonbonded = openmm.NonbondedForce()
+    nonbonded.setNonbondedMethod(openmm.NonbondedForce.NoCutoff)
+    gbsa = openmm.GBSAOBCForce()
+    gbsa.setNonbondedMethod(openmm.GBSAOBCForce.NoCutoff)
+
+    n_side = int(np.ceil(n_atoms ** (1 / 3)))
+    positions = []
+    for index in range(n_atoms):
+        charge = 0.2 if index % 2 == 0 else -0.2
+        system.addParticle(12.0)
+        nonbonded.addParticle(charge, 0.3, 0.5)
+        gbsa.addParticle(charge, 0.17, 0.8)
+        positions.append(
+            openmm.Vec3(index % n_side, (index // n_side) % n_side, index // n_side**2)
+            * 0.4
+        )
+
+    system.addForce(nonbonded)
+    system.addForce(gbsa)
+    return system, positions
+
+
+def _run_window(arguments):
+    # Steps per second of one window with the given number of CPU threads
+    n_threads, n_atoms, duration = arguments
+    system, positions = _calibration_system(n_atoms)
+    integrator = openmm.LangevinIntegrator(300.0, 1.0, 0.001)
+    platform = openmm.Platform.getPlatformByName("CPU")
+    context = openmm.Context(system, integrator, platform, {"Threads": str(n_threads)})
+    context.setPositions(positions)
+    openmm.LocalEnergyMinimizer.minimize(context, 10.0, 100)
+    integrator.step(100)
+
+    steps, start = 0, time.perf_counter()
+    while time.perf_counter() - start < duration:
+        integrator.step(100)
+        steps += 100
+    return steps / (time.perf_counter() - start)
+
+
+def calibrate(n_cores, max_windows=None, n_atoms=CALIBRATION_ATOMS, duration=10.0):
+    # Runs the windows of each threads per window split at the same time and
+    # returns {threads per window: total steps per second}
+    if max_windows is None:
+        max_windows = n_cores
+
+    splits = sorted(
+        {
+            n_threads
+            for n_threads in [2**power for power in range(n_cores.bit_length())]
+            + [n_cores]
+            if n_cores // n_threads <= max_windows
+        }
+        | {int(np.ceil(n_cores / max_windows))}
+    )
+
+    throughput = {}
+    context = multiprocessing.get_context("spawn")
+    for n_threads in splits:
+        n_windows = min(max_windows, n_cores // n_threads)
+        with context.Pool(n_windows) as pool:
+            rates = pool.map(_run_window, [(n_threads, n_atoms, duration)] * n_windows)
+        throughput[n_threads] = float(np.sum(rates))
+
+    return throughput
+
+
+def local_resources(
+    memory_per_window=2 * unit.gigabyte,
+    calibration_path="calibration.json",
+    use_gpus=True,
+):
+    # The number of workers and the ComputeResources of each: one worker per
+    # GPU when there are GPUs, otherwise the CPU split with the most total
+    # steps per second that fits in memory
+    n_cores, memory, n_gpus = available_resources()
+
+    if use_gpus and n_gpus > 0:
+        return n_gpus, ComputeResources(
+            number_of_threads=1,
+            number_of_gpus=1,
+            preferred_gpu_toolkit=ComputeResources.GPUToolkit.CUDA,
+        )
+
+    max_windows = max(1, int((memory / memory_per_window).m_as(unit.dimensionless)))
+
+    # The calibration is kept for the next run on the same kind of node
+    calibration = {}
+    if calibration_path is not None and os.path.isfile(calibration_path):
+        with open(calibration_path) as file:
+            calibration = json.load(file)
+    node_key = f"{n_cores} cores, {max_windows} windows"
+
+    if node_key not in calibration:
+        calibration[node_key] = calibrate(n_cores, max_windows)
+        if calibration_path is not None:
+            with open(calibration_path, "w") as file:
+                json.dump(calibration, file, indent=2)
+
+    throughput = {int(key): value for key, value in calibration[node_key].items()}
+    n_threads = max(throughput, key=throughput.get)
+    n_workers = min(max_windows, n_cores // n_threads)
+
+    return n_workers, ComputeResources(number_of_threads=n_threads, number_of_gpus=0)
+
+
+def create_backend(**kwargs):
+    # A DaskLocalCluster sized for the resources of this node, see
+    # local_resources for the options
+    n_workers, resources = local_resources(**kwargs)
+    return DaskLocalCluster(number_of_workers=n_workers, resources_per_worker=resources)
+
+
+def main():
+    # python local_backend.py [memory per window in GB]
+    memory_per_window = float(sys.argv[1]) if len(sys.argv) > 1 else 2.0
+    n_cores, memory, n_gpus = available_resources()
+    print(f"{n_cores} cores, {memory:.1f}, {n_gpus} GPUs")
+
+    max_windows = max(
+        1, int((memory / (memory_per_window * unit.gigabyte)).m_as(unit.dimensionless))
+    )
+    for n_threads, steps in calibrate(n_cores, max_windows).items():
+        n_windows = min(max_windows, n_cores // n_threads)
+        print(
+            f"{n_windows:>4} windows x {n_threads:>3} threads: "
+            f"{steps:10.1f} steps/s in total"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import json
+import warnings
+
+import numpy as np
+from openff.units import unit as openff_unit
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+energy_unit = openff_unit.kcal / openff_unit.mole
+# Gradients are reported per these parameter units, by dimensionality.
+# Angles are dimensionless in pint and are recognised by name instead.
+PARAMETER_UNITS = [
+    openff_unit.angstrom,
+    openff_unit.kcal / openff_unit.mole,
+    openff_unit.dimensionless,
+]
+ANGLE_UNITS = ("radian", "degree")
+
+PROPERTY_PREFIX = "estimated_properties.properties.item"
+
+
+def _system_name(file_path):
+    return file_path.split("/")[-1].split(".")[0]
+
+
+def _gradient_entry(tag, smirks, attribute, value, unit):
+    return "/".join([tag, smirks, attribute]), value, unit
+
+
+def _new_record():
+    return {
+        "host": None,
+        "guest": None,
+        "value": None,
+        "value_unit": None,
+        "uncertainty": None,
+        "uncertainty_unit": None,
+        "gradients": [],
+    }
+
+
+def _stream_records(file, with_gradients):
+    # Walk the parser events and only keep the few fields we need, so the
+    # provenance and metadata payloads are never built into Python objects
+    fields = {
+        f"{PROPERTY_PREFIX}.value.value": "value",
+        f"{PROPERTY_PREFIX}.value.unit": "value_unit",
+        f"{PROPERTY_PREFIX}.uncertainty.value": "uncertainty",
+        f"{PROPERTY_PREFIX}.uncertainty.unit": "uncertainty_unit",
+    }
+    host_path = f"{PROPERTY_PREFIX}.metadata.host_file_paths.host_mol2_path"
+    guest_path = f"{PROPERTY_PREFIX}.metadata.guest_file_paths.guest_mol2_path"
+    gradient_prefix = f"{PROPERTY_PREFIX}.gradients.item"
+
+    record, gradient = None, None
+    for prefix, event, value in ijson.parse(file, use_float=True):
+        if prefix == PROPERTY_PREFIX:
+            if event == "start_map":
+                record = _new_record()
+            elif event == "end_map":
+                yield record
+                record = None
+        elif record is None:
+            continue
+        elif prefix in fields:
+            record[fields[prefix]] = value
+        elif prefix == host_path:
+            record["host"] = _system_name(value)
+        elif prefix == guest_path:
+            record["guest"] = _system_name(value)
+        elif with_gradients and prefix.startswith(gradient_prefix):
+            if prefix == gradient_prefix and event == "start_map":
+                gradient = {}
+            elif prefix == gradient_prefix and event == "end_map":
+                record["gradients"].append(
+                    _gradient_entry(
+                        gradient["key.tag"],
+                        gradient["key.smirks"],
+                        gradient["key.attribute"],
+                        gradient["value.value"],
+                        gradient["value.unit"],
+                    )
+                )
+            elif event in ("string", "number"):
+                gradient[prefix[len(gradient_prefix) + 1 :]] = value
+
+
+def _load_records(file, with_gradients):
+    results = json.load(file)
+    for prop in results["estimated_properties"]["properties"]:
+        record = _new_record()
+        record["value"] = prop["value"]["value"]
+        record["value_unit"] = prop["value"]["unit"]
+        record["uncertainty"] = prop["uncertainty"]["value"]
+        record["uncertainty_unit"] = prop["uncertainty"]["unit"]
+
+        metadata = prop.get("metadata", {})
+        if "host_file_paths" in metadata:
+            record["host"] = _system_name(metadata["host_file_paths"]["host_mol2_path"])
+        if "guest_file_paths" in metadata:
+            record["guest"] = _system_name(
+                metadata["guest_file_paths"]["guest_mol2_path"]
+            )
+
+        if with_gradients:
+            for gradient in prop.get("gradients", []):
+                record["gradients"].append(
+                    _gradient_entry(
+                        gradient["key"]["tag"],
+                        gradient["key"]["smirks"],
+                        gradient["key"]["attribute"],
+                        gradient["value"]["value"],
+                        gradient["value"]["unit"],
+                    )
+                )
+
+        yield record
+
+
+def convert_units(values, units, target_unit):
+    # One Quantity per distinct unit string, then scale all values at once
+    values = np.asarray(values, dtype=float)
+    units = np.asarray(units, dtype=object)
+    converted = np.empty_like(values)
+    for unit_string in set(units):
+        mask = units == unit_string
+        factor = openff_unit.Quantity(1.0, units=unit_string).to(target_unit).magnitude
+        converted[mask] = values[mask] * factor
+    return converted
+
+
+def gradient_unit(unit_string):
+    # kcal/mol per the preferred unit of the parameter, e.g. kcal/mol/Å for a
+    # gradient in kJ/mol/nm, or the unit itself for other parameters
+    if any(name in unit_string for name in ANGLE_UNITS):
+        return energy_unit / openff_unit.degree
+
+    parameter_unit = (
+        openff_unit.Quantity(1.0, energy_unit)
+        / openff_unit.Quantity(1.0, units=unit_string)
+    ).units
+    for preferred_unit in PARAMETER_UNITS:
+        if parameter_unit.dimensionality == preferred_unit.dimensionality:
+            return energy_unit / preferred_unit
+    return openff_unit.Unit(unit_string)
+
+
+def read_results_table(json_file, with_gradients=False, streaming=True):
+    # Streaming keeps the memory bounded for large result files, as only the
+    # needed fields are built. streaming=False uses the C json parser, which
+    # is faster for small files.
+    if streaming and ijson is None:
+        warnings.warn(
+            "ijson is not installed, the whole results file is loaded with json."
+        )
+        streaming = False
+
+    with open(json_file, "rb") as file:
+        if streaming:
+            records = list(_stream_records(file, with_gradients))
+        else:
+            records = list(_load_records(file, with_gradients))
+
+    table = {
+        "host": np.array([record["host"] for record in records], dtype=object),
+        "guest": np.array([record["guest"] for record in records], dtype=object),
+        "value": convert_units(
+            [record["value"] for record in records],
+            [record["value_unit"] for record in records],
+            energy_unit,
+        ),
+        "uncertainty": convert_units(
+            [record["uncertainty"] for record in records],
+            [record["uncertainty_unit"] for record in records],
+            energy_unit,
+        ),
+    }
+
+    if with_gradients:
+        # One column per parameter, NaN where a property has no such gradient
+        keys = sorted({key for record in records for key, _, _ in record["gradients"]})
+        rows = {key: row for row, key in enumerate(keys)}
+        values = np.full((len(keys), len(records)), np.nan)
+        units = np.full((len(keys), len(records)), None, dtype=object)
+        for index, record in enumerate(records):
+            for key, value, unit_string in record["gradients"]:
+                values[rows[key], index] = value
+                units[rows[key], index] = unit_string
+
+        table["gradients"] = {}
+        for key, row in rows.items():
+            present = units[row] != None  # noqa: E711
+            column = np.full(len(records), np.nan)
+            column[present] = convert_units(
+                values[row][present],
+                units[row][present],
+                gradient_unit(units[row][present][0]),
+            )
+            table["gradients"][key] = column
+
+    return table
+
+
+def table_by_system(table):
+    # {(host, guest): {"value": ..., "uncertainty": ...}}
+    systems = {}
+    for index, (host, guest) in enumerate(zip(table["host"], table["guest"])):
+        systems[(host, guest)] = {
+            "value": table["value"][index],
+            "uncertainty": table["uncertainty"][index],
+        }
+        for key, values in table.get("gradients", {}).items():
+            systems[(host, guest)][key] = values[index]
+    return systems
+
+
+def extract_results(json_file):
+    table = read_results_table(json_file)
+
+    calculated = {}
+    for guest_name, value, uncertainty in zip(
+        table["guest"], table["value"], table["uncertainty"]
+    ):
+        calculated[guest_name] = {
+            "value": value,
+            "uncertainty": uncertainty,
+        }
+
+    return calculated